@@ -0,0 +1,583 @@
+"""
+Benchmarks for the `Monitor` class, run against a local HTTP server standing in for the monitored websites,
+so that the results don't depend on the Internet connection or on the remote servers.
+
+Usage:
+python benchmark.py fetch [--pages N] [--cycles N] [--latency SECONDS]
+python benchmark.py diff [--pages N] [--paragraphs N] [--processes N]
+python benchmark.py engine [--pages N] [--paragraphs N] [--cycles N] [--depth N]
+python benchmark.py align [--siblings N] [--repeat N]
+python benchmark.py memory [--pages N] [--paragraphs N] [--cycles N] [--changed N]
+python benchmark.py parsers [--corpus DIR] [--pages N] [--paragraphs N] [--repeat N]
+python benchmark.py save-corpus DIR URL [URL ...]
+python benchmark.py pipeline [--pages N] [--paragraphs N] [--slow SECONDS] [--cycles N]
+python benchmark.py shards [--pages N] [--paragraphs N] [--workers N] [--cycles N] [--latency SECONDS]
+"""
+import os
+import re
+import glob
+import time
+import random
+import signal
+import hashlib
+import statistics
+import argparse
+import threading
+import tracemalloc
+import functools
+import collections
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+
+from website_change_monitor import (
+    Monitor, CompactTree, MonitorStarted, CycleStarted, CycleFinished, PageChanged, HASH_ONLY, parse_page, find_compact_differences,
+    build_tree, available_parsers, keeps_positions, choose_parser, digest_text, ShardCoordinator, WorkerStarted,
+    WorkerLost, ShardChanged, PagesReassigned
+)
+
+
+def mutate_html(html, seed, changes=5):
+    """
+    Returns a version of the document made by `make_html` with a few sections changed.
+    """
+    rng = random.Random(seed)
+    for _ in range(changes):
+        i = rng.randrange(html.count('class="section"'))
+        html = html.replace(f'<h2>Section {i}</h2>', f'<h2>Section {i} (updated)</h2>')
+    return html
+
+
+def make_html(seed, paragraphs=50):
+    """
+    Returns a deterministic, moderately sized HTML document. Different seeds give different documents.
+    """
+    rng = random.Random(seed)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do']
+    body = []
+    for i in range(paragraphs):
+        text = ' '.join(rng.choice(words) for _ in range(20))
+        body.append(f'<div class="section" id="s{i}"><h2>Section {i}</h2><p>{text}</p><a href="/link/{i}">more</a></div>')
+    return f'<!DOCTYPE html><html><head><title>Page {seed}</title></head><body>{"".join(body)}</body></html>'
+
+
+def perturb_html(html):
+    """
+    Returns a version of any HTML document with a paragraph inserted at the top of its body.
+    """
+    body = re.search(r'<body[^>]*>', html, re.IGNORECASE)
+    at = body.end() if body else 0
+    return html[:at] + '<p>Breaking news!</p>' + html[at:]
+
+
+class StandInServer:
+    """
+    A local multithreaded HTTP/1.1 server (with keep-alive) serving `/page/<i>` documents.
+    It counts the requests and the TCP connections it has accepted, and can simulate network latency.
+    Documents carry an `ETag` and conditional requests for unchanged documents are answered with 304 Not Modified.
+    """
+    def __init__(self, latency=0.0, paragraphs=50, port=0):
+        self.latency = latency
+        self.slow = {}  # path -> latency of that document only
+        self.paragraphs = paragraphs
+        self.documents = {}
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                # a handler is instantiated once per accepted connection
+                with server.lock:
+                    server.connections += 1
+                super().setup()
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                if server.latency or self.path in server.slow:
+                    time.sleep(server.slow.get(self.path, server.latency))
+                body = server.document(self.path).encode()
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    with server.lock:
+                        server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        # the connections of killed clients (see `bench_shards`) are reset, that's not worth a traceback
+        self.httpd.handle_error = lambda request, client_address: None
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def document(self, path):
+        if path not in self.documents:
+            self.documents[path] = make_html(path, self.paragraphs)
+        return self.documents[path]
+
+    def urls(self, n):
+        host, port = self.httpd.server_address
+        return [f'http://{host}:{port}/page/{i}' for i in range(n)]
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.connections = 0
+            self.not_modified = 0
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def run_cycles(monitor, cycles, conditional=False):
+    """
+    Runs `cycles` download cycles of the monitor and returns the time each of them took
+    and the number of pages which failed to download in the last one.
+    If `conditional` is true, then every cycle but the first one sends conditional requests.
+    """
+    times = []
+    soups = {}
+    new_soups = {}
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        try:
+            for i in range(cycles):
+                t0 = time.perf_counter()
+                for page in monitor.update_soups(executor, new_soups, soups if conditional and i else None):
+                    continue
+                times.append(time.perf_counter() - t0)
+                soups, new_soups = new_soups, soups
+        finally:
+            monitor.close()
+    failed = sum(soup is None for soup in soups.values())
+    return times, failed
+
+
+def bench_fetch(args):
+    """
+    Compares the download cycle of the 'threads' fetch mode against the 'asyncio' one.
+    """
+    with StandInServer(latency=args.latency) as server:
+        pages = server.urls(args.pages)
+        for mode in ('threads', 'asyncio'):
+            for conditional in (False, True):
+                server.reset_counters()
+                monitor = Monitor(pages, 'html.parser', fetch_mode=mode)
+                times, failed = run_cycles(monitor, args.cycles, conditional)
+                print(f'{mode}' + (' (conditional GET)' if conditional else '') + ':')
+                print('\tcycle times:\t', ', '.join(f'{t:.3f}s' for t in times))
+                print('\tbest cycle:\t', f'{min(times):.3f}s')
+                print('\trequests:\t', server.requests)
+                print('\tnot modified:\t', server.not_modified)
+                print('\tconnections:\t', server.connections)
+                print('\tfailed:\t\t', failed)
+                print()
+
+
+def bench_diff(args):
+    """
+    Compares parsing and diff finding of large pages: `bs4` trees in a thread pool
+    against `CompactTree`s in a process pool.
+    """
+    befores = [make_html(i, args.paragraphs) for i in range(args.pages)]
+    nows = [mutate_html(html, i) for i, html in enumerate(befores)]
+    print(f'{args.pages} pairs of pages, {len(befores[0]) // 1024} KiB each, {args.processes} processes')
+    print()
+
+    monitor = Monitor([], 'html.parser')
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        t0 = time.perf_counter()
+        soups = list(executor.map(lambda html: parse_page(html, 'html.parser', None)[0], befores + nows))
+        t1 = time.perf_counter()
+        diffs = list(executor.map(lambda i: monitor.find_differences(None, None, soups[i], soups[args.pages + i]), range(args.pages)))
+        t2 = time.perf_counter()
+    print('threads (bs4):')
+    print('\tparse:\t', f'{t1 - t0:.3f}s')
+    print('\tdiff:\t', f'{t2 - t1:.3f}s')
+    print('\tchanges:', sum(map(len, diffs)))
+    print()
+
+    with concurrent.futures.ProcessPoolExecutor(args.processes) as executor:
+        concurrent.futures.wait([executor.submit(os.getpid) for _ in range(args.processes)])  # starting the workers up front
+        t0 = time.perf_counter()
+        parse = functools.partial(parse_page, parser='html.parser', previous_digest=None, compact=True)
+        trees = [tree for tree, _ in executor.map(parse, befores + nows)]
+        t1 = time.perf_counter()
+        diffs = list(executor.map(find_compact_differences, trees[:args.pages], trees[args.pages:]))
+        t2 = time.perf_counter()
+    print('processes (compact):')
+    print('\tparse:\t', f'{t1 - t0:.3f}s')
+    print('\tdiff:\t', f'{t2 - t1:.3f}s')
+    print('\tchanges:', sum(map(len, diffs)))
+    print()
+
+
+def bench_engine(args):
+    """
+    Compares the recursive `find_differences_recursive` against the iterative, hash-pruned `find_differences`
+    on large pages with a few changes in every cycle and on a deeply nested document.
+    """
+    versions = []  # for every page: its consecutive versions, one per cycle
+    for i in range(args.pages):
+        html = make_html(i, args.paragraphs)
+        page_versions = [html]
+        for cycle in range(args.cycles):
+            page_versions.append(mutate_html(page_versions[-1], f'{i}-{cycle}'))
+        versions.append([parse_page(html, 'html.parser', None)[0] for html in page_versions])
+    deep = '<div>' * args.depth + 'text' + '</div>' * args.depth
+    deep_pair = (parse_page(deep, 'html.parser', None)[0], parse_page(deep.replace('text', 'changed'), 'html.parser', None)[0])
+
+    print(f'{args.pages} pages with {args.paragraphs} sections each, {args.cycles} cycles, nesting depth {args.depth}')
+    print()
+    for name in ('recursive', 'iterative'):
+        monitor = Monitor([], 'html.parser')
+        find = monitor.find_differences_recursive if name == 'recursive' else monitor.find_differences
+        t0 = time.perf_counter()
+        changes = 0
+        for cycle in range(args.cycles):
+            for page_versions in versions:
+                changes += len(find(None, None, page_versions[cycle], page_versions[cycle + 1]))
+            monitor.forget_hashes(page_versions[cycle + 1] for page_versions in versions)
+        t1 = time.perf_counter()
+        try:
+            find(None, None, *deep_pair)
+            deep_result = f'{time.perf_counter() - t1:.3f}s'
+        except RecursionError:
+            deep_result = 'RecursionError'
+        print(f'{name}:')
+        print('\tper cycle:\t', f'{(t1 - t0) / args.cycles:.3f}s', f'({changes} changes in total)')
+        print('\tdeep:\t\t', deep_result)
+        print()
+
+
+def bench_align(args):
+    """
+    Compares the 'positional' and the 'lcs' alignment of children on a page with hundreds of siblings,
+    where one element was inserted at the top, one removed in the middle and one changed near the end.
+    """
+    html = make_html('align', args.siblings)
+    middle, end = args.siblings // 2, args.siblings - 10
+    changed = html.replace('<body>', '<body><p>Breaking news!</p>')
+    changed = changed.replace(f'<h2>Section {end}</h2>', f'<h2>Section {end} (updated)</h2>')
+    start = changed.index(f'<div class="section" id="s{middle}">')
+    changed = changed[:start] + changed[changed.index('</div>', start) + len('</div>'):]
+    before, now = parse_page(html, 'html.parser', None)[0], parse_page(changed, 'html.parser', None)[0]
+    compact_before, compact_now = CompactTree(before), CompactTree(now)
+
+    print(f'{args.siblings} siblings, 1 inserted, 1 removed, 1 changed')
+    print()
+    for alignment in ('positional', 'lcs'):
+        monitor = Monitor([], 'html.parser', alignment=alignment)
+        monitor.hashes_of(before), monitor.hashes_of(now)  # hashing is benchmarked by `engine`
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            changes = monitor.find_differences(None, None, before, now)
+        t1 = time.perf_counter()
+        for _ in range(args.repeat):
+            compact_changes = find_compact_differences(compact_before, compact_now, alignment)
+        t2 = time.perf_counter()
+        print(f'{alignment}:')
+        print('\tbs4:\t', f'{(t1 - t0) / args.repeat * 1000:.2f}ms', f'({len(changes)} changes)')
+        print('\tcompact:', f'{(t2 - t1) / args.repeat * 1000:.2f}ms', f'({len(compact_changes)} changes)')
+        print('\tkinds:\t', dict(collections.Counter(what for _, _, what, _ in changes)))
+        print()
+
+
+def bench_memory(args):
+    """
+    Compares the memory used by the monitor keeping the pages as parsed trees against the low-memory mode,
+    over a few cycles in which `changed` pages change before every cycle.
+    """
+    with StandInServer(paragraphs=args.paragraphs) as server:
+        pages = server.urls(args.pages)
+        for low_memory in (False, True):
+            server.documents.clear()
+            for page in pages:
+                server.document(page[page.index('/page/'):])  # generated before the memory is traced
+            monitor = Monitor(pages, 'html.parser', low_memory=low_memory, trace_memory=True)
+            cycles = []
+            events = monitor.watch_changes(0)
+            for event in events:
+                if not isinstance(event, CycleFinished):
+                    continue
+                cycles.append(event)
+                if len(cycles) == args.cycles:
+                    break
+                for i in range(args.changed):
+                    path = f'/page/{(len(cycles) * args.changed + i) % args.pages}'
+                    server.documents[path] = mutate_html(server.documents[path], f'{path} {len(cycles)}')
+            events.close()
+            print('low memory:' if low_memory else 'parsed trees:')
+            print('\tcycle times:\t', ', '.join(f'{cycle.elapsed:.3f}s' for cycle in cycles))
+            print('\tpeak memory:\t', ', '.join(f'{cycle.peak_memory / 2**20:.1f}MiB' for cycle in cycles))
+            print('\tkept memory:\t', ', '.join(f'{cycle.retained_memory / 2**20:.1f}MiB' for cycle in cycles))
+            print()
+
+
+def save_corpus(args):
+    """
+    Downloads the given pages into the given directory, to be used as the corpus of `parsers`.
+    """
+    os.makedirs(args.directory, exist_ok=True)
+    for i, url in enumerate(args.urls):
+        name = re.sub(r'[^\w.-]+', '_', urlsplit(url).netloc + urlsplit(url).path).strip('_')
+        path = os.path.join(args.directory, f'{i:03}_{name}.html')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(requests.get(url).text)
+        print(path)
+
+
+def bench_parsers(args):
+    """
+    Compares the parser backends over a corpus of HTML pages: saved ones (see `save_corpus`) or generated ones.
+    For every backend reports the time of parsing the corpus (and a changed version of every page),
+    the time of diffing the two versions, the memory taken by the parsed trees and whether the positions
+    of tags are kept, then the backend `Monitor(..., 'auto')` would choose.
+    """
+    if args.corpus:
+        corpus = []
+        for path in sorted(glob.glob(os.path.join(args.corpus, '*.html'))):
+            with open(path, encoding='utf-8', errors='replace') as file:
+                corpus.append(file.read())
+    else:
+        corpus = [make_html(f'corpus {i}', args.paragraphs) for i in range(args.pages)]
+    changed = [perturb_html(html) for html in corpus]
+    print(f'{len(corpus)} pages, {sum(map(len, corpus)) / 2**20:.1f}MiB of HTML')
+    print()
+
+    for parser in available_parsers():
+        if parser == HASH_ONLY:
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                for html in corpus + changed:
+                    digest_text(html)
+            print(f'{parser}:')
+            print('\tparse:\t\t', f'{(time.perf_counter() - t0) / args.repeat:.3f}s (hashing only)')
+            print()
+            continue
+
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            befores = [build_tree(html, parser) for html in corpus]
+            nows = [build_tree(html, parser) for html in changed]
+            times.append(time.perf_counter() - t0)
+
+        monitor = Monitor([], parser, alignment='lcs')
+        t0 = time.perf_counter()
+        changes = sum(len(monitor.find_differences(None, None, before, now)) for before, now in zip(befores, nows))
+        diff_time = time.perf_counter() - t0
+        monitor.tree_hashes.clear()
+        del befores, nows
+
+        tracemalloc.start()
+        trees = [build_tree(html, parser) for html in corpus]
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del trees
+
+        print(f'{parser}:')
+        print('\tparse:\t\t', f'{min(times):.3f}s')
+        print('\tdiff:\t\t', f'{diff_time:.3f}s ({changes} changes)')
+        print('\ttrees:\t\t', f'{memory / 2**20:.1f}MiB')
+        print('\tpositions:\t', all(keeps_positions(parser, html) for html in corpus[:3]))
+        print()
+
+    print('auto:', choose_parser(corpus[:3]))
+
+
+def bench_pipeline(args):
+    """
+    Compares how soon the changes are reported by `watch_changes` and `watch_pipelined`, when one of the pages
+    is served `slow` seconds late. Every page changes before every cycle.
+    """
+    with StandInServer(paragraphs=args.paragraphs) as server:
+        pages = server.urls(args.pages)
+        server.slow['/page/0'] = args.slow
+        for name in ('watch_changes', 'watch_pipelined'):
+            server.documents.clear()
+            monitor = Monitor(pages, 'html.parser')
+            delays = []
+            events = getattr(monitor, name)(0)
+            cycles = 0
+            for event in events:
+                if isinstance(event, CycleStarted):
+                    started = time.perf_counter()
+                elif isinstance(event, PageChanged) and event.page != pages[0]:
+                    delays.append(time.perf_counter() - started)
+                elif isinstance(event, (MonitorStarted, CycleFinished)):
+                    cycles += isinstance(event, CycleFinished)
+                    if cycles == args.cycles:
+                        break
+                    # every page changes before every cycle
+                    for page in pages:
+                        path = page[page.index('/page/'):]
+                        server.documents[path] = mutate_html(server.document(path), f'{path} {cycles}', 1)
+            events.close()
+            print(f'{name}:')
+            print('\treported after (median):', f'{statistics.median(delays):.3f}s')
+            print('\treported after (max):\t', f'{max(delays):.3f}s')
+            print()
+
+
+def bench_shards(args):
+    """
+    Measures how many pages per second `ShardCoordinator` checks with 1 to `workers` shard workers
+    (the pages are parsed in separate processes, so it can only grow with the number of cores),
+    then kills one of the workers and measures how long it takes until it's restarted and monitors its pages again
+    and, with the restarts disabled, until its pages are monitored by the others (which take them over
+    without being restarted).
+    """
+    with StandInServer(latency=args.latency, paragraphs=args.paragraphs) as server:
+        pages = server.urls(args.pages)
+        for workers in sorted({1, args.workers // 2 or 1, args.workers}):
+            server.documents.clear()
+            coordinator = ShardCoordinator(pages, 'html.parser', workers, 0)
+            events = coordinator.watch()
+            checked = 0
+            for event in events:
+                if isinstance(event, MonitorStarted) and not checked:
+                    started = time.perf_counter()
+                elif isinstance(event, CycleFinished):
+                    checked += event.pages
+                    # every page changes before every cycle, so that the pages are parsed and compared
+                    for page in pages[:event.pages]:
+                        path = page[page.index('/page/'):]
+                        server.documents[path] = mutate_html(server.document(path), f'{path} {checked}', 1)
+                    if checked >= args.cycles * len(pages):
+                        break
+            elapsed = time.perf_counter() - started
+            events.close()
+            print(f'{workers} workers:\t{checked / elapsed:.1f} pages/s')
+
+        print()
+        coordinator = ShardCoordinator(pages, 'html.parser', args.workers, 0)
+        events = coordinator.watch()
+        started = 0
+        for event in events:
+            if isinstance(event, MonitorStarted):
+                started += 1
+                if started == args.workers:
+                    killed = time.perf_counter()
+                    os.kill(coordinator.workers['worker-0'][0].pid, signal.SIGKILL)
+                elif started > args.workers:
+                    print(f'worker-0 restarted and monitoring its pages after {time.perf_counter() - killed:.3f}s')
+                    break
+            elif isinstance(event, WorkerLost):
+                print(f'{event.worker} lost after {time.perf_counter() - killed:.3f}s')
+        events.close()
+
+        print()
+        coordinator = ShardCoordinator(pages, 'html.parser', args.workers, 0, max_restarts=0)
+        events = coordinator.watch()
+        started = restarted = changed = reassigned = 0
+        for event in events:
+            if isinstance(event, MonitorStarted):
+                started += 1
+                if started == args.workers:
+                    print('shards:', {name: len(shard) for name, shard in coordinator.shards.items()})
+                    killed = time.perf_counter()
+                    os.kill(coordinator.workers['worker-0'][0].pid, signal.SIGKILL)
+            elif isinstance(event, WorkerLost):
+                print(f'{event.worker} lost after {time.perf_counter() - killed:.3f}s')
+            elif isinstance(event, WorkerStarted) and started == args.workers:
+                restarted += 1
+            elif isinstance(event, ShardChanged):
+                changed += 1
+            elif isinstance(event, PagesReassigned):
+                reassigned += 1
+                if reassigned == changed:
+                    break
+        print(f'its pages monitored again after {time.perf_counter() - killed:.3f}s '
+              f'({changed} shards changed, {restarted} workers restarted)')
+        print('shards:', {name: len(shard) for name, shard in coordinator.shards.items()})
+        events.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    fetch = subparsers.add_parser('fetch', help='thread pool vs asyncio downloads, with and without conditional GET')
+    fetch.add_argument('--pages', type=int, default=200)
+    fetch.add_argument('--cycles', type=int, default=3)
+    fetch.add_argument('--latency', type=float, default=0.05, help='simulated server latency in seconds')
+    fetch.set_defaults(run=bench_fetch)
+
+    diff = subparsers.add_parser('diff', help='bs4 trees in threads vs compact trees in processes')
+    diff.add_argument('--pages', type=int, default=16)
+    diff.add_argument('--paragraphs', type=int, default=1000, help='size of every page')
+    diff.add_argument('--processes', type=int, default=os.cpu_count())
+    diff.set_defaults(run=bench_diff)
+
+    engine = subparsers.add_parser('engine', help='recursive vs iterative, hash-pruned diff finding')
+    engine.add_argument('--pages', type=int, default=8)
+    engine.add_argument('--paragraphs', type=int, default=1000, help='size of every page')
+    engine.add_argument('--cycles', type=int, default=5)
+    engine.add_argument('--depth', type=int, default=5000, help='nesting depth of the deep document')
+    engine.set_defaults(run=bench_engine)
+
+    align = subparsers.add_parser('align', help='positional vs lcs alignment of children')
+    align.add_argument('--siblings', type=int, default=500)
+    align.add_argument('--repeat', type=int, default=20)
+    align.set_defaults(run=bench_align)
+
+    memory = subparsers.add_parser('memory', help='parsed trees vs compressed HTML kept between cycles')
+    memory.add_argument('--pages', type=int, default=100)
+    memory.add_argument('--paragraphs', type=int, default=200, help='size of every page')
+    memory.add_argument('--cycles', type=int, default=3)
+    memory.add_argument('--changed', type=int, default=5, help='pages changed before every cycle')
+    memory.set_defaults(run=bench_memory)
+
+    parsers = subparsers.add_parser('parsers', help='parse time, diff time and memory of every parser backend')
+    parsers.add_argument('--corpus', help='directory with saved *.html pages (see save-corpus), generated pages if not given')
+    parsers.add_argument('--pages', type=int, default=20, help='number of generated pages')
+    parsers.add_argument('--paragraphs', type=int, default=500, help='size of every generated page')
+    parsers.add_argument('--repeat', type=int, default=3)
+    parsers.set_defaults(run=bench_parsers)
+
+    pipeline = subparsers.add_parser('pipeline', help='how soon changes are reported when one page is slow')
+    pipeline.add_argument('--pages', type=int, default=50)
+    pipeline.add_argument('--paragraphs', type=int, default=100, help='size of every page')
+    pipeline.add_argument('--slow', type=float, default=2.0, help='latency of the slow page in seconds')
+    pipeline.add_argument('--cycles', type=int, default=3)
+    pipeline.set_defaults(run=bench_pipeline)
+
+    shards = subparsers.add_parser('shards', help='pages per second with more shard workers, and their failover')
+    shards.add_argument('--pages', type=int, default=100)
+    shards.add_argument('--paragraphs', type=int, default=200, help='size of every page')
+    shards.add_argument('--workers', type=int, default=4)
+    shards.add_argument('--cycles', type=int, default=3)
+    shards.add_argument('--latency', type=float, default=0.01, help='simulated server latency in seconds')
+    shards.set_defaults(run=bench_shards)
+
+    corpus = subparsers.add_parser('save-corpus', help='download pages to be used as the corpus of parsers')
+    corpus.add_argument('directory')
+    corpus.add_argument('urls', nargs='+')
+    corpus.set_defaults(run=save_corpus)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,165 @@
+"""
+Regression checks of `website_change_monitor.py`, run with `python -m pytest` (they need no Internet connection).
+"""
+import os
+import time
+import signal
+import threading
+import itertools
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from benchmark import StandInServer
+from website_change_monitor import (
+    Monitor, PageScheduled, PageUnavailable, MonitorStarted, ShardCoordinator, ShardChanged, WorkerLost, WorkerStarted
+)
+
+
+class TricklingHandler(BaseHTTPRequestHandler):
+    # sends a few bytes every 0.1s, so the download never waits for the next bytes longer than the read timeout
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', '1000')
+        self.end_headers()
+        try:
+            for _ in range(100):
+                self.wfile.write(b'<p>trickle')
+                self.wfile.flush()
+                time.sleep(0.1)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UndeclaredEncodingHandler(BaseHTTPRequestHandler):
+    # a Cyrillic page in Windows-1251 whose `Content-Type` has no charset
+    protocol_version = 'HTTP/1.1'
+    body = ('<p>' + 'Привет мир, как дела? ' * 20 + '</p>').encode('cp1251')
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xhtml+xml')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def serving(handler):
+    # yields the URL of a local server answering with the given handler
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{httpd.server_port}/'
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_scheduler_survives_a_page_which_is_down_for_good():
+    # nothing listens on port 1, so every check fails right away; the backoff used to overflow after 1024 failures
+    events = Monitor(['http://127.0.0.1:1/'], 'html.parser').watch_scheduled(0.0001, 0.0002)
+    try:
+        unavailable = 0
+        delays = set()
+        for event in itertools.islice(events, 5000):
+            unavailable += isinstance(event, PageUnavailable)
+            if isinstance(event, PageScheduled):
+                delays.add(event.interval)
+            if unavailable > 1100:
+                break
+    finally:
+        events.close()
+    assert unavailable > 1100
+    assert max(delays) == 0.0002
+
+
+@pytest.mark.parametrize('fetch_mode', ['threads', 'asyncio'])
+def test_trickling_page_is_unavailable_after_the_download_timeout(fetch_mode):
+    with serving(TricklingHandler) as page:
+        monitor = Monitor([page], 'html.parser', fetch_mode=fetch_mode, read_timeout=5, download_timeout=0.5)
+        events = monitor.watch_scheduled(10, 10)
+        try:
+            t0 = time.monotonic()
+            event = next(event for event in events if isinstance(event, (PageUnavailable, PageScheduled)))
+            assert isinstance(event, PageUnavailable)
+            assert time.monotonic() - t0 < 2
+        finally:
+            events.close()
+            monitor.close()
+
+
+def test_undeclared_encoding_is_detected_like_requests_does_it():
+    # the streamed body used to be decoded as UTF-8, while `response.text` detects the encoding
+    with serving(UndeclaredEncodingHandler) as page:
+        monitor = Monitor([page], 'html.parser')
+        text, validators, digest = monitor.download(page, {})
+        assert text == requests.get(page).text
+        assert 'Привет мир' in text
+
+
+def test_scheduler_releases_the_trees_of_checked_pages():
+    # in the low-memory mode the pages which aren't being diffed are kept as compressed HTML, not as parsed trees
+    with StandInServer(paragraphs=3) as server:
+        pages = server.urls(5)
+        events = Monitor(pages, 'html.parser', low_memory=True).watch_scheduled(0.01, 0.02)
+        try:
+            scheduled = 0
+            for event in events:
+                scheduled += isinstance(event, PageScheduled)
+                if scheduled == 3 * len(pages):
+                    break
+            versions = events.gi_frame.f_locals['versions']
+            assert set(versions) == set(pages)
+            assert all(isinstance(version, bytes) for version in versions.values())
+        finally:
+            events.close()
+
+
+def test_coordinator_restarts_a_lost_worker_until_it_gives_up_on_it():
+    with StandInServer(paragraphs=3) as server:
+        pages = server.urls(10)
+        coordinator = ShardCoordinator(pages, 'html.parser', 2, 0.05, max_restarts=1)
+        events = coordinator.watch()
+        seen = []
+        try:
+            started = 0
+            for event in itertools.islice(events, 10000):
+                if isinstance(event, MonitorStarted):
+                    started += 1
+                    if started in (2, 3):  # once all the workers are running, and once worker-0 has been restarted
+                        os.kill(coordinator.workers['worker-0'][0].pid, signal.SIGKILL)
+                elif isinstance(event, (WorkerLost, WorkerStarted, ShardChanged)):
+                    seen.append(event)
+                    if isinstance(event, ShardChanged):
+                        break
+        finally:
+            events.close()
+    assert [(type(event), event.worker) for event in seen] == [
+        (WorkerStarted, 'worker-0'), (WorkerStarted, 'worker-1'),
+        (WorkerLost, 'worker-0'), (WorkerStarted, 'worker-0'),
+        (WorkerLost, 'worker-0'), (ShardChanged, 'worker-1')
+    ]
+    assert [event.restarted for event in seen if isinstance(event, WorkerLost)] == [True, False]
+    assert seen[3].pages == seen[0].pages
+    assert seen[-1].pages == len(pages)
+
+
+def test_coordinator_refuses_a_stall_timeout_shorter_than_a_download():
+    with pytest.raises(ValueError):
+        ShardCoordinator([], 'html.parser', 2, 1, stall_timeout=10, download_timeout=30)
+    with pytest.raises(ValueError):
+        ShardCoordinator([], 'html.parser', 2, 1, download_timeout=None)
+    ShardCoordinator([], 'html.parser', 2, 1, stall_timeout=10, download_timeout=5, read_timeout=5)
@@ -1,23 +1,1422 @@
+import re
+import gc
+import os
+import math
+import json
 import time
+import codecs
+import zlib
+import heapq
+import queue
+import sqlite3
+import hashlib
+import tracemalloc
+import bisect
+import difflib
+import asyncio
+import itertools
+import threading
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import collections
 import concurrent.futures
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
 import bs4
 from bs4 import *
 
+try:
+    import aiohttp
+except ImportError:  # only needed for the 'asyncio' fetch mode
+    aiohttp = None
+
+try:
+    import lxml.html
+except ImportError:  # only needed for the XPath scopes
+    lxml = None
+
+try:
+    import html5_parser
+except (ImportError, RuntimeError):  # only needed for the 'html5-parser' parser backend
+    # (it refuses to be imported next to an `lxml` built against a different version of libxml2)
+    html5_parser = None
+
+
+class Marker:
+    """
+    A named marker standing in for a parsed page. It is pickled by its name, so it is unpickled as the same
+    module-level object (e.g. when returned from the process pool) and can always be compared with `is`.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+    def __reduce__(self):
+        return self.name
+
+
+# returned by the fetching methods instead of a parsed page when the server answered 304 Not Modified
+NOT_MODIFIED = Marker('NOT_MODIFIED')
+# returned by the fetching methods instead of a parsed page when the downloaded page has the same digest as before
+UNCHANGED = Marker('UNCHANGED')
+# stands in `soups` for a version of a page which is kept only in the snapshot store, not as a parsed tree
+STORED = Marker('STORED')
+# stands in `soups` for a version of a page parsed by the 'hash-only' parser backend, which builds no trees
+HASHED = Marker('HASHED')
+
+# the parser backend which doesn't parse the pages at all: they're compared by their digests only,
+# so a change is reported without any details (but at the cost of hashing alone)
+HASH_ONLY = 'hash-only'
+
+# what of a page is monitored (see `extract_scope`): the regions matching a CSS `selector` or an `xpath` expression
+# (the whole page if neither is given) without the elements matching any of the CSS selectors in `ignored_elements`
+# and without the `ignored_attributes` (names of HTML attributes)
+Scope = collections.namedtuple('Scope', ['selector', 'xpath', 'ignored_elements', 'ignored_attributes'],
+                               defaults=(None, None, (), ()))
+
+# what the fetching methods return: the parsed page (or `NOT_MODIFIED`/`UNCHANGED`), the validators for the next request,
+# the digest of the page and its compressed HTML (see `compress_html`), the latter only if the monitor keeps it
+# (with the snapshot store or in the low-memory mode) and the page has changed, None otherwise
+FetchResult = collections.namedtuple('FetchResult', ['soup', 'validators', 'digest', 'html'])
+
+# the JSON dump of the metrics (see `Metrics.dump`) is written at most once per that many seconds by `watch_scheduled`
+# (`watch_changes` writes it after every cycle)
+METRICS_DUMP_INTERVAL = 10
+
+# how often (in seconds) the shard workers tell the coordinator that they're alive, and after how many seconds
+# without hearing from a worker the coordinator considers it dead (see `ShardCoordinator`)
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 10.0
+# how many times a lost shard worker is restarted (with the same shard) before it's given up on
+# and its pages are given to the others (see `ShardCoordinator`)
+MAX_RESTARTS = 3
+# how many seconds (on top of the interval between cycles) the monitor of a shard worker may go without finishing
+# any download or comparison before it's considered stuck and stops its heartbeat (see `run_shard`);
+# not shorter than a download may take within the default limits (`DOWNLOAD_TIMEOUT`, which a download in the 'threads'
+# fetch mode may overrun by up to `READ_TIMEOUT`, see `Monitor.download`)
+STALL_TIMEOUT = 60.0
+
+# default limits of a single download: seconds to establish the connection, seconds to wait for the next bytes
+# of the response, seconds for the whole download and the size of the body (a page over a limit is considered
+# unavailable), so that one hanging, trickling or huge page can't stall a whole cycle or blow up the memory
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 30.0
+DOWNLOAD_TIMEOUT = 30.0
+MAX_BYTES = 10 * 2**20
+
+# the size of the chunks in which the bodies of the responses are read, decoded and hashed (see `StreamedBody`)
+CHUNK_SIZE = 64 * 2**10
+
+# the largest (number of siblings before) * (number of siblings now) in a part of the children left between
+# identical subtrees for which siblings are matched by their keys (which is quadratic), above it they are paired
+# by their positions, which keeps the cost of diffing very wide nodes bounded
+ALIGNMENT_MAX_CELLS = 100_000
+
+# how many characters of the HTML of a changed element are kept in a change event (the rest is cut off),
+# so that an element added or removed together with a large subtree doesn't blow up the event stream
+EVENT_TEXT_LIMIT = 1000
+
+# a description of an element taking part in a change, made of plain values only (no references to the parsed trees),
+# `text` is its HTML (or its text, for texts) cut to `EVENT_TEXT_LIMIT` characters, None for parents
+ElementInfo = collections.namedtuple('ElementInfo', ['type', 'name', 'sourceline', 'sourcepos', 'text'])
+# a single difference found between two versions of a page, a plain counterpart of a tuple returned by `find_differences`:
+# what has changed, where (row, col) in the new version, the two elements and their parents (`ElementInfo`s or None)
+Change = collections.namedtuple('Change', ['what', 'where', 'before', 'now', 'parents'])
+
+
+# the events produced by `Monitor.watch_changes` and `Monitor.watch_scheduled` and passed to the sinks,
+# every one of them has a `kind` (used as the 'event' field of its JSON form, see `event_to_dict`)
+# and a `time` (a UNIX timestamp of when it happened)
+
+class MonitorStarted(collections.namedtuple('MonitorStarted', ['time', 'pages', 'restored'])):
+    """The initial versions of the pages are known (`restored` of them came from the snapshot store)."""
+    __slots__ = ()
+    kind = 'started'
+
+
+class CycleStarted(collections.namedtuple('CycleStarted', ['time'])):
+    """A check of all the pages has started (`watch_changes` only)."""
+    __slots__ = ()
+    kind = 'cycle started'
+
+
+class PageChanged(collections.namedtuple('PageChanged', ['time', 'page', 'changed', 'changes'])):
+    """A page has been compared with its previous version: `changes` is a list of `Change`s found by the diff engine,
+    `changed` tells whether the versions differ according to `bs4`'s built-in comparison (or `CompactTree`'s one)."""
+    __slots__ = ()
+    kind = 'changed'
+
+
+class PageSkipped(collections.namedtuple('PageSkipped', ['time', 'page', 'reason'])):
+    """A page hasn't been diffed, because it hasn't changed: `reason` is 'not modified' (304) or 'unchanged' (same digest)."""
+    __slots__ = ()
+    kind = 'skipped'
+
+
+class PageUnavailable(collections.namedtuple('PageUnavailable', ['time', 'page'])):
+    """Downloading a page has failed."""
+    __slots__ = ()
+    kind = 'unavailable'
+
+
+class PageAvailable(collections.namedtuple('PageAvailable', ['time', 'page'])):
+    """A page which was unavailable before has been downloaded."""
+    __slots__ = ()
+    kind = 'available'
+
+
+class PageScheduled(collections.namedtuple('PageScheduled', ['time', 'page', 'interval'])):
+    """The next check of a page will take place in `interval` seconds (`watch_scheduled` only)."""
+    __slots__ = ()
+    kind = 'scheduled'
+
+
+class PagesReassigned(collections.namedtuple('PagesReassigned', ['time', 'pages', 'added', 'removed', 'restored'])):
+    """The monitored pages have been replaced (see `Monitor.set_pages`), there are `pages` of them now: `added` new ones
+    (`restored` of them from the snapshot store, the others downloaded) and `removed` ones (`watch_changes` only)."""
+    __slots__ = ()
+    kind = 'pages reassigned'
+
+
+class WorkerStarted(collections.namedtuple('WorkerStarted', ['time', 'worker', 'pages'])):
+    """A shard worker has been started with its shard of `pages` pages (`ShardCoordinator.watch` only)."""
+    __slots__ = ()
+    kind = 'worker started'
+
+
+class ShardChanged(collections.namedtuple('ShardChanged', ['time', 'worker', 'pages'])):
+    """The shard of a running worker has been changed to `pages` pages, it takes them over without being restarted
+    (`ShardCoordinator.watch` only)."""
+    __slots__ = ()
+    kind = 'shard changed'
+
+
+class WorkerLost(collections.namedtuple('WorkerLost', ['time', 'worker', 'reason', 'pages', 'restarted'])):
+    """A shard worker has exited or stopped responding, it is started again with its `pages` pages if `restarted`,
+    otherwise they are given to the others (`ShardCoordinator.watch` only)."""
+    __slots__ = ()
+    kind = 'worker lost'
+
+
+class CycleFinished(collections.namedtuple(
+        'CycleFinished', ['time', 'elapsed', 'pages', 'not_modified', 'unchanged', 'peak_memory', 'retained_memory'])):
+    """A check of all the pages has finished after `elapsed` seconds (`watch_changes` only).
+    With `trace_memory` the peak of the memory allocated during the cycle and the memory still allocated after it
+    (what is kept between cycles) are given in bytes, otherwise they are None."""
+    __slots__ = ()
+    kind = 'cycle finished'
+
+
+def validators_of(headers):
+    """
+    Extracts the cache validators from the headers of a response and returns them
+    as headers to be sent with the next, conditional request for the same page.
+    """
+    validators = {}
+    if headers.get('ETag'):
+        validators['If-None-Match'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['If-Modified-Since'] = headers['Last-Modified']
+    return validators
+
+
+def digest_text(text, ignored_attributes=None, normalize_whitespace=False):
+    """
+    Returns a digest of the given HTML text after an optional normalization:
+    `ignored_attributes` is a compiled regex matching the attributes to be stripped,
+    `normalize_whitespace` makes all runs of whitespace equivalent.
+    Two versions of a page with equal digests are considered the same, without parsing and comparing them.
+    """
+    if ignored_attributes is not None:
+        text = ignored_attributes.sub('', text)
+    if normalize_whitespace:
+        text = ' '.join(text.split())
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class StreamedBody:
+    """
+    Decodes the body of a response chunk by chunk as it arrives and, if `hashed` is true, computes its digest
+    at the same time (the same as `digest_text` without any normalization), so that an unchanged page can be
+    recognized without ever joining its text into a single string.
+    The body is decoded like `requests` decodes `response.text`: with the `encoding` of the response, UTF-8
+    if it is unknown, with the undecodable bytes replaced; if the response has no encoding (None), it is detected
+    from the whole body, so only then the raw bytes are kept until the body is complete.
+    Raises `ValueError` as soon as the body exceeds `max_bytes` (if given) and `TimeoutError` as soon as a chunk
+    arrives after the `deadline` (a `time.monotonic()` time, if given).
+    """
+    def __init__(self, page, encoding, max_bytes, hashed, deadline=None):
+        self.page = page
+        self.max_bytes = max_bytes
+        self.deadline = deadline
+        self.hash = hashlib.blake2b(digest_size=16) if hashed else None
+        self.decoder = incremental_decoder(encoding) if encoding is not None else None
+        self.raw = bytearray() if encoding is None else None
+        self.pieces = []
+        self.size = 0
+
+    def check_size(self, size):
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise ValueError(f"{self.page} is larger than {self.max_bytes} bytes")
+
+    def feed(self, chunk):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise TimeoutError(f"{self.page} took too long to download")
+        self.size += len(chunk)
+        self.check_size(self.size)
+        if self.decoder is None:
+            self.raw += chunk
+        else:
+            self.add(self.decoder.decode(chunk))
+
+    def add(self, text):
+        if self.hash is not None:
+            self.hash.update(text.encode('utf-8', 'surrogatepass'))
+        self.pieces.append(text)
+
+    def finish(self):
+        """
+        Returns the digest of the whole body (None if it isn't hashed).
+        """
+        if self.decoder is None:
+            raw, self.raw = memoryview(self.raw), None
+            self.decoder = incremental_decoder(detect_encoding(raw.obj))
+            for i in range(0, len(raw), CHUNK_SIZE):
+                self.add(self.decoder.decode(raw[i:i + CHUNK_SIZE]))
+            raw.release()
+        self.add(self.decoder.decode(b'', final=True))
+        return self.hash.digest() if self.hash is not None else None
+
+    def text(self):
+        """
+        Returns the text of the whole body, whose pieces are released (they are joined just once).
+        """
+        self.pieces = [''.join(self.pieces)]
+        return self.pieces[0]
+
+
+def incremental_decoder(encoding):
+    """
+    Returns an incremental decoder of the given encoding (of UTF-8 if it is unknown) replacing undecodable bytes.
+    """
+    try:
+        return codecs.getincrementaldecoder(encoding)('replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')('replace')
+
+
+def detect_encoding(body):
+    """
+    Guesses the encoding of the given body of a response which doesn't declare any, the same way as `requests`
+    does it (`response.apparent_encoding`), falling back to UTF-8.
+    """
+    if requests.compat.chardet is None:
+        return 'utf-8'
+    return requests.compat.chardet.detect(body)['encoding'] or 'utf-8'
+
+
+def response_chunks(response, size):
+    """
+    Yields the (decompressed) body of a streamed `requests` response in chunks of at most `size` bytes,
+    each as soon as it arrives (`iter_content` waits until a whole chunk has arrived, which a trickling body
+    may never do), so that a download can be cut off at its deadline (see `StreamedBody`).
+    Falls back to `iter_content` with `urllib3` older than 2.3, which has no `read1`.
+    """
+    read1 = getattr(response.raw, 'read1', None)
+    if read1 is None:
+        yield from response.iter_content(size)
+        return
+    while True:
+        chunk = read1(size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+
+def stable_hash(text):
+    """
+    Returns a 64-bit hash of the given string which (unlike the built-in `hash`) is the same in every process.
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little', signed=True)
+
+
+def attributes_key(tag):
+    """
+    Returns a hashable value which is equal for two tags exactly when their attributes are equal.
+    """
+    return tuple(sorted((key, tuple(value) if isinstance(value, list) else value) for key, value in tag.attrs.items()))
+
+
+def subtree_hashes(root):
+    """
+    Computes Merkle-style hashes of all the subtrees of the given `bs4` tree: the hash of a node covers its type,
+    its name and attributes (or its text) and the hashes of its children, so two subtrees have equal hashes
+    if (barring a 64-bit collision) they are equal.
+    Returns a dict mapping `id`s of the nodes to their hashes (the dict is valid as long as the tree is alive).
+    The tree is traversed in post-order with an explicit stack.
+    """
+    hashes = {}
+    if root is None:
+        return hashes
+
+    Tag = bs4.element.Tag
+    if not isinstance(root, Tag):  # texts (and anything else which can't contain children)
+        hashes[id(root)] = hash((type(root), str(root)))
+        return hashes
+
+    stack = [(root, False)]
+    push, pop = stack.append, stack.pop
+    while stack:
+        node, children_done = pop()
+        if children_done:
+            hashes[id(node)] = hash((
+                type(node), node.name, attributes_key(node) if node.attrs else (),
+                tuple([hashes[id(child)] for child in node.contents])
+            ))
+            continue
+        push((node, True))
+        for child in node.contents:
+            if isinstance(child, Tag):
+                push((child, False))
+            else:  # texts are hashed right away, there's no point in putting them on the stack
+                hashes[id(child)] = hash((type(child), str(child)))
+    return hashes
+
+
+def child_key(node):
+    """
+    Returns the key by which a `bs4` node is matched with its counterpart when aligning children (see `align_children`).
+    """
+    if isinstance(node, bs4.element.Tag):
+        return (type(node).__name__, node.name, node.get('id'))
+    return (type(node).__name__, None, None)
+
+
+def unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi):
+    """
+    Matches the elements of `a[a_lo:a_hi]` and `b[b_lo:b_hi]` which occur exactly once in both of the parts,
+    keeping the longest sequence of such matches which are in the same order on both sides (as in patience diff).
+    Returns the matches as triples `(i, j, 1)` (with absolute positions). Takes O(n log n) time.
+    """
+    a_counts = collections.Counter(a[a_lo:a_hi])
+    b_counts = collections.Counter(b[b_lo:b_hi])
+    b_positions = {b[j]: j for j in range(b_lo, b_hi) if b_counts[b[j]] == 1}
+    candidates = [(i, b_positions[a[i]]) for i in range(a_lo, a_hi) if a_counts[a[i]] == 1 and a[i] in b_positions]
+
+    # longest increasing subsequence of the positions in `b`, by patience sorting
+    tails = []  # tails[k] -- the smallest position in `b` ending an increasing subsequence of length k + 1
+    tail_indices = []
+    previous = [None] * len(candidates)
+    for index, (_, j) in enumerate(candidates):
+        k = bisect.bisect_left(tails, j)
+        if k == len(tails):
+            tails.append(j)
+            tail_indices.append(index)
+        else:
+            tails[k] = j
+            tail_indices[k] = index
+        previous[index] = tail_indices[k - 1] if k else None
+
+    anchors = []
+    index = tail_indices[-1] if tail_indices else None
+    while index is not None:
+        i, j = candidates[index]
+        anchors.append((i, j, 1))
+        index = previous[index]
+    return anchors[::-1]
+
+
+def matching_blocks(a, b, a_lo, a_hi, b_lo, b_hi, max_cells):
+    """
+    Returns the blocks of equal elements of `a[a_lo:a_hi]` and `b[b_lo:b_hi]` in the order they appear in both,
+    as triples `(i, j, size)` (with absolute positions). No blocks are returned if the parts are too large to align.
+    """
+    if a_lo == a_hi or b_lo == b_hi or (a_hi - a_lo) * (b_hi - b_lo) > max_cells:
+        return []
+    matcher = difflib.SequenceMatcher(None, a[a_lo:a_hi], b[b_lo:b_hi], autojunk=False)
+    return [(a_lo + i, b_lo + j, size) for i, j, size in matcher.get_matching_blocks() if size]
+
+
+def gaps_between(blocks, a_lo, a_hi, b_lo, b_hi):
+    """
+    Yields the ranges `(a_lo, a_hi, b_lo, b_hi)` left between consecutive matching blocks.
+    """
+    for i, j, size in blocks + [(a_hi, b_hi, 0)]:
+        if a_lo < i or b_lo < j:
+            yield a_lo, i, b_lo, j
+        a_lo, b_lo = i + size, j + size
+
+
+def align_children(before_keys, now_keys, before_hashes, now_hashes, max_cells=ALIGNMENT_MAX_CELLS):
+    """
+    Aligns two lists of siblings (given by their keys and subtree hashes), so that an element inserted or removed
+    somewhere doesn't make all the following siblings look changed, like pairing by positions does:
+    1. identical subtrees which occur once on both sides are matched with each other, keeping the longest
+       sequence of matches in the same order on both sides (see `unique_anchors`), this is O(n log n),
+    2. in between them, identical subtrees at the starts and ends of the remaining parts are matched
+       (e.g. repeated whitespace around an inserted element),
+    3. what's left, siblings with the same key (type, tag name and `id`) are matched in order (`difflib`'s
+       Ratcliff/Obershelp, a variant of the longest common subsequence), unless the part is larger
+       than `max_cells` (see `ALIGNMENT_MAX_CELLS`), in which case it falls back to pairing by positions.
+
+    Output:
+    A list of pairs `(i, j)` of positions of siblings to be compared with each other, where `i` is None for inserted
+    and `j` is None for removed siblings. Identical subtrees are not listed, there's nothing to compare there.
+    """
+    pairs = []
+    anchors = unique_anchors(before_hashes, now_hashes, 0, len(before_hashes), 0, len(now_hashes))
+    for b_lo, b_hi, n_lo, n_hi in gaps_between(anchors, 0, len(before_hashes), 0, len(now_hashes)):
+        while b_lo < b_hi and n_lo < n_hi and before_hashes[b_lo] == now_hashes[n_lo]:
+            b_lo += 1
+            n_lo += 1
+        while b_lo < b_hi and n_lo < n_hi and before_hashes[b_hi - 1] == now_hashes[n_hi - 1]:
+            b_hi -= 1
+            n_hi -= 1
+
+        if (b_hi - b_lo) * (n_hi - n_lo) > max_cells:
+            pairs.extend(itertools.zip_longest(range(b_lo, b_hi), range(n_lo, n_hi)))
+            continue
+        same_keys = matching_blocks(before_keys, now_keys, b_lo, b_hi, n_lo, n_hi, max_cells)
+        for i, j, size in same_keys:
+            pairs.extend(zip(range(i, i + size), range(j, j + size)))
+        for gb_lo, gb_hi, gn_lo, gn_hi in gaps_between(same_keys, b_lo, b_hi, n_lo, n_hi):
+            pairs.extend((i, None) for i in range(gb_lo, gb_hi))
+            pairs.extend((None, j) for j in range(gn_lo, gn_hi))
+    return pairs
+
+
+class CompactTree:
+    """
+    A compact, picklable representation of a parsed HTML tree.
+
+    `bs4` trees are made of many interlinked objects, so pickling them (which is needed to pass them
+    to other processes) is slow and fails with a recursion error on large pages. Here the whole tree
+    is stored in a few flat arrays instead, indexed by node numbers. Nodes are numbered in the BFS order,
+    so the children of every node have consecutive numbers (node 0 is the root of the document):
+    `types` -- index of the node's `bs4` class name in `type_names`
+    `names` -- index of the tag's name in `strings` (-1 for texts)
+    `attrs` -- hash of the tag's attributes (0 for texts)
+    `ids` -- hash of the tag's `id` attribute (0 for texts and tags without it)
+    `text_start`, `text_end` -- offsets of the node's text in `text` (empty for tags)
+    `child_start`, `child_end` -- range of the node's children
+    `parents` -- the parent's node number (-1 for the root)
+    `lines`, `positions` -- `sourceline` and `sourcepos` of the tag in the source (-1 if unknown)
+    `hashes` -- Merkle-style hash of the node's subtree (just like `subtree_hashes`, but the same in every process)
+    """
+    __slots__ = ('type_names', 'strings', 'text', 'types', 'names', 'attrs', 'ids', 'text_start', 'text_end',
+                 'child_start', 'child_end', 'parents', 'lines', 'positions', 'hashes')
+
+    def __init__(self, soup):
+        """
+        Builds the compact representation of the given `bs4` tree (usually a `BeautifulSoup` object).
+        """
+        self.type_names = []
+        self.strings = []
+        self.types = array('H')
+        self.names = array('i')
+        self.attrs = array('q')
+        self.ids = array('q')
+        self.text_start = array('I')
+        self.text_end = array('I')
+        self.child_start = array('I')
+        self.child_end = array('I')
+        self.parents = array('i')
+        self.lines = array('i')
+        self.positions = array('i')
+
+        type_index = {}
+        string_index = {}
+        texts = []
+        offset = 0
+
+        queue = collections.deque([(soup, -1)])
+        count = 1  # number of nodes already enqueued
+        while queue:
+            node, parent = queue.popleft()
+
+            type_name = type(node).__name__
+            if type_name not in type_index:
+                type_index[type_name] = len(self.type_names)
+                self.type_names.append(type_name)
+            self.types.append(type_index[type_name])
+            self.parents.append(parent)
+
+            if isinstance(node, bs4.element.NavigableString):
+                self.names.append(-1)
+                self.attrs.append(0)
+                self.ids.append(0)
+                texts.append(str(node))
+                self.text_start.append(offset)
+                offset += len(texts[-1])
+                self.text_end.append(offset)
+                self.child_start.append(count)
+                self.child_end.append(count)
+                self.lines.append(-1)
+                self.positions.append(-1)
+                continue
+
+            if node.name not in string_index:
+                string_index[node.name] = len(self.strings)
+                self.strings.append(node.name)
+            self.names.append(string_index[node.name])
+            self.attrs.append(stable_hash(repr(sorted(
+                (key, ' '.join(value) if isinstance(value, list) else value) for key, value in node.attrs.items()
+            ))))
+            self.ids.append(stable_hash(node['id']) if isinstance(node.get('id'), str) else 0)
+            self.text_start.append(offset)
+            self.text_end.append(offset)
+            self.lines.append(node.sourceline if getattr(node, 'sourceline', None) is not None else -1)
+            self.positions.append(node.sourcepos if getattr(node, 'sourcepos', None) is not None else -1)
+
+            index = len(self.types) - 1
+            self.child_start.append(count)
+            for child in node.contents:
+                queue.append((child, index))
+            count += len(node.contents)
+            self.child_end.append(count)
+
+        self.text = ''.join(texts)
+
+        # children always have larger numbers than their parents, so going backwards
+        # every node is hashed after its children (hashes of tuples of ints don't depend on the process)
+        type_hashes = [stable_hash(type_name) for type_name in self.type_names]
+        string_hashes = [stable_hash(string) for string in self.strings]
+        hashes = [0] * len(self.types)
+        for i in range(len(self.types) - 1, -1, -1):
+            if self.names[i] < 0:
+                hashes[i] = hash((type_hashes[self.types[i]], stable_hash(self.text[self.text_start[i]:self.text_end[i]])))
+            else:
+                hashes[i] = hash((type_hashes[self.types[i]], string_hashes[self.names[i]], self.attrs[i],
+                                  tuple(hashes[self.child_start[i]:self.child_end[i]])))
+        self.hashes = array('q', hashes)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __eq__(self, other):
+        # equivalent to `bs4`'s comparison of whole trees, but done on arrays (so mostly in C)
+        if not isinstance(other, CompactTree):
+            return NotImplemented
+        # the string tables are built in the order of nodes, so for equal trees they are equal as well
+        if self.hashes[0] != other.hashes[0]:
+            return False
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__ if slot not in ('lines', 'positions'))
+
+    def type_name(self, i):
+        return self.type_names[self.types[i]]
+
+    def name(self, i):
+        return self.strings[self.names[i]] if self.names[i] >= 0 else None
+
+    def node_text(self, i):
+        return self.text[self.text_start[i]:self.text_end[i]]
+
+    def is_text(self, i):
+        return self.names[i] < 0
+
+    def where(self, i):
+        """
+        Returns `(row, col)` of the node in the source, or `(None, None)` for texts (just like `find_differences`).
+        """
+        if self.is_text(i):
+            return (None, None)
+        return (self.lines[i] if self.lines[i] >= 0 else None, self.positions[i] if self.positions[i] >= 0 else None)
+
+    def key(self, i):
+        """
+        Returns the key by which the node is matched with its counterpart when aligning children (see `align_children`).
+        """
+        return (self.type_name(i), self.name(i), self.ids[i])
+
+    def node(self, i):
+        """
+        Returns a lightweight view of the given node, or None if `i` is None.
+        """
+        return CompactNode(self, i) if i is not None else None
+
+
+class CompactNode:
+    """
+    A view of a single node of a `CompactTree`, offering the few attributes of `bs4` elements used by `print_changes`.
+    """
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def name(self):
+        return self.tree.name(self.index)
+
+    @property
+    def sourceline(self):
+        return self.tree.where(self.index)[0]
+
+    @property
+    def sourcepos(self):
+        return self.tree.where(self.index)[1]
+
+    def __str__(self):
+        if self.tree.is_text(self.index):
+            return self.tree.node_text(self.index)
+        start, end = self.tree.child_start[self.index], self.tree.child_end[self.index]
+        return f'<{self.name}> ({end - start} children)'
+
+
+def find_compact_differences(before, now, alignment='positional', max_alignment_cells=ALIGNMENT_MAX_CELLS):
+    """
+    The counterpart of `Monitor.find_differences` for two `CompactTree`s, comparing them from their roots.
+    It is a module-level function, so it can be run in a separate process.
+    `alignment` and `max_alignment_cells` have the same meaning as the arguments of `Monitor`.
+
+    Output:
+    A list of tuples in the same format as the output of `Monitor.find_differences`,
+    except that instead of the elements (and their parents) their node numbers in `before` and `now` are given
+    (None where the element doesn't exist). `CompactTree.node` turns them into printable views.
+    """
+    differences = []
+    # an explicit stack instead of the recursion, the trees are arrays anyway
+    stack = [(None, None, 0, 0)]
+    while stack:
+        before_parent, now_parent, b, n = stack.pop()
+        if b is not None and n is not None and before.hashes[b] == now.hashes[n]:
+            continue  # identical subtrees
+
+        parents = (before_parent, now_parent)
+        where = now.where(n) if n is not None else (None, None)
+        elems = (b, n)
+
+        if n is None:
+            differences.append((where, parents, 'element removed', elems))
+            continue
+        if b is None:
+            differences.append((where, parents, 'element added', elems))
+            continue
+        if before.type_name(b) != now.type_name(n):
+            differences.append((where, parents, 'element type', elems))
+            continue
+
+        if before.is_text(b):
+            if before.node_text(b) != now.node_text(n):
+                differences.append((where, parents, 'text', elems))
+            continue
+
+        what = []  # list of what has changed here
+        if before.name(b) != now.name(n):
+            what.append('type')
+        if before.attrs[b] != now.attrs[n]:
+            what.append('attributes')
+        if what:
+            differences.append((where, parents, 'tag ' + ', '.join(what), elems))
+
+        before_children = range(before.child_start[b], before.child_end[b])
+        now_children = range(now.child_start[n], now.child_end[n])
+        if alignment == 'positional':
+            # children are paired by their positions, the shorter list is padded with Nones
+            for c1, c2 in itertools.zip_longest(before_children, now_children):
+                stack.append((b, n, c1, c2))
+        else:
+            pairs = align_children(
+                [before.key(c) for c in before_children], [now.key(c) for c in now_children],
+                before.hashes[before_children.start:before_children.stop], now.hashes[now_children.start:now_children.stop],
+                max_alignment_cells
+            )
+            for i, j in pairs:
+                stack.append((b, n, before_children[i] if i is not None else None, now_children[j] if j is not None else None))
+
+    return differences
+
+
+def build_tree(text, parser, compact=False):
+    """
+    Parses the HTML text with the given parser backend: one of the `bs4` parsers ('html.parser', 'lxml', 'html5lib')
+    or 'html5-parser' (a C implementation of the HTML5 parsing algorithm building the `bs4` tree directly).
+    If `compact` is true, then the parsed tree is converted to a `CompactTree`.
+    It is a module-level function, so it can be run in a separate process.
+    """
+    if parser == 'html5-parser':
+        soup = html5_parser.parse(text, treebuilder='soup', return_root=False)
+    else:
+        soup = BeautifulSoup(text, parser)
+    return CompactTree(soup) if compact else soup
+
+
+def available_parsers():
+    """
+    Returns the names of the parser backends which can be used here (some of them need optional modules).
+    """
+    parsers = [name for name in ('html.parser', 'lxml', 'html5lib') if bs4.builder.builder_registry.lookup(name) is not None]
+    if html5_parser is not None:
+        parsers.append('html5-parser')
+    return parsers + [HASH_ONLY]
+
+
+def keeps_positions(parser, text):
+    """
+    Checks whether the given parser backend gives every tag of the given page its `sourceline` and `sourcepos`,
+    and the same ones every time (so that the positions of changes can be reported and compared between cycles).
+    """
+    if parser == HASH_ONLY:
+        return False
+    positions = [[(tag.sourceline, tag.sourcepos) for tag in build_tree(text, parser).find_all(True)] for _ in range(2)]
+    return positions[0] == positions[1] and all(line is not None and pos is not None for line, pos in positions[0])
+
+
+def choose_parser(samples, repeat=3):
+    """
+    Returns the fastest of the available parser backends (see `available_parsers`) which keep the positions
+    of tags (see `keeps_positions`), measured by parsing the given HTML texts `repeat` times (the best time counts).
+    """
+    best, best_time = 'html.parser', None
+    for parser in available_parsers():
+        if not all(keeps_positions(parser, text) for text in samples):
+            continue
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for text in samples:
+                build_tree(text, parser)
+            times.append(time.perf_counter() - t0)
+        if best_time is None or min(times) < best_time:
+            best, best_time = parser, min(times)
+    return best
+
+
+def extract_scope(text, scope, parser):
+    """
+    Returns the HTML of the regions of the page selected by the given `Scope`, one after another,
+    with the ignored elements removed and the ignored attributes stripped. The monitor hashes, parses and diffs
+    only this HTML, so the changes outside of the regions don't make the page changed, and the positions
+    of the changes are given within it.
+    It is a module-level function, so it can be run in a separate process.
+    """
+    if parser == HASH_ONLY:
+        parser = 'html.parser'  # the regions have to be found in the tree anyway
+    if scope.xpath is not None:
+        matches = lxml.html.fromstring(text).xpath(scope.xpath)
+        # the results of XPath expressions can also be texts (e.g. `//title/text()`)
+        regions = [build_tree(''.join(
+            match if isinstance(match, str) else lxml.html.tostring(match, encoding='unicode', with_tail=False)
+            for match in matches
+        ), parser)]
+    else:
+        soup = build_tree(text, parser)
+        regions = soup.select(scope.selector) if scope.selector is not None else [soup]
+
+    for region in regions:
+        for selector in scope.ignored_elements:
+            for element in region.select(selector):
+                element.decompose()
+        if scope.ignored_attributes:
+            for tag in itertools.chain([region], region.find_all(True)):
+                for attribute in scope.ignored_attributes:
+                    tag.attrs.pop(attribute, None)
+    return ''.join(str(region) for region in regions)
+
+
+def parse_page(text, parser, previous_digest, ignored_attributes=None, normalize_whitespace=False, compact=False):
+    """
+    Parses the downloaded HTML text (see `build_tree`), unless its digest is equal to `previous_digest`.
+    It is a module-level function, so it can be run in a separate process.
+    Returns a pair: the parsed page (or `UNCHANGED`, or `HASHED` for the 'hash-only' backend) and the digest of the text.
+    """
+    digest = digest_text(text, ignored_attributes, normalize_whitespace)
+    if digest == previous_digest:
+        return UNCHANGED, digest
+    if parser == HASH_ONLY:
+        return HASHED, digest
+    return build_tree(text, parser, compact), digest
+
+
+def compress_html(text):
+    """
+    Returns the given HTML text compressed, the form in which the versions of the pages are kept
+    in the snapshot store and in the low-memory mode.
+    """
+    return zlib.compress(text.encode('utf-8', 'surrogatepass'))
+
+
+def restore_tree(compressed, parser, compact=False):
+    """
+    Parses a version of a page which was kept compressed (see `compress_html`).
+    It is a module-level function, so it can be run in a separate process.
+    """
+    return build_tree(zlib.decompress(compressed).decode('utf-8', 'surrogatepass'), parser, compact)
+
+
+def compare_compact(before, now, parser, alignment='positional', max_alignment_cells=ALIGNMENT_MAX_CELLS):
+    """
+    Compares two versions of a page kept as `CompactTree`s, the previous one can also be given compressed
+    (then it is parsed here first). Returns a triple: the output of `find_compact_differences`, whether
+    the trees are different according to `CompactTree`'s comparison and how many seconds it took.
+    It is a module-level function, so it can be run in a separate process.
+    """
+    t0 = time.perf_counter()
+    if isinstance(before, bytes):
+        before = restore_tree(before, parser, compact=True)
+    differences = find_compact_differences(before, now, alignment, max_alignment_cells)
+    # the node numbers are meaningless outside of this process, so they're turned into descriptions here
+    differences = [
+        (where, (before.node(pb), now.node(pn)), what, (before.node(b), now.node(n)))
+        for where, (pb, pn), what, (b, n) in differences
+    ]
+    return describe_changes(differences), before != now, time.perf_counter() - t0
+
+
+def html_pieces(root):
+    """
+    Yields the HTML of the given `bs4` element piece by piece (the same as `str(root)` once joined),
+    so that serializing it can be stopped at any point. The tree is walked without recursion, however deep it is.
+    """
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, bs4.NavigableString):
+            # a string on its own is just its text, within a tag it's formatted (e.g. a comment gets its `<!-- -->`)
+            yield str(item) if item is root else item.output_ready()
+        elif isinstance(item, str):
+            yield item  # a closing tag
+        elif not item.contents:
+            yield str(item)
+        else:
+            if not item.hidden:
+                # the opening tag is serialized from a childless copy of the tag, without its closing tag
+                closing = f'</{item.prefix + ":" if item.prefix else ""}{item.name}>'
+                opening = str(Tag(name=item.name, attrs=item.attrs, prefix=item.prefix, can_be_empty_element=False))
+                yield opening[:len(opening) - len(closing)]
+                stack.append(closing)
+            stack.extend(reversed(item.contents))
+
+
+def element_html(element, limit):
+    """
+    Returns the HTML of the given `bs4` element (or `CompactNode`) cut to `limit` characters, serializing only
+    as much of it as that takes, instead of the whole subtree (which can be most of a large page).
+    """
+    if isinstance(element, CompactNode):
+        return str(element)[:limit]
+    pieces = []
+    length = 0
+    for piece in html_pieces(element):
+        pieces.append(piece)
+        length += len(piece)
+        if length >= limit:
+            break
+    return ''.join(pieces)[:limit]
+
+
+def describe_element(element, with_text=True):
+    """
+    Returns an `ElementInfo` of the given `bs4` element or `CompactNode` (None if `element` is None).
+    """
+    if element is None:
+        return None
+    if isinstance(element, CompactNode):
+        type_name = element.tree.type_name(element.index)
+    else:
+        type_name = type(element).__name__
+    text = element_html(element, EVENT_TEXT_LIMIT) if with_text else None
+    return ElementInfo(
+        type_name, element.name, getattr(element, 'sourceline', None), getattr(element, 'sourcepos', None), text
+    )
+
+
+def describe_changes(differences):
+    """
+    Turns the output of `Monitor.find_differences` (or of `find_compact_differences` with the node numbers
+    replaced by `CompactNode`s) into a list of `Change`s, which don't keep the compared trees alive.
+    """
+    return [
+        Change(what, where, describe_element(b), describe_element(n),
+               (describe_element(pb, with_text=False), describe_element(pn, with_text=False)))
+        for where, (pb, pn), what, (b, n) in differences
+    ]
+
+
+class SnapshotStore:
+    """
+    Persists the latest versions of the monitored pages in an SQLite database, so that a restarted monitor
+    can diff against them right away instead of fetching the initial data again.
+    For every page its HTML (compressed with zlib), digest, cache validators and the time of the last check are kept.
+    Should be used from a single thread at a time (it's the main one, except in `Monitor.watch_pipelined`).
+    The monitor keeps `STORED` in place of the pages' trees and loads a page from the store only when it has
+    to be diffed (see `update_soups`).
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            'page TEXT PRIMARY KEY, html BLOB NOT NULL, digest BLOB NOT NULL, validators TEXT NOT NULL, checked_at REAL NOT NULL)'
+        )
+        self.connection.commit()
+
+    def save(self, page, html, digest, validators):
+        """
+        Stores a new version of the page, `html` is its compressed HTML (see `compress_html`).
+        """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO snapshots (page, html, digest, validators, checked_at) VALUES (?, ?, ?, ?, ?)',
+            (page, html, digest, json.dumps(validators), time.time())
+        )
+
+    def touch(self, page, validators):
+        """
+        Records that the page has been checked and found unchanged.
+        """
+        self.connection.execute(
+            'UPDATE snapshots SET validators = ?, checked_at = ? WHERE page = ?', (json.dumps(validators), time.time(), page)
+        )
+
+    def load(self, page):
+        """
+        Returns the compressed HTML of the stored version of the page (see `restore_tree`), or None if there's none.
+        """
+        row = self.connection.execute('SELECT html FROM snapshots WHERE page = ?', (page, )).fetchone()
+        return row[0] if row is not None else None
+
+    def metadata(self, pages):
+        """
+        Returns a dict mapping those of the given pages which are stored to pairs: their digests and validators.
+        """
+        pages = set(pages)
+        return {
+            page: (digest, json.loads(validators))
+            for page, digest, validators in self.connection.execute('SELECT page, digest, validators FROM snapshots')
+            if page in pages
+        }
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def event_to_dict(event):
+    """
+    Returns the given event as a dict of JSON-serializable values, with the kind of the event under the 'event' key.
+    """
+    def plain(value):
+        if hasattr(value, '_asdict'):
+            return {key: plain(item) for key, item in value._asdict().items()}
+        if isinstance(value, (list, tuple)):
+            return [plain(item) for item in value]
+        return value
+
+    return {'event': event.kind, **plain(event)}
+
+
+def print_event(event):
+    """
+    The default sink of the monitoring methods: prints the given event to the console.
+    """
+    if isinstance(event, MonitorStarted):
+        if event.restored:
+            print(f"Restored {event.restored}/{event.pages} pages from the snapshot store.")
+        print("Done. Waiting the given time interval...")
+        print()
+    elif isinstance(event, CycleStarted):
+        print("RESULTS:\n")
+    elif isinstance(event, PageUnavailable):
+        print(f"{event.page}\nPage unavailable.\n")
+    elif isinstance(event, PageAvailable):
+        print(f"{event.page}\nPage is now available (previously unavailable).\n")
+    elif isinstance(event, PageChanged):
+        print(event.page)
+        print("Changed:", event.changed)  # `bs4`'s built-in comparison (or `CompactTree`'s one)
+        print(len(event.changes))  # number of changes found by my code
+        print()
+    elif isinstance(event, CycleFinished):
+        print(f"Time elapsed: {event.elapsed}s")
+        print(f"Pages not modified (skipped): {event.not_modified}/{event.pages}")
+        print(f"Pages unchanged (skipped): {event.unchanged}/{event.pages}")
+        if event.peak_memory is not None:
+            print(f"Peak memory: {event.peak_memory / 2**20:.1f} MiB (kept between cycles: {event.retained_memory / 2**20:.1f} MiB)")
+        print()
+        print("===================================================")
+        print("===================================================")
+        print()
+    elif isinstance(event, PagesReassigned):
+        print(f"Monitoring {event.pages} pages now ({event.added} added, {event.removed} removed).\n")
+    elif isinstance(event, WorkerStarted):
+        print(f"Shard worker {event.worker} started with {event.pages} pages.\n")
+    elif isinstance(event, ShardChanged):
+        print(f"Shard worker {event.worker} monitors {event.pages} pages now.\n")
+    elif isinstance(event, WorkerLost):
+        if event.restarted:
+            print(f"Shard worker {event.worker} lost ({event.reason}), restarting it with its {event.pages} pages.\n")
+        else:
+            print(f"Shard worker {event.worker} lost ({event.reason}), its {event.pages} pages are given to the others.\n")
+    # skipped pages and the schedule are not worth printing
+
+
+class JsonLinesSink:
+    """
+    A sink writing every event as a line of JSON (see `event_to_dict`) to the given file,
+    flushed right away, so that other programs can follow the file while the monitor is running.
+    `kinds` -- if given, then only the events of these kinds are written (e.g. `('changed', 'unavailable')`)
+    """
+    def __init__(self, path, kinds=None):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.kinds = set(kinds) if kinds is not None else None
+
+    def __call__(self, event):
+        if self.kinds is not None and event.kind not in self.kinds:
+            return
+        self.file.write(json.dumps(event_to_dict(event), ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Metrics:
+    """
+    Counters and timings of the stages of monitoring, collected by the monitor (see `Monitor.metrics`)
+    from all of its threads, and exposed in the Prometheus text format (see `serve`) or as JSON (see `dump`).
+    The stages are:
+    -- 'connect' (including DNS) and 'dns' -- only in the 'asyncio' fetch mode, as `requests` doesn't tell them apart,
+    -- 'response' -- from sending the request to receiving the headers of the response,
+    -- 'download' -- receiving the body of the response,
+    -- 'scope', 'hash', 'parse' and 'compress' -- see `Monitor.parse`,
+    -- 'diff' -- comparing two versions of a page (see `Monitor.compare`).
+    For every stage the number of observations, their total and maximum time are kept, and for every page
+    the time of its latest observation of every stage.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.stages = {}  # stage -> [number of observations, total seconds, max seconds]
+        self.page_stages = {}  # page -> {stage -> seconds of the latest observation}
+        self.server = None
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, stage, seconds, page=None):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            if page is not None:
+                self.page_stages.setdefault(page, {})[stage] = seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage, page=None):
+        """
+        Observes how long the body of the `with` statement takes as the given stage.
+        """
+        t0 = time.perf_counter()
+        yield
+        self.observe(stage, time.perf_counter() - t0, page)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {stage: {'count': n, 'seconds': total, 'max': longest} for stage, (n, total, longest) in self.stages.items()},
+                'pages': {page: dict(stages) for page, stages in self.page_stages.items()},
+            }
+
+    def prometheus_text(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        metrics = self.to_dict()
+        lines = []
+        for name, value in sorted(metrics['counters'].items()):
+            lines.append(f'# TYPE monitor_{name}_total counter')
+            lines.append(f'monitor_{name}_total {value}')
+        lines.append('# TYPE monitor_stage_seconds summary')
+        for stage, totals in sorted(metrics['stages'].items()):
+            lines.append(f'monitor_stage_seconds_sum{{stage="{label(stage)}"}} {totals["seconds"]}')
+            lines.append(f'monitor_stage_seconds_count{{stage="{label(stage)}"}} {totals["count"]}')
+        lines.append('# TYPE monitor_stage_seconds_max gauge')
+        for stage, totals in sorted(metrics['stages'].items()):
+            lines.append(f'monitor_stage_seconds_max{{stage="{label(stage)}"}} {totals["max"]}')
+        lines.append('# TYPE monitor_page_stage_seconds gauge')
+        for page, stages in sorted(metrics['pages'].items()):
+            for stage, seconds in sorted(stages.items()):
+                lines.append(f'monitor_page_stage_seconds{{page="{label(page)}",stage="{label(stage)}"}} {seconds}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """
+        Writes the metrics as JSON to the given file, replacing it at once (so the readers never see half of it).
+        """
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(self.to_dict(), file)
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Starts serving the metrics in the Prometheus text format at http://host:port/metrics, in a separate thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
 
 class Monitor:
-    def __init__(self, pages, parser):
+    def __init__(self, pages, parser, fetch_mode='threads', max_connections=100, max_connections_per_host=8,
+                 normalize_whitespace=False, ignored_attributes=(), processes=0,
+                 alignment='positional', max_alignment_cells=ALIGNMENT_MAX_CELLS, store=None,
+                 low_memory=False, trace_memory=False, scopes=None, metrics_port=None, metrics_file=None,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, download_timeout=DOWNLOAD_TIMEOUT,
+                 max_bytes=MAX_BYTES):
         """
         Input:
         `pages` -- list of URLs of HTML-based websites to be monitored
-        `parser` -- HTML parser to be used by `bs4` module to parse the HTML tree
+        `parser` -- HTML parser backend to be used to parse the HTML tree: 'html.parser', 'lxml', 'html5lib',
+                    'html5-parser' (see `build_tree`), 'hash-only' (no parsing, changes are found by digests only,
+                    without any details) or 'auto' -- the fastest available one which keeps the positions of tags,
+                    chosen with the first downloaded page (see `choose_parser`, and `benchmark.py parsers`)
+        `scopes` -- a dict mapping pages to `Scope`s: only the selected regions of those pages are monitored
+                    (hashed, parsed and diffed), see `extract_scope`
+        `metrics_port` -- if given, then the metrics (see `Metrics`) are served at http://127.0.0.1:<metrics_port>/metrics
+                          while the monitor is running
+        `metrics_file` -- if given, then the metrics are dumped as JSON to that file periodically
+        `fetch_mode` -- 'threads' downloads every page with a separate `requests.get` call in a thread pool,
+                        'asyncio' downloads all pages from a single event loop over a shared pool of keep-alive
+                        connections (requires the `aiohttp` module)
+        `max_connections` -- the total number of connections kept open at once in the 'asyncio' mode
+        `max_connections_per_host` -- the number of connections to a single host kept open at once in the 'asyncio' mode
+        `normalize_whitespace` -- if true, then changes in whitespace only are not considered changes of the page
+        `ignored_attributes` -- names of HTML attributes whose values change on every load (e.g. 'nonce'),
+                                changes in their values only are not considered changes of the page
+        `processes` -- if positive, then parsing and diff finding run in a pool of that many processes
+                       and the pages are kept as `CompactTree`s instead of `bs4` trees (because those can't be pickled)
+        `alignment` -- 'positional' compares children of corresponding elements by their positions,
+                       'lcs' aligns them first (see `align_children`), so that insertions and removals
+                       are reported as such instead of as changes of all the following siblings
+        `max_alignment_cells` -- bounds the cost of the 'lcs' alignment of very wide elements (see `ALIGNMENT_MAX_CELLS`)
+        `store` -- path of an SQLite database in which the latest versions of the pages are persisted (see `SnapshotStore`),
+                   with it the monitor resumes from the last state after a restart, and the pages are kept
+                   as parsed trees only while they're being diffed (otherwise they're reparsed from the store)
+        `low_memory` -- if true, then between the checks the pages are kept as compressed HTML instead of parsed trees
+                        (like with the `store`, just in memory), and the previous version of a page is parsed again
+                        only when the page has changed (its digest is different), right before diffing it
+        `trace_memory` -- if true, then the peak memory of every cycle is measured with `tracemalloc` and reported
+                          in `CycleFinished` (this slows allocations down, and the memory of the processes
+                          of the process pool isn't counted)
+        `connect_timeout`, `read_timeout` -- how many seconds a download may wait for the connection to be established
+                                             and for the next bytes of the response (None waits forever)
+        `download_timeout` -- how many seconds the whole download of a page may take, a page taking longer
+                              is treated as unavailable (None waits forever)
+        `max_bytes` -- the largest accepted (decompressed) body of a page, a larger one is treated as unavailable
+                       (None accepts any size); the bodies are streamed, decoded and, unless the digest needs
+                       some normalization, hashed while they arrive (see `StreamedBody`); the bodies of pages
+                       with a scope are always hashed whole, so that a byte-identical one isn't even scoped
         """
+        if fetch_mode not in ('threads', 'asyncio'):
+            raise ValueError(f"unknown fetch mode: {fetch_mode!r}")
+        if alignment not in ('positional', 'lcs'):
+            raise ValueError(f"unknown alignment: {alignment!r}")
+        if fetch_mode == 'asyncio' and aiohttp is None:
+            raise ImportError("the 'asyncio' fetch mode requires the `aiohttp` module")
+        if parser == 'html5-parser' and html5_parser is None:
+            raise ImportError("the 'html5-parser' parser backend requires the `html5_parser` module")
+        scopes = scopes or {}
+        if lxml is None and any(scope.xpath is not None for scope in scopes.values()):
+            raise ImportError("XPath scopes require the `lxml` module")
+        if any(scope.xpath is not None and scope.selector is not None for scope in scopes.values()):
+            raise ValueError("a scope can have either a CSS selector or an XPath expression, not both")
+
         self.pages = pages
         self.parser = parser
+        # the 'auto' parser is chosen by the first thread to parse a page, the others wait for it
+        self.parser_lock = threading.Lock()
+        self.scopes = scopes
+        # timings of the stages of every check and counters of what has happened, see `Metrics`
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.metrics_dumped_at = 0
+        self.fetch_mode = fetch_mode
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.normalize_whitespace = normalize_whitespace
+        self.ignored_attributes = re.compile(
+            r'\s(?:' + '|'.join(map(re.escape, ignored_attributes)) + r')\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]*)',
+            re.IGNORECASE
+        ) if ignored_attributes else None
+        self.processes = processes
+        self.alignment = alignment
+        self.max_alignment_cells = max_alignment_cells
+        self.store = SnapshotStore(store) if store is not None else None
+        self.low_memory = low_memory
+        self.trace_memory = trace_memory
+        # the compressed HTML of the pages downloaded since the last `release_trees`, which replaces their trees then
+        self.snapshots = {}
+        # created on first use, just like the event loop of the 'asyncio' fetch mode
+        self.process_executor = None
+        # `time.monotonic()` of the latest finished download or comparison (or sent event, see `run_shard`),
+        # which tells whether the monitor is making progress or is stuck
+        self.progressed_at = time.monotonic()
+        # the pages to be monitored instead of `pages` from the next cycle on (see `set_pages`)
+        self.next_pages = None
+        self.pages_lock = threading.Lock()
+
+        # the event loop (running in its own thread) and the HTTP session of the 'asyncio' mode,
+        # both are created on first use and live as long as the monitor, so that the connections are reused between cycles
+        self.loop = None
+        self.loop_thread = None
+        self.http_session = None
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.download_timeout = download_timeout
+        self.max_bytes = max_bytes
+
+        # cache validators (`If-None-Match`/`If-Modified-Since` headers) of the last successful download of every page
+        self.validators = {}
+        # pages which were answered with 304 Not Modified in the latest download cycle
+        self.not_modified = set()
+        # digests of the (normalized) HTML of the last successful download of every page
+        self.digests = {}
+        # digests of the whole (raw) HTML of the last successful download of every page with a scope,
+        # whose `digests` are the digests of the selected regions only (see `parse`)
+        self.raw_digests = {}
+        # pages which were downloaded in the latest download cycle, but turned out to have the same digest as before
+        self.unchanged = set()
+        # subtree hashes of the trees compared by `find_differences`: `id` of the root -> (the root, the hashes);
+        # the current version of a page is the previous one in the next cycle, so this way every tree is hashed once
+        self.tree_hashes = {}
 
     def find_differences(self, before_parent, now_parent, before, now):
         """
+        Finds differences between two elements of some `bs4` classes. Takes the same things and returns the same
+        tuples as `find_differences_recursive` (see there), but:
+        -- it traverses the trees with an explicit stack, so deeply nested documents don't hit the recursion limit,
+        -- it first computes Merkle-style hashes of all subtrees (see `subtree_hashes`) and skips every pair
+           of subtrees with equal hashes in O(1), so only the paths leading to the actual changes are walked,
+        -- it doesn't allocate padded lists of children nor merge sets of differences at every level,
+        -- it returns the tuples in a list, not in a set: every pair of elements is visited once, so there are
+           no duplicates, and hashing a `bs4` element (needed to put it in a set) serializes its whole subtree,
+           which for changes in wide elements (with the parents in the tuples) costs more than the diffing itself,
+        -- with the 'lcs' `alignment` children are aligned (see `align_children`) instead of paired by positions,
+           so the output differs from `find_differences_recursive`'s where elements were inserted or removed.
+        """
+        before_hashes = self.hashes_of(before)
+        now_hashes = self.hashes_of(now)
+
+        differences = []
+        stack = [(before_parent, now_parent, before, now)]
+        while stack:
+            before_parent, now_parent, before, now = stack.pop()
+            if before is not None and now is not None and before_hashes[id(before)] == now_hashes[id(now)]:
+                continue  # identical subtrees
+
+            # below is the same sequence of checks as in `find_differences_recursive`
+            parents = (before_parent, now_parent)
+            where = (now.sourceline, now.sourcepos) if hasattr(now, 'sourceline') else (None, None)
+            elems = (before, now)
+
+            if before and not now:
+                differences.append((where, parents, 'element removed', elems))
+            elif not before and now:
+                differences.append((where, parents, 'element added', elems))
+            elif type(before) != type(now):
+                differences.append((where, parents, 'element type', elems))
+            elif issubclass(type(before), (bs4.element.NavigableString, )):
+                if before != now:
+                    differences.append((where, parents, 'text', elems))
+            elif issubclass(type(before), (bs4.BeautifulSoup, bs4.element.Tag)):
+                what = []  # list of what has changed here
+                if before.name != now.name:
+                    what.append('type')
+                if before.attrs != now.attrs:
+                    what.append('attributes')
+                if what:
+                    differences.append((where, parents, 'tag ' + ', '.join(what), elems))
+
+                for c1, c2 in self.pair_children(before, now, before_hashes, now_hashes):
+                    stack.append((before, now, c1, c2))
+
+        return differences
+
+    def pair_children(self, before, now, before_hashes, now_hashes):
+        """
+        Returns the pairs of children of `before` and `now` to be compared with each other,
+        according to the monitor's `alignment` (None stands for a missing counterpart).
+        """
+        if self.alignment == 'positional':
+            # the shorter list of children is padded with Nones
+            return itertools.zip_longest(before.contents, now.contents)
+
+        before_contents, now_contents = before.contents, now.contents
+        pairs = align_children(
+            [child_key(child) for child in before_contents], [child_key(child) for child in now_contents],
+            [before_hashes[id(child)] for child in before_contents], [now_hashes[id(child)] for child in now_contents],
+            self.max_alignment_cells
+        )
+        return [(before_contents[i] if i is not None else None, now_contents[j] if j is not None else None) for i, j in pairs]
+
+    def hashes_of(self, root):
+        """
+        Returns the subtree hashes of the given tree, computing them only if they are not cached yet.
+        """
+        if root is None:
+            return {}
+        cached = self.tree_hashes.get(id(root))
+        if cached is None or cached[0] is not root:
+            cached = (root, subtree_hashes(root))
+            self.tree_hashes[id(root)] = cached
+        return cached[1]
+
+    def forget_hashes(self, keep):
+        """
+        Drops the cached subtree hashes of all trees but the ones in `keep` (so that the old trees can be freed).
+        """
+        kept = {id(root) for root in keep}
+        self.tree_hashes = {key: value for key, value in self.tree_hashes.items() if key in kept}
+
+    def forget_tree(self, root):
+        """
+        Drops the cached subtree hashes of the given tree only (when it's replaced or released, see `watch_scheduled`).
+        """
+        cached = self.tree_hashes.get(id(root))
+        if cached is not None and cached[0] is root:
+            del self.tree_hashes[id(root)]
+
+    def find_differences_recursive(self, before_parent, now_parent, before, now):
+        """
+        The original, recursive version of `find_differences`, kept for reference and for `benchmark.py engine`.
+
         This function finds differences between two elements of some `bs4` classes. It aims to find differences
         between the past and the current version of some HTML-based website (with help of the `bs4` module).
         It traverses the parsed HMTL trees in parallel, looking for differences in corresponding nodes.
@@ -89,7 +1488,7 @@ class Monitor:
                 differences.add((where, parents, 'tag ' + ', '.join(what), elems))
 
             for c1, c2 in zip(before_contents, now_contents):
-                differences.update(self.find_differences(before, now, c1, c2))
+                differences.update(self.find_differences_recursive(before, now, c1, c2))
 
             return differences
 
@@ -146,123 +1545,1189 @@ class Monitor:
             print("===================================================")
             print()
 
-    def monitor_changes(self, interval):
+    def digest(self, text):
+        """
+        Returns a digest of the given HTML text after the normalization configured for this monitor.
+        """
+        return digest_text(text, self.ignored_attributes, self.normalize_whitespace)
+
+    def parse(self, text, previous_digest, page=None, digest=None):
+        """
+        Parses the downloaded HTML text, unless its digest is equal to `previous_digest`.
+        `digest` is the digest of the text if it is already known (computed during the download).
+        If the page has a scope (see `extract_scope`), then all of that applies to the HTML of the selected regions,
+        and `digest` (if given) is the digest of the whole text, remembered for the next download (see `finish_download`).
+        If the monitor uses processes, then parsing is done in the process pool (and this thread waits for it).
+        Returns a triple: the parsed page (or `UNCHANGED`, or `HASHED`), the digest of the text and the compressed text
+        if the monitor keeps it (see `FetchResult`). Runs in a worker thread, so that compression doesn't hold up
+        the main one. The time of every step is observed as a stage of `self.metrics`.
+        """
+        if self.parser == 'auto':
+            with self.parser_lock:
+                if self.parser == 'auto':
+                    self.parser = choose_parser([text])
+        if page in self.scopes:
+            if digest is not None:
+                self.raw_digests[page] = digest
+            digest = None  # the digest of the selected regions is computed below
+            with self.metrics.timed('scope', page):
+                if self.processes > 0:
+                    text = self.get_process_executor().submit(extract_scope, text, self.scopes[page], self.parser).result()
+                else:
+                    text = extract_scope(text, self.scopes[page], self.parser)
+
+        # the same steps as in `parse_page`, but timed separately
+        if digest is None:
+            with self.metrics.timed('hash', page):
+                digest = self.digest(text)
+        if digest == previous_digest:
+            soup = UNCHANGED
+        elif self.parser == HASH_ONLY:
+            soup = HASHED
+        else:
+            with self.metrics.timed('parse', page):
+                if self.processes > 0:
+                    # only the pages which have to be parsed are sent to the process
+                    soup = self.get_process_executor().submit(build_tree, text, self.parser, compact=True).result()
+                else:
+                    soup = build_tree(text, self.parser)
+
+        html = None
+        if soup is not UNCHANGED and (self.store is not None or (self.low_memory and self.parser != HASH_ONLY)):
+            with self.metrics.timed('compress', page):
+                html = compress_html(text)
+        return soup, digest, html
+
+    def get_process_executor(self):
+        """
+        Returns the process pool used for parsing and diff finding, creating it on first use.
+        """
+        if self.process_executor is None:
+            self.process_executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+        return self.process_executor
+
+    def compare(self, before, now):
+        """
+        Compares two versions of a page kept as `bs4` trees, the previous one can also be given compressed
+        (then it is parsed here first). Returns a triple: the output of `find_differences` turned into `Change`s
+        (see `describe_changes`), whether the trees are different according to `bs4`'s built-in comparison
+        and how many seconds it took.
+        """
+        if now is HASHED:
+            # the 'hash-only' backend builds no trees, all that is known is that the digest has changed
+            return [], True, 0.0
+        t0 = time.perf_counter()
+        restored = isinstance(before, bytes)
+        if restored:
+            before = restore_tree(before, self.parser)
+        changes = describe_changes(self.find_differences(None, None, before, now))
+        changed = before != now
+        if restored:
+            self.forget_tree(before)  # parsed just for this comparison, so its hashes won't be needed again
+        return changes, changed, time.perf_counter() - t0
+
+    def submit_differences(self, thread_executor, before, now):
+        """
+        Schedules comparing two versions of a page (see `compare`), in the process pool if the monitor
+        uses processes (the versions are `CompactTree`s then) or in the given thread pool otherwise.
+        """
+        if self.processes > 0 and now is not HASHED:
+            return self.get_process_executor().submit(
+                compare_compact, before, now, self.parser, self.alignment, self.max_alignment_cells
+            )
+        return thread_executor.submit(self.compare, before, now)
+
+    def restore_snapshots(self, soups, pages=None):
+        """
+        Puts the pages (all the monitored ones, or just `pages` if given) found in the snapshot store into `soups`
+        (as `STORED`) and restores their digests and validators, so the next cycle can diff against them.
+        Returns the set of restored pages.
+        """
+        if self.store is None:
+            return set()
+        metadata = self.store.metadata(self.pages if pages is None else pages)
+        for page, (digest, validators) in metadata.items():
+            self.digests[page] = digest
+            self.validators[page] = validators
+            soups[page] = STORED
+        return set(metadata)
+
+    def set_pages(self, pages):
+        """
+        Makes `watch_changes` monitor the given pages instead of the current ones from its next cycle on,
+        without starting over: the pages which are monitored already keep their versions. Can be called
+        from another thread (e.g. the one following the shard of a worker, see `run_shard`).
+        """
+        with self.pages_lock:
+            self.next_pages = list(pages)
+
+    def replace_pages(self, executor, soups):
+        """
+        Replaces the monitored pages with the ones given to `set_pages` (if there are any): forgets the removed ones
+        and gets the first versions of the added ones (from the snapshot store, or by downloading them), just like
+        `watch_changes` does at the start. Returns a `PagesReassigned` event, or None if the pages haven't been replaced.
+        """
+        with self.pages_lock:
+            pages, self.next_pages = self.next_pages, None
+        if pages is None:
+            return None
+        current, kept = set(self.pages), set(pages)
+        removed = [page for page in self.pages if page not in kept]
+        added = [page for page in pages if page not in current]
+        for page in removed:
+            soups.pop(page, None)
+            for known in (self.validators, self.digests, self.raw_digests, self.snapshots):
+                known.pop(page, None)
+        self.pages = pages
+
+        restored = self.restore_snapshots(soups, added)
+        for page in self.update_soups(executor, soups, pages=[page for page in added if page not in restored]):
+            continue
+        self.release_trees(soups)
+        return PagesReassigned(time.time(), len(pages), len(added), len(removed), len(restored))
+
+    def release_trees(self, soups):
+        """
+        If the monitor uses the snapshot store, then replaces the parsed trees in `soups` with `STORED`,
+        so that they can be freed (they are already in the store). In the low-memory mode replaces them
+        with their compressed HTML (see `compress_html`) instead.
+        """
+        if self.store is None and not self.low_memory:
+            return
+        for page, soup in soups.items():
+            if soup is None or soup is STORED or soup is HASHED or isinstance(soup, bytes):
+                continue
+            soups[page] = STORED if self.store is not None else self.snapshots.pop(page)
+
+    def streamed_body(self, page, encoding, headers, started):
+        """
+        Returns a `StreamedBody` for the response to a request for the given page, hashed if the page has a scope
+        or its digest needs no normalization (see `digest`), which must be downloaded within `download_timeout`
+        seconds from `started` (a `time.monotonic()` time). Raises `ValueError` right away
+        if the `Content-Length` in the `headers` exceeds `max_bytes`.
+        """
+        body = StreamedBody(
+            page, encoding, self.max_bytes,
+            hashed=page in self.scopes or self.ignored_attributes is None and not self.normalize_whitespace,
+            deadline=started + self.download_timeout if self.download_timeout is not None else None
+        )
+        if headers.get('Content-Length', '').isdigit():
+            body.check_size(int(headers['Content-Length']))
+        return body
+
+    def finish_download(self, page, body, previous_digest, seconds):
+        """
+        Finishes a streamed download of the given page: records it in the metrics and returns the text
+        (or `UNCHANGED`, see `download`) and the digest. For a page with a scope that is the digest of the whole text,
+        and the page is `UNCHANGED` if it is the same as the last time (then the digest of its regions is returned),
+        so only a page whose bytes have changed is scoped and its regions compared by their digest (see `parse`).
+        """
+        digest = body.finish()
+        self.metrics.observe('download', seconds, page)
+        self.metrics.count('bytes_fetched', body.size)
+        if page in self.scopes:
+            if digest is not None and previous_digest is not None and digest == self.raw_digests.get(page):
+                return UNCHANGED, previous_digest
+            return body.text(), digest
+        if digest is not None and digest == previous_digest:
+            return UNCHANGED, digest
+        return body.text(), digest
+
+    def download(self, page, validators, previous_digest=None):
+        """
+        Downloads the given page. Used by the 'threads' fetch mode, runs in a worker thread.
+        `validators` are the headers making the request conditional (can be empty).
+        The body is streamed (see `streamed_body`), within the monitor's timeouts and size limit; the time limit
+        of the whole download is checked whenever some bytes arrive, so it may be overrun by up to `read_timeout`.
+        Returns a triple: the text of the page (None if the server answered 304 Not Modified, `UNCHANGED`
+        if it was hashed during the download and its digest is equal to `previous_digest`),
+        the validators for the next request and the digest of the text (None if it wasn't hashed,
+        see `finish_download` for pages with a scope).
+        """
+        started = time.monotonic()
+        with requests.get(page, headers=validators, stream=True,
+                          timeout=(self.connect_timeout, self.read_timeout)) as response:
+            # `elapsed` is the time until the headers were parsed, the body is downloaded after that
+            self.metrics.observe('response', response.elapsed.total_seconds(), page)
+            t1 = time.perf_counter()
+            if response.status_code == 304:
+                return None, validators, None
+            # `requests` gives the text/* types without a charset ISO-8859-1, the other ones None (see `StreamedBody`)
+            body = self.streamed_body(page, response.encoding, response.headers, started)
+            # the chunks are decompressed, so `max_bytes` limits also what a small compressed body expands to
+            for chunk in response_chunks(response, CHUNK_SIZE):
+                body.feed(chunk)
+            text, digest = self.finish_download(page, body, previous_digest, time.perf_counter() - t1)
+            return text, validators_of(response.headers), digest
+
+    async def download_async(self, page, validators, previous_digest=None):
+        """
+        Downloads the given page. Used by the 'asyncio' fetch mode, runs in the monitor's event loop.
+        Takes and returns the same things as `download` (the timeouts are set on the session, see `start_event_loop`).
+        """
+        started = time.monotonic()
+        t0 = time.perf_counter()
+        # the page is passed to the tracing callbacks (see `start_event_loop`)
+        async with self.http_session.get(page, headers=validators, trace_request_ctx={'page': page}) as response:
+            t1 = time.perf_counter()
+            self.metrics.observe('response', t1 - t0, page)
+            if response.status == 304:
+                return None, validators, None
+            # without a charset `response.text()` (with the default session) decodes the body as UTF-8
+            body = self.streamed_body(page, response.charset or 'utf-8', response.headers, started)
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                body.feed(chunk)
+            text, digest = self.finish_download(page, body, previous_digest, time.perf_counter() - t1)
+            return text, validators_of(response.headers), digest
+
+    def fetch_soup(self, page, validators, previous_digest):
+        """
+        Downloads and parses the given page. Used by the 'threads' fetch mode, runs in a worker thread.
+        `validators` are the headers making the request conditional (can be empty).
+        `previous_digest` is the digest of the previous version of the page (or None).
+        Returns a `FetchResult`.
+        """
+        text, validators, digest = self.download(page, validators, previous_digest)
+        if text is None:
+            return FetchResult(NOT_MODIFIED, validators, previous_digest, None)
+        if text is UNCHANGED:
+            return FetchResult(UNCHANGED, validators, digest, None)
+        soup, digest, html = self.parse(text, previous_digest, page, digest)
+        return FetchResult(soup, validators, digest, html)
+
+    async def fetch_soup_async(self, page, validators, previous_digest):
+        """
+        Downloads and parses the given page. Used by the 'asyncio' fetch mode, runs in the monitor's event loop.
+        Takes and returns the same things as `fetch_soup`.
+        """
+        text, validators, digest = await self.download_async(page, validators, previous_digest)
+        if text is None:
+            return FetchResult(NOT_MODIFIED, validators, previous_digest, None)
+        if text is UNCHANGED:
+            return FetchResult(UNCHANGED, validators, digest, None)
+        # hashing and parsing are CPU-bound, so they are moved off the event loop to let the other downloads progress meanwhile
+        soup, digest, html = await self.loop.run_in_executor(None, self.parse, text, previous_digest, page, digest)
+        return FetchResult(soup, validators, digest, html)
+
+    def start_event_loop(self):
+        """
+        Starts the event loop of the 'asyncio' fetch mode in a separate thread together with the HTTP session
+        whose connection pool is shared by all the downloads. Does nothing if it is already running.
+        """
+        if self.loop is not None:
+            return
+
+        def traced(stage):
+            # a pair of callbacks observing the time between the start and the end of the stage of a request
+            async def on_start(session, context, params):
+                setattr(context, stage, time.perf_counter())
+
+            async def on_end(session, context, params):
+                page = (context.trace_request_ctx or {}).get('page')
+                self.metrics.observe(stage, time.perf_counter() - getattr(context, stage), page)
+            return on_start, on_end
+
+        tracing = aiohttp.TraceConfig()
+        on_start, on_end = traced('dns')
+        tracing.on_dns_resolvehost_start.append(on_start)
+        tracing.on_dns_resolvehost_end.append(on_end)
+        on_start, on_end = traced('connect')
+        tracing.on_connection_create_start.append(on_start)
+        tracing.on_connection_create_end.append(on_end)
+
+        async def open_session():
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host)
+            # `total` is the time limit of the whole download, including the wait for a free connection
+            timeout = aiohttp.ClientTimeout(
+                total=self.download_timeout, sock_connect=self.connect_timeout, sock_read=self.read_timeout
+            )
+            return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[tracing])
+
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.http_session = asyncio.run_coroutine_threadsafe(open_session(), self.loop).result()
+
+    def close(self):
+        """
+        Closes the HTTP session and stops the event loop of the 'asyncio' fetch mode (if they were started)
+        and shuts the process pool down (if it was started) and closes the snapshot store (if there is one).
+        """
+        self.metrics.close()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if self.process_executor is not None:
+            self.process_executor.shutdown()
+            self.process_executor = None
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.http_session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.loop = None
+        self.loop_thread = None
+        self.http_session = None
+
+    def submit_fetch(self, executor, page, validators, previous_digest):
+        """
+        Schedules the download of the given page according to the fetch mode.
+        In both modes the result is a `concurrent.futures.Future`, so the callers don't have to care about the mode.
+        """
+        if self.fetch_mode == 'asyncio':
+            self.start_event_loop()
+            return asyncio.run_coroutine_threadsafe(self.fetch_soup_async(page, validators, previous_digest), self.loop)
+        return executor.submit(self.fetch_soup, page, validators, previous_digest)
+
+    def submit_page(self, executor, page, previous):
+        """
+        Schedules the download of the given page, conditional on its previous version (if there is one in `previous`).
+        """
+        # comparing against the previous version makes sense only if there is a previous version to fall back on
+        if previous is None or previous.get(page) is None:
+            return self.submit_fetch(executor, page, {}, None)
+        return self.submit_fetch(executor, page, self.validators.get(page, {}), self.digests.get(page))
+
+    def record_fetch(self, page, f, previous):
+        """
+        Handles the finished download `f` of the given page: updates the page's validators and digest
+        (and the snapshot store, if the monitor has one).
+        `previous` is the dict of the pages' previous versions (or None).
+        Returns a pair: the new version of the page (None if it is unavailable) and what happened, one of:
+        'fetched', 'not modified' (304), 'unchanged' (same digest) or 'error'.
+        """
+        self.progressed_at = time.monotonic()
+        try:
+            # this will re-raise an exception if it occured while executing the funciton in a separate thread
+            soup, self.validators[page], self.digests[page], html = f.result()
+            if html is not None and self.store is None:
+                self.snapshots[page] = html
+            if self.store is not None:
+                if html is not None:
+                    if previous is not None and previous.get(page) is STORED:
+                        # the previous version is about to be overwritten in the store, but it is still needed
+                        # for the diff (it gets parsed again in the thread or process doing the diff)
+                        previous[page] = self.store.load(page)
+                    self.store.save(page, html, self.digests[page], self.validators[page])
+                else:
+                    self.store.touch(page, self.validators[page])
+        except:
+            # if there was an error while downloading the site, then the site's value is None
+            # it will be handled later on
+            self.validators.pop(page, None)
+            self.digests.pop(page, None)
+            self.raw_digests.pop(page, None)
+            self.snapshots.pop(page, None)
+            self.metrics.count('fetch_errors')
+            return None, 'error'
+        if soup is NOT_MODIFIED:
+            self.metrics.count('not_modified')
+            return previous[page], 'not modified'
+        if soup is UNCHANGED:
+            self.metrics.count('unchanged')
+            return previous[page], 'unchanged'
+        self.metrics.count('fetched')
+        return soup, 'fetched'
+
+    def observe_differences(self, page, changes, seconds):
+        """
+        Records in the metrics a finished comparison of two versions of the page (see `compare`).
+        """
+        self.progressed_at = time.monotonic()
+        self.metrics.observe('diff', seconds, page)
+        self.metrics.count('diffs')
+        self.metrics.count('changes_found', len(changes))
+
+    def serve_metrics(self):
+        """
+        Starts serving the metrics at `metrics_port`, if it was given (until the monitor is closed).
+        """
+        if self.metrics_port is not None and self.metrics.server is None:
+            self.metrics.serve(self.metrics_port)
+
+    def dump_metrics(self, force=False):
+        """
+        Dumps the metrics to `metrics_file`, if it was given, at most once per `METRICS_DUMP_INTERVAL` seconds
+        (unless `force` is true).
+        """
+        if self.metrics_file is None or not force and time.monotonic() - self.metrics_dumped_at < METRICS_DUMP_INTERVAL:
+            return
+        self.metrics.dump(self.metrics_file)
+        self.metrics_dumped_at = time.monotonic()
+
+    def update_soups(self, executor, soups, previous=None, pages=None):
+        """
+        Downloads the monitored pages (all of them, or just `pages` if given) and stores their parsed versions in `soups`
+        (and in the snapshot store, if the monitor has one).
+        This is a generator which yields every page as soon as it has been stored.
+        `executor` is used by the 'threads' fetch mode only.
+        `previous` is the dict of the pages' parsed versions from the previous cycle. If given, the requests are
+        conditional and the pages answered with 304 Not Modified (listed in `self.not_modified` afterwards)
+        or having the same digest as before (listed in `self.unchanged`) get their previous versions stored in `soups`.
+        """
+        # modifies `soups`, but is the only thread to do so
+        self.not_modified = set()
+        self.unchanged = set()
+
+        # dict of Futures and corresponding pages
+        f_to_page = {self.submit_page(executor, page, previous): page for page in (self.pages if pages is None else pages)}
+        for f in concurrent.futures.as_completed(f_to_page):  # a queue of completed thread tasks
+            page = f_to_page[f]
+            soup, status = self.record_fetch(page, f, previous)
+            if status == 'not modified':
+                self.not_modified.add(page)
+            elif status == 'unchanged':
+                self.unchanged.add(page)
+            # no need for any locks, because this is the main thread
+            # no other thread is able to modify any object that belongs to the main thread
+            soups[page] = soup
+            yield page
+
+        if self.store is not None:
+            self.store.commit()
+
+    def monitor_changes(self, interval, sinks=(print_event, )):
         """
         Monitors content changes in the given websites periodically in given time interval.
 
         Input:
         `interval` -- time interval in seconds after which the check for changes should take place
+        `sinks` -- callables to which every event (see `watch_changes`) is passed, e.g. `print_event` (the default),
+                   a `JsonLinesSink` or any function
 
         Output:
-        Returns None. Prints info about changes to the console.
-        If there occurs an error while connecting to the website to be monitored,
-        the monitoring is stopped with an adequate message.
+        Returns None. By default prints info about changes to the console.
         """
+        self.dispatch(self.watch_changes(interval), sinks)
 
-        def fetch_soup(page):
-            return BeautifulSoup(requests.get(page).text, self.parser)
-
-        def update_soups(executor, soups):
-            # modifies `soups`, but is the only thread to do so
+    def dispatch(self, events, sinks):
+        """
+        Passes every event from the given generator to all the `sinks`, until the generator ends (or an exception,
+        e.g. a `KeyboardInterrupt`, stops it, then the generator is closed, so that the monitor gets closed too).
+        """
+        try:
+            for event in events:
+                for sink in sinks:
+                    sink(event)
+        finally:
+            events.close()
 
-            # dict of Futures and corresponding pages
-            f_to_page = {executor.submit(fetch_soup, page): page for page in self.pages}
-            for f in concurrent.futures.as_completed(f_to_page):  # a queue of completed thread tasks
-                try:
-                    # this will re-raise an exception if it occured while executing the funciton in a separate thread
-                    soup = f.result()
-                except:
-                    # if there was an error while downloading the site, then the site's value is None
-                    # it will be handled later on
-                    soup = None  
-                page = f_to_page[f]
-                # no need for any locks, because this is the main thread
-                # no other thread is able to modify any object that belongs to the main thread
-                soups[page] = soup
-                yield page
+    def watch_changes(self, interval):
+        """
+        Monitors content changes in the given websites periodically in given time interval.
+        This is a generator which yields the events (`MonitorStarted`, `CycleStarted`, `PageChanged`, `PageSkipped`,
+        `PageUnavailable`, `PageAvailable` and `CycleFinished`) as soon as they happen, so the changes can be
+        processed incrementally. The events consist of plain values only, they don't keep any parsed trees alive.
 
+        Input:
+        `interval` -- time interval in seconds after which the check for changes should take place
+        """
 
         soups = {}
         new_soups = {}
-        with concurrent.futures.ThreadPoolExecutor() as thread_executor:  #, concurrent.futures.ProcessPoolExecutor() as process_executor:
+        # tracing has to start before the initial data is fetched, otherwise the memory kept between cycles isn't counted
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        self.serve_metrics()
+        try:
+            with concurrent.futures.ThreadPoolExecutor() as thread_executor:  #, concurrent.futures.ProcessPoolExecutor() as process_executor:
+                # initialization
+                restored = self.restore_snapshots(soups)
+                if len(restored) < len(self.pages):
+                    for page in self.update_soups(thread_executor, soups, pages=[page for page in self.pages if page not in restored]):
+                        continue
+                    self.release_trees(soups)
+                    if self.low_memory:
+                        gc.collect()  # see below
+                yield MonitorStarted(time.time(), len(self.pages), len(restored))
+
+                # monitoring
+                while time.sleep(interval) or True:
+                    t0 = time.perf_counter()
+                    if self.trace_memory:
+                        tracemalloc.reset_peak()
+                    fp_to_page = {}  # dict of Futures and corresponding pages (used only if submitting diff finding to separate threads)
+
+                    reassigned = self.replace_pages(thread_executor, soups)
+                    if reassigned is not None:
+                        yield reassigned
+                    yield CycleStarted(time.time())
+                    for page in self.update_soups(thread_executor, new_soups, soups):
+                        if page in self.not_modified or page in self.unchanged:
+                            # either the server confirmed that the page is the same as before or its digest is the same,
+                            # so there is nothing to diff (neither with `find_differences` nor with `bs4`'s comparison)
+                            yield PageSkipped(time.time(), page, 'not modified' if page in self.not_modified else 'unchanged')
+                            continue
+                        if new_soups[page] is None:
+                            yield PageUnavailable(time.time(), page)
+                        elif soups[page] is None:
+                            yield PageAvailable(time.time(), page)
+                        else:
+                            before = soups[page]
+                            now = new_soups[page]
+
+                            # # the below using processes doesn't work due to the pickling mechanism
+                            # # https://www.py4u.net/discuss/225589
+                            # # seems like `bs4` objects are unpickleable in some situations (when they are large)
+                            # # the below worked fine when tested with `html_doc1` and `html_doc2` which are defined near the bottom of this file
+                            # fp = process_executor.submit(self.find_differences, None, None, before, now)
+                            # fp_to_page[fp] = page
+                            # # that's why with `processes` set the pages are kept as `CompactTree`s, which pickle fine
+
+                            # measurements tell that using threads for those computations is at best
+                            # not better than running everything in the main thread one after the other:
+                            # about 1.5s of work for multi- and singlethreaded computations.
+                            # it is because there exists a Global Interpreter Lock, which effectively
+                            # means that only a single thread can run Python code within a Python process.
+                            # this means that using threads is productive really only when dealing with I/O-bound problems.
+                            # using multiple threads when optimizing the CPU-bound problems can even be counter productive
+                            # because of the context switching.
+                            # the nature of diff finding is computational, so it doesn't make sense to put it into
+                            # separate threads, since only one can be running at a time anyway.
+                            # it would be useful if processes worked for diff finding for `bs4` objets, because then CPU cores
+                            # would actually run computations in parallel, but it's not viable since `bs4` objects
+                            # are unpickleable in real-world situations (when they contain actual parsed websites),
+                            # and apparently processes demand pickling of arguments
+                            fp = self.submit_differences(thread_executor, before, now)
+                            fp_to_page[fp] = page
+
+                            # # single-threaded computations:
+                            # diff = self.find_differences(None, None, before, now)
+                            # # self.print_changes(diff)
+                            # # instead of the above line, for readability:
+                            # print(page)
+                            # print("Changed:", soups[page] != new_soups[page])  # `bs4`'s built-in comparison
+                            # print(len(diff))  # number of changes found by my code
+                            # print()
+
+                    # when running computations in separate threads/processes this reports the results
+                    # (`print_changes` prints the details of such changes, `print_event` only their number, for readability)
+                    for fp in concurrent.futures.as_completed(fp_to_page):
+                        changes, changed, seconds = fp.result()
+                        self.observe_differences(fp_to_page[fp], changes, seconds)
+                        yield PageChanged(time.time(), fp_to_page[fp], changed, changes)
+
+                    # with the snapshot store only the pages being diffed are kept as parsed trees
+                    self.release_trees(new_soups)
+
+                    # swapping references to objects:
+                    # new_soups become current soups
+                    # current soups objects will serve as a container for the new incoming soups
+                    aux = soups
+                    soups = new_soups
+                    new_soups = aux
+                    # the previous versions are not needed anymore, so they're freed now instead of
+                    # when they get overwritten in the next cycle (otherwise two versions of every page are kept)
+                    new_soups.clear()
+                    self.forget_hashes(soups.values())
+                    if self.low_memory:
+                        # `bs4` trees are full of reference cycles (parents <-> children), so they're freed only by
+                        # the garbage collector, which otherwise runs rarely when there are lots of objects
+                        gc.collect()
+
+                    retained_memory, peak_memory = tracemalloc.get_traced_memory() if self.trace_memory else (None, None)
+                    self.metrics.count('cycles')
+                    self.metrics.observe('cycle', time.perf_counter() - t0)
+                    self.dump_metrics(force=True)
+                    yield CycleFinished(
+                        time.time(), time.perf_counter() - t0, len(self.pages), len(self.not_modified), len(self.unchanged),
+                        peak_memory, retained_memory
+                    )
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            # releases the pooled connections of the 'asyncio' fetch mode
+            self.close()
+
+    def monitor_scheduled(self, min_interval, max_interval, concurrency=None, sinks=(print_event, )):
+        """
+        Monitors content changes in the given websites, checking every page on its own schedule
+        (see `watch_scheduled`, which takes the same arguments). Every event is passed to all the `sinks`,
+        just like in `monitor_changes`.
+        """
+        self.dispatch(self.watch_scheduled(min_interval, max_interval, concurrency), sinks)
+
+    def watch_scheduled(self, min_interval, max_interval, concurrency=None):
+        """
+        Monitors content changes in the given websites, checking every page on its own schedule
+        instead of all of them every `interval` seconds like `monitor_changes` does.
+
+        Input:
+        `min_interval`, `max_interval` -- bounds (in seconds) of the time between two checks of a page
+        `concurrency` -- how many downloads can run at once (by default `max_connections`)
+
+        Every page has its own interval which adapts to how often the page changes: it is halved after
+        a change has been found and grows by half after a check which found nothing new, so frequently changing
+        pages are checked often and static ones rarely. After an error the page backs off exponentially
+        (`min_interval` doubled with every consecutive failure, up to `max_interval`), without changing the interval
+        it has learned, to which it returns once it's available again. The pages are kept in a priority queue ordered
+        by the time of their next check, and every page is handled as soon as its download finishes,
+        so a slow page delays only itself.
+
+        This is a generator of events, just like `watch_changes`, except that there are no cycles, so instead of
+        `CycleStarted` and `CycleFinished` it yields `PageScheduled` after every check of a page.
+        """
+        if concurrency is None:
+            concurrency = self.max_connections
+
+        versions = {}  # the latest version of every page, just like `soups` in `monitor_changes`
+        intervals = {page: min_interval for page in self.pages}
+        failures = {page: 0 for page in self.pages}  # numbers of consecutive failed checks
+        # the backoff stops growing at `max_interval`, so the numbers of failures stop growing there too
+        # (otherwise a page which is down for good would make `2 ** failures` too large for a float)
+        max_failures = math.ceil(math.log2(max_interval / min_interval)) if 0 < min_interval < max_interval else 0
+        queue = [(time.monotonic(), page) for page in self.pages]  # a heap of (time of the next check, page)
+        fetches = {}  # Futures of the running downloads and corresponding pages
+        diffs = {}  # Futures of the running comparisons and corresponding pairs: (page, its previous version)
+        diffing = set()  # pages being compared, their versions are needed as they are
+
+        def reschedule(page, interval):
+            intervals[page] = max(min_interval, min(max_interval, interval))
+            return schedule(page, intervals[page])
+
+        def back_off(page):
+            # the delay after a failure is separate from the page's interval, which is kept for when it recovers
+            return schedule(page, min(max_interval, min_interval * 2 ** failures[page]))
+
+        def schedule(page, delay):
+            heapq.heappush(queue, (time.monotonic() + delay, page))
+            return PageScheduled(time.time(), page, delay)
+
+        def release(page):
+            # with the snapshot store (or in the low-memory mode) only the pages being diffed are kept as parsed trees;
+            # only the page which has just been handled is released, so an iteration doesn't cost as much as there are pages
+            if page in diffing:
+                return
+            version = {page: versions.get(page)}
+            self.release_trees(version)
+            if version[page] is not versions.get(page):
+                self.forget_tree(versions[page])
+                versions[page] = version[page]
+
+        self.serve_metrics()
+        try:
+            with concurrent.futures.ThreadPoolExecutor() as thread_executor:
+                restored = self.restore_snapshots(versions)
+                yield MonitorStarted(time.time(), len(self.pages), len(restored))
+
+                while True:
+                    # starting the checks which are due, as long as the concurrency budget allows
+                    while queue and queue[0][0] <= time.monotonic() and len(fetches) < concurrency:
+                        _, page = heapq.heappop(queue)
+                        fetches[self.submit_page(thread_executor, page, versions)] = page
+
+                    # waiting until something finishes, or until the next check is due (if it can be started then)
+                    timeout = max(0, queue[0][0] - time.monotonic()) if queue and len(fetches) < concurrency else None
+                    done, _ = concurrent.futures.wait(
+                        list(fetches) + list(diffs), timeout, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+
+                    for f in done:
+                        if f in diffs:
+                            page, before = diffs.pop(f)
+                            diffing.discard(page)
+                            changes, changed, seconds = f.result()
+                            self.observe_differences(page, changes, seconds)
+                            self.forget_tree(before)  # the previous version isn't needed anymore
+                            release(page)
+                            yield PageChanged(time.time(), page, changed, changes)
+                            yield reschedule(page, intervals[page] / 2 if changed else intervals[page] * 1.5)
+                            continue
+
+                        page = fetches.pop(f)
+                        version, status = self.record_fetch(page, f, versions)
+                        before = versions.get(page)  # read after `record_fetch`, which may load it from the store
+                        versions[page] = version
+                        if status == 'error':
+                            self.forget_tree(before)
+                            failures[page] = min(failures[page] + 1, max_failures + 1)
+                            yield PageUnavailable(time.time(), page)
+                            yield back_off(page)
+                            continue
+
+                        previously_unavailable = failures[page] > 0
+                        failures[page] = 0
+                        if status != 'fetched':
+                            # 304 Not Modified or the same digest, nothing to diff
+                            yield PageSkipped(time.time(), page, status)
+                            yield reschedule(page, intervals[page] * 1.5)
+                        elif before is None:
+                            # the first version of the page, there is nothing to compare it against
+                            if previously_unavailable:
+                                yield PageAvailable(time.time(), page)
+                            yield reschedule(page, intervals[page])
+                        else:
+                            # rescheduled once the comparison is done, as it decides about the interval
+                            diffs[self.submit_differences(thread_executor, before, version)] = (page, before)
+                            diffing.add(page)
+                            continue
+                        release(page)
+
+                    if self.store is not None:
+                        self.store.commit()
+                    self.dump_metrics()
+        finally:
+            self.close()
+
+    def monitor_pipelined(self, interval, queue_size=16, fetchers=32, sinks=(print_event, )):
+        """
+        Monitors content changes in the given websites periodically in given time interval, reporting every page
+        as soon as it's done (see `watch_pipelined`, which takes the same arguments). Every event is passed
+        to all the `sinks`, just like in `monitor_changes`.
+        """
+        self.dispatch(self.watch_pipelined(interval, queue_size, fetchers), sinks)
+
+    def watch_pipelined(self, interval, queue_size=16, fetchers=32):
+        """
+        Monitors content changes in the given websites periodically in given time interval, just like `watch_changes`
+        (and yields the same events), but the checks of the pages are pipelined: downloading, parsing, recording
+        (updating the validators, digests and the snapshot store), diffing and reporting are separate stages,
+        run by their own threads and joined by bounded queues. Every page goes through them on its own, so its
+        result is yielded as soon as it's ready, instead of after all the pages have been downloaded, and a slow
+        website delays only itself. When a stage falls behind (or the consumer of the events does), the queue
+        in front of it fills up and the stages before it wait, so no more than `queue_size` pages wait between
+        any two stages, however many of them arrive at once.
+
+        Input:
+        `interval` -- time interval in seconds after which the check for changes should take place
+        `queue_size` -- the capacity of every queue between the stages
+        `fetchers` -- the number of threads downloading the pages (at most that many downloads run at once)
+        """
+        versions = {}  # the latest version of every page, just like `soups` in `watch_changes`
+        checked = set()  # pages which have been checked at least once
+        to_fetch = queue.Queue()  # pages to be checked in the current cycle (they're all put there at once)
+        to_parse = queue.Queue(queue_size)  # (page, Future of `download`, digest of the previous version)
+        to_record = queue.Queue(queue_size)  # (page, Future of `FetchResult`)
+        to_diff = queue.Queue(queue_size)  # (page, previous version, new version)
+        to_report = queue.Queue(queue_size)  # (page, event or None), exactly one for every page in a cycle
+        stopping = threading.Event()
+
+        def put(destination, item):
+            # waits for a free place in the queue, unless the monitoring is being stopped
+            while not stopping.is_set():
+                try:
+                    destination.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def items(source):
+            # yields the items put into the queue, until the monitoring is stopped
+            while not stopping.is_set():
+                try:
+                    yield source.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+        def settled(function, *args):
+            # a finished Future of the call, so that the errors are handled by `record_fetch` just like in the other modes
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as error:
+                future.set_exception(error)
+            return future
+
+        def release(page):
+            # with the snapshot store or in the low-memory mode the trees are dropped as soon as they aren't needed
+            version = {page: versions[page]}
+            self.release_trees(version)
+            versions[page] = version[page]
+
+        def download(page, validators, previous_digest):
+            if self.fetch_mode == 'asyncio':
+                return asyncio.run_coroutine_threadsafe(
+                    self.download_async(page, validators, previous_digest), self.loop
+                ).result()
+            return self.download(page, validators, previous_digest)
+
+        def parse(page, downloaded, previous_digest):
+            text, validators, digest = downloaded.result()  # re-raises the error of the download, if there was one
+            if text is None:
+                return FetchResult(NOT_MODIFIED, validators, previous_digest, None)
+            if text is UNCHANGED:
+                return FetchResult(UNCHANGED, validators, digest, None)
+            soup, digest, html = self.parse(text, previous_digest, page, digest)
+            return FetchResult(soup, validators, digest, html)
+
+        def fetch_stage():
+            for page in items(to_fetch):
+                # the requests are conditional only if there is a previous version to fall back on (see `submit_page`)
+                previous = versions.get(page) is not None
+                validators = self.validators.get(page, {}) if previous else {}
+                previous_digest = self.digests.get(page) if previous else None
+                put(to_parse, (page, settled(download, page, validators, previous_digest), previous_digest))
+
+        def parse_stage():
+            for page, downloaded, previous_digest in items(to_parse):
+                put(to_record, (page, settled(parse, page, downloaded, previous_digest)))
+
+        def record_stage():
+            # the only stage changing `versions` (apart from releasing the trees after diffing) and using the store
+            for page, fetched in items(to_record):
+                version, status = self.record_fetch(page, fetched, versions)
+                before = versions.get(page)  # read after `record_fetch`, which may load it from the store
+                versions[page] = version
+                if status == 'error':
+                    put(to_report, (page, PageUnavailable(time.time(), page)))
+                elif status != 'fetched':
+                    put(to_report, (page, PageSkipped(time.time(), page, status)))
+                elif before is None:
+                    # the first version of the page, there is nothing to compare it against
+                    release(page)
+                    put(to_report, (page, PageAvailable(time.time(), page) if page in checked else None))
+                else:
+                    put(to_diff, (page, before, version))
+                checked.add(page)
+
+        def diff_stage():
+            for page, before, now in items(to_diff):
+                if self.processes > 0 and now is not HASHED:
+                    changes, changed, seconds = self.submit_differences(None, before, now).result()
+                else:
+                    changes, changed, seconds = self.compare(before, now)
+                self.observe_differences(page, changes, seconds)
+                release(page)
+                put(to_report, (page, PageChanged(time.time(), page, changed, changes)))
+
+        def run(stage):
+            # an error in any stage stops the monitoring, just like in `watch_changes`
+            try:
+                stage()
+            except BaseException as error:
+                put(to_report, (None, error))
+
+        def report():
+            page, event = to_report.get()
+            if isinstance(event, BaseException):
+                raise event
+            return event
+
+        workers = max(1, self.processes)  # parsing and diffing are CPU-bound, more threads than processes don't help
+        stages = [fetch_stage] * fetchers + [parse_stage] * workers + [record_stage] + [diff_stage] * workers
+        threads = [threading.Thread(target=run, args=(stage, ), daemon=True) for stage in stages]
+
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        self.serve_metrics()
+        if self.fetch_mode == 'asyncio':
+            self.start_event_loop()
+        try:
+            for thread in threads:
+                thread.start()
+
             # initialization
-            print("Fetching initial data...")
-            for page in update_soups(thread_executor, soups):
-                continue
-            print("Done. Waiting the given time interval...")
-            print()
+            restored = self.restore_snapshots(versions)
+            checked.update(restored)
+            initial = [page for page in self.pages if page not in restored]
+            for page in initial:
+                to_fetch.put(page)
+            for _ in initial:
+                report()
+            if self.store is not None:
+                self.store.commit()
+            yield MonitorStarted(time.time(), len(self.pages), len(restored))
 
             # monitoring
             while time.sleep(interval) or True:
                 t0 = time.perf_counter()
-                fp_to_page = {}  # dict of Futures and corresponding pages (used only if submitting diff finding to separate threads)
-
-                print("RESULTS:\n")
-                for page in update_soups(thread_executor, new_soups):
-                    if new_soups[page] is None:
-                        print(f"{page}\nPage unavailable.\n")
-                    elif soups[page] is None:
-                        print(f"{page}\nPage is now available (previously unavailable).\n")
+                if self.trace_memory:
+                    tracemalloc.reset_peak()
+                yield CycleStarted(time.time())
+
+                for page in self.pages:
+                    to_fetch.put(page)
+                not_modified = unchanged = 0
+                for _ in self.pages:
+                    event = report()
+                    if isinstance(event, PageSkipped):
+                        not_modified += event.reason == 'not modified'
+                        unchanged += event.reason == 'unchanged'
+                    if event is not None:
+                        yield event
+
+                # all the pages are done, so the stages are idle now
+                if self.store is not None:
+                    self.store.commit()
+                self.forget_hashes(versions.values())
+                if self.low_memory:
+                    gc.collect()  # see `watch_changes`
+
+                retained_memory, peak_memory = tracemalloc.get_traced_memory() if self.trace_memory else (None, None)
+                self.metrics.count('cycles')
+                self.metrics.observe('cycle', time.perf_counter() - t0)
+                self.dump_metrics(force=True)
+                yield CycleFinished(
+                    time.time(), time.perf_counter() - t0, len(self.pages), not_modified, unchanged, peak_memory, retained_memory
+                )
+        finally:
+            stopping.set()
+            # the downloads can take long to finish, but the other stages stop right away, and they have to,
+            # before the snapshot store gets closed
+            for thread in threads[fetchers:]:
+                thread.join()
+            if started_tracing:
+                tracemalloc.stop()
+            self.close()
+
+
+class HashRing:
+    """
+    Consistent hashing of the pages onto nodes (the shard workers, see `ShardCoordinator`): every node owns `replicas`
+    points on a ring of hashes, and every page belongs to the node owning the first point after the hash of the page.
+    When a node is removed, only its pages move (spread over the other nodes), and when one is added,
+    it takes over about its share of the pages from the others, the rest of them stay where they were.
+    """
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.points = []  # sorted pairs: (hash, node)
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            bisect.insort(self.points, (stable_hash(f'{node}#{i}'), node))
+
+    def remove(self, node):
+        self.points = [point for point in self.points if point[1] != node]
+
+    def nodes(self):
+        return sorted({node for _, node in self.points})
+
+    def node(self, page):
+        """
+        Returns the node owning the given page.
+        """
+        i = bisect.bisect(self.points, (stable_hash(page), ))
+        return self.points[i % len(self.points)][1]
+
+    def assign(self, pages):
+        """
+        Returns a dict mapping every node to the list of its pages (in the order of `pages`).
+        """
+        shards = {node: [] for node in self.nodes()}
+        for page in pages:
+            shards[self.node(page)].append(page)
+        return shards
+
+
+def run_shard(name, pages, connection, control, parser, interval, stall_timeout, options):
+    """
+    The body of a shard worker process (see `ShardCoordinator`): monitors the given pages with its own `Monitor`
+    and sends every event to the coordinator through `connection` as `(name, event)`,
+    and `(name, None)` as a heartbeat every `HEARTBEAT_INTERVAL` seconds, but only while the monitor
+    makes progress: if it finishes no download or comparison for `interval` + `stall_timeout` seconds
+    (e.g. because it hangs), then the heartbeat stops, so the coordinator notices a stuck worker, not only a dead one.
+    Whenever its shard changes, the coordinator sends the new list of its pages through `control`,
+    and the monitor switches to them in its next cycle (see `Monitor.set_pages`).
+    It is a module-level function, so it can be run in a separate process.
+    """
+    monitor = Monitor(pages, parser, **options)
+    lock = threading.Lock()  # the heartbeat and the events are sent from different threads
+
+    def send(event):
+        with lock:
+            connection.send((name, event))
+
+    def heartbeat():
+        while True:
+            if time.monotonic() - monitor.progressed_at <= interval + stall_timeout:
+                send(None)
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def follow_shard():
+        while True:
+            try:
+                monitor.set_pages(control.recv())
+            except EOFError:
+                return  # the coordinator is gone
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    threading.Thread(target=follow_shard, daemon=True).start()
+    for event in monitor.watch_changes(interval):
+        send(event)
+        # sending waits while the coordinator is busy, that time doesn't count as the monitor being stuck
+        monitor.progressed_at = time.monotonic()
+
+
+class ShardCoordinator:
+    """
+    Monitors the pages with `workers` local worker processes, each of them running its own `Monitor`
+    (created with `parser` and `monitor_options`) on its shard of the pages, assigned with consistent hashing
+    (see `HashRing`). As the workers don't share anything, the number of pages which can be monitored
+    grows with the number of workers (given enough cores).
+    The coordinator checks the health of the workers: one which exits or doesn't send its heartbeat
+    for `heartbeat_timeout` seconds (which it stops sending when its monitor is stuck for `stall_timeout` seconds
+    longer than the `interval`, see `run_shard`) is stopped and started again with the same shard, up to `max_restarts`
+    times. After that it is removed from the ring, and its pages are given to the others. As every node has many points
+    on the ring, they are spread over almost all the other workers, so none of them is restarted: they get their new
+    shards through their control pipes and take the new pages over in their next cycles, keeping the versions
+    of the pages they already had. With the snapshot `store` (every worker has its own, named after it, just like
+    the `metrics_file`, and the `metrics_port` is increased by the number of the worker) a restarted worker
+    also resumes the pages it has monitored before.
+    As a single download is limited in time (see `Monitor.download`), the `stall_timeout` must be at least as long
+    as a download may take, otherwise one slow page could stop the heartbeat of a healthy worker.
+    """
+    def __init__(self, pages, parser, workers, interval, heartbeat_timeout=HEARTBEAT_TIMEOUT, stall_timeout=STALL_TIMEOUT,
+                 max_restarts=MAX_RESTARTS, **monitor_options):
+        longest = monitor_options.get('download_timeout', DOWNLOAD_TIMEOUT)
+        if longest is not None and monitor_options.get('fetch_mode', 'threads') == 'threads':
+            # in the 'threads' fetch mode the time limit of a download may be overrun by up to the read timeout
+            read_timeout = monitor_options.get('read_timeout', READ_TIMEOUT)
+            longest = longest + read_timeout if read_timeout is not None else None
+        if longest is None or longest > stall_timeout:
+            raise ValueError(
+                f"a download may take {'forever' if longest is None else f'{longest}s'}, "
+                f"longer than the stall timeout ({stall_timeout}s)"
+            )
+
+        self.pages = pages
+        self.parser = parser
+        self.interval = interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stall_timeout = stall_timeout
+        self.max_restarts = max_restarts
+        self.monitor_options = monitor_options
+        self.ring = HashRing([f'worker-{i}' for i in range(workers)])
+        # every worker has its own pipes, so nothing sent by a stopped worker can be mistaken for its successor's
+        self.workers = {}  # name -> (process, receiving end of its pipe, sending end of its control pipe)
+        self.shards = {}  # name -> its pages
+        self.last_seen = {}  # name -> `time.monotonic()` of the latest message from the worker
+        self.restarts = collections.Counter()  # name -> how many times the worker has been restarted
+
+    def start_worker(self, name, pages):
+        """
+        Starts a worker process monitoring the given pages. Returns a `WorkerStarted` event.
+        """
+        options = dict(self.monitor_options)
+        number = int(name.rsplit('-', 1)[1])
+        for option in ('store', 'metrics_file'):
+            if options.get(option) is not None:
+                options[option] = f'{options[option]}.{name}'
+        if options.get('metrics_port') is not None:
+            options['metrics_port'] += number
+
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        control_receiver, control = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=run_shard,
+            args=(name, pages, sender, control_receiver, self.parser, self.interval, self.stall_timeout, options),
+            daemon=True
+        )
+        process.start()
+        # the worker has its own copies, without this one the end of the worker can be noticed
+        sender.close()
+        control_receiver.close()
+        self.workers[name] = (process, receiver, control)
+        self.shards[name] = pages
+        self.last_seen[name] = time.monotonic()
+        return WorkerStarted(time.time(), name, len(pages))
+
+    def stop_worker(self, name):
+        process, receiver, control = self.workers.pop(name)
+        process.terminate()
+        process.join()
+        receiver.close()
+        control.close()
+
+    def change_shard(self, name, pages):
+        """
+        Sends the new shard to the running worker (see `run_shard`). Returns a `ShardChanged` event.
+        """
+        try:
+            self.workers[name][2].send(pages)
+        except OSError:
+            pass  # the worker has just died, that's noticed (and its pages given to the others) by `watch`
+        self.shards[name] = pages
+        return ShardChanged(time.time(), name, len(pages))
+
+    def rebalance(self):
+        """
+        Assigns the pages to the nodes of the ring, starts the workers which aren't running
+        and sends the new shards to the running ones whose shards have changed (see `change_shard`).
+        Returns the list of `WorkerStarted` and `ShardChanged` events.
+        """
+        events = []
+        for name, pages in self.ring.assign(self.pages).items():
+            if name not in self.workers:
+                events.append(self.start_worker(name, pages))
+            elif self.shards[name] != pages:
+                events.append(self.change_shard(name, pages))
+        return events
+
+    def health(self):
+        """
+        Returns a dict mapping the workers to their state: whether they're alive, how many pages they monitor
+        and how many seconds ago they have been heard of.
+        """
+        now = time.monotonic()
+        return {
+            name: {'alive': process.is_alive(), 'pages': len(self.shards[name]), 'last_seen': now - self.last_seen[name]}
+            for name, (process, _, _) in self.workers.items()
+        }
+
+    def watch(self):
+        """
+        Starts the workers and yields the events of all of them (see `Monitor.watch_changes`) as they come,
+        together with `WorkerStarted`, `ShardChanged` and `WorkerLost`. The workers are stopped when the generator is closed.
+        Raises `RuntimeError` once all the workers have been given up on (see `max_restarts`).
+        """
+        try:
+            yield from self.rebalance()
+            while True:
+                if not self.workers:
+                    raise RuntimeError("all the shard workers are gone")
+                receivers = {receiver: name for name, (_, receiver, _) in self.workers.items()}
+                lost = {}
+                for receiver in multiprocessing.connection.wait(list(receivers), timeout=HEARTBEAT_INTERVAL):
+                    name = receivers[receiver]
+                    try:
+                        _, event = receiver.recv()
+                    except (EOFError, OSError):
+                        lost[name] = 'exited'  # the worker's end of the pipe has been closed
+                        continue
+                    self.last_seen[name] = time.monotonic()
+                    if event is not None:
+                        yield event
+
+                for name in self.workers:
+                    if name not in lost and time.monotonic() - self.last_seen[name] > self.heartbeat_timeout:
+                        lost[name] = 'not responding'
+                removed = False
+                for name, reason in lost.items():
+                    self.stop_worker(name)
+                    if self.restarts[name] < self.max_restarts:
+                        self.restarts[name] += 1
+                        yield WorkerLost(time.time(), name, reason, len(self.shards[name]), True)
+                        yield self.start_worker(name, self.shards[name])
                     else:
-                        before = soups[page]
-                        now = new_soups[page]
-
-                        # # the below using processes doesn't work due to the pickling mechanism
-                        # # https://www.py4u.net/discuss/225589
-                        # # seems like `bs4` objects are unpickleable in some situations (when they are large)
-                        # # the below worked fine when tested with `html_doc1` and `html_doc2` which are defined near the bottom of this file
-                        # fp = process_executor.submit(self.find_differences, None, None, before, now)
-                        # fp_to_page[fp] = page
-
-                        # measurements tell that using threads for those computations is at best
-                        # not better than running everything in the main thread one after the other:
-                        # about 1.5s of work for multi- and singlethreaded computations.
-                        # it is because there exists a Global Interpreter Lock, which effectively
-                        # means that only a single thread can run Python code within a Python process.
-                        # this means that using threads is productive really only when dealing with I/O-bound problems.
-                        # using multiple threads when optimizing the CPU-bound problems can even be counter productive
-                        # because of the context switching.
-                        # the nature of diff finding is computational, so it doesn't make sense to put it into
-                        # separate threads, since only one can be running at a time anyway.
-                        # it would be useful if processes worked for diff finding for `bs4` objets, because then CPU cores
-                        # would actually run computations in parallel, but it's not viable since `bs4` objects
-                        # are unpickleable in real-world situations (when they contain actual parsed websites),
-                        # and apparently processes demand pickling of arguments
-                        fp = thread_executor.submit(self.find_differences, None, None, before, now)
-                        fp_to_page[fp] = page
-
-                        # # single-threaded computations:
-                        # diff = self.find_differences(None, None, before, now)
-                        # # self.print_changes(diff)
-                        # # instead of the above line, for readability:
-                        # print(page)
-                        # print("Changed:", soups[page] != new_soups[page])  # `bs4`'s built-in comparison
-                        # print(len(diff))  # number of changes found by my code
-                        # print()
-
-                # when running computations in separate threads/processes this prints the results
-                for fp in concurrent.futures.as_completed(fp_to_page):
-                    diff = fp.result()
-                    page = fp_to_page[fp]
-                    # self.print_changes(diff)
-                    # instead of the above line, for readability:
-                    print(page)
-                    print("Changed:", soups[page] != new_soups[page])  # `bs4`'s built-in comparison
-                    print(len(diff))  # number of changes found by my code
-                    print()
-
-                # swapping references to objects:
-                # new_soups become current soups
-                # current soups objects will serve as a container for the new incoming soups
-                aux = soups
-                soups = new_soups
-                new_soups = aux
-
-                print(f"Time elapsed: {time.perf_counter() - t0}s")
-                print()
-                print("===================================================")
-                print("===================================================")
-                print()
+                        self.ring.remove(name)
+                        removed = True
+                        yield WorkerLost(time.time(), name, reason, len(self.shards.pop(name)), False)
+                if removed and self.ring.points:
+                    yield from self.rebalance()
+        finally:
+            self.close()
+
+    def monitor(self, sinks=(print_event, )):
+        """
+        Passes every event (see `watch`) to all the `sinks`, just like `Monitor.monitor_changes`.
+        """
+        events = self.watch()
+        try:
+            for event in events:
+                for sink in sinks:
+                    sink(event)
+        finally:
+            events.close()
+
+    def close(self):
+        for name in list(self.workers):
+            self.stop_worker(name)
+
 
 """
 Improvements: the code from the solution of the exercise from the previous list takes ~4.6s to process
@@ -292,6 +2757,8 @@ using locks for example.
 
 """
 # Google's page changes every time, because it generates a one-time numbers for some elements
+# (`ignored_attributes=('nonce', )` makes the monitor skip such pages when nothing else has changed,
+# and so does `scopes={'https://www.google.com/': Scope(ignored_elements=('script', ), ignored_attributes=('nonce', ))}`)
 # The list of WWE's personnel is the most frequently changed Wiki page in the last 15 years
 pages = [
     'https://en.wikipedia.org/wiki/List_of_WWE_personnel/',
@@ -309,5 +2776,15 @@ pages = [
 ]
 
 monitor = Monitor(pages, 'html.parser')
+# monitor = Monitor(pages, 'auto')  # the fastest parser which keeps the positions of tags, see `benchmark.py parsers`
+# monitor = Monitor(pages, 'html.parser', fetch_mode='asyncio')  # pooled keep-alive connections, see `benchmark.py fetch`
+# monitor = Monitor(pages, 'html.parser', processes=4)  # parsing and diff finding on 4 cores, see `benchmark.py diff`
+# monitor = Monitor(pages, 'html.parser', store='snapshots.db')  # resumes from the last state after a restart
+# monitor = Monitor(pages, 'html.parser', low_memory=True, trace_memory=True)  # see `benchmark.py memory`
+# monitor = Monitor(pages, 'html.parser', metrics_port=9100)  # timings of every stage at http://127.0.0.1:9100/metrics
 monitor.monitor_changes(5)
+# monitor.monitor_changes(5, sinks=(print_event, JsonLinesSink('changes.jsonl')))  # also logs every event as JSON
+# monitor.monitor_scheduled(5, 300)  # every page on its own schedule, between 5 seconds and 5 minutes
+# monitor.monitor_pipelined(5)  # like `monitor_changes`, but every page is reported as soon as it's done
+# ShardCoordinator(pages, 'html.parser', 4, 5).monitor()  # the pages split among 4 processes, see `benchmark.py shards`
 """
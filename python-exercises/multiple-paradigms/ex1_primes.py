@@ -1,4 +1,5 @@
 from functools import reduce
+from itertools import compress
 from collections import defaultdict as dd
 import timeit
 
@@ -38,6 +39,54 @@ def primes_imperative(n):
 
     return result
 
+def primes_segmented(n, segment_size=2 ** 20):
+    """
+    Takes `n` - a natural number - as an input.
+    Yields prime numbers up to `n` inclusively, in increasing order.
+    These primes are found using the Sieve of Eratosthenes too, but only odd numbers are sieved
+    and only a segment of `segment_size` of them at a time, so the memory used doesn't grow with `n`
+    (only the primes up to sqrt(n) are kept). Multiples of a prime are crossed out in a segment
+    all at once with a slice assignment, not one by one.
+    The primes can be stored compactly with e.g. `array.array('Q', primes_segmented(n))`.
+    """
+
+    if n < 2:
+        return
+    yield 2
+
+    # the odd primes up to sqrt(n), which are enough to sieve out all odd composites up to `n`;
+    # `small[i]` informs if `2 * i + 1` is prime
+    root = int(n ** 0.5)
+    while (root + 1) ** 2 <= n:  # correcting the floating-point square root
+        root += 1
+    small = bytearray([1]) * (root // 2 + 1)
+    small[0] = 0  # 1 is not a prime
+    for i in range(1, len(small)):
+        p = 2 * i + 1
+        if p * p > root:
+            break
+        if small[i]:
+            small[p * p // 2::p] = bytes(len(range(p * p // 2, len(small), p)))
+    sieving = [2 * i + 1 for i in compress(range(len(small)), small)]
+
+    size = min(segment_size, n // 2 + 1)
+    zeros = memoryview(bytes(size))  # sliced without copying to cross out multiples
+    # a segment informs which of the odd numbers `low`, `low + 2`, ..., `low + 2 * (size - 1)` are prime
+    for low in range(3, n + 1, 2 * size):
+        count = min(size, (n - low) // 2 + 1)
+        segment = bytearray([1]) * count
+        for p in sieving:
+            start = p * p
+            if start >= low + 2 * count:
+                break  # larger primes have no multiples to cross out in this segment
+            if start < low:
+                start = low + (-low) % p  # the first multiple of `p` not smaller than `low`
+                if start % 2 == 0:
+                    start += p  # even multiples aren't in the segment
+            i = (start - low) // 2  # stepping by `p` in the segment means stepping by 2p, landing on odd multiples
+            segment[i::p] = zeros[:len(range(i, count, p))]
+        yield from compress(range(low, low + 2 * count, 2), segment)
+
 # 'lcomp' stands for 'list comprehension'
 def primes_lcomp(n):
     """
@@ -82,27 +131,39 @@ print(primes_imperative(1))
 print(primes_lcomp(1))
 print(primes_functional1(1))
 print(primes_functional2(1))
+print(list(primes_segmented(1)))
 
 print(primes_imperative(2))
 print(primes_lcomp(2))
 print(primes_functional1(2))
 print(primes_functional2(2))
+print(list(primes_segmented(2)))
 
 print(primes_imperative(50))
 print(primes_lcomp(50))
 print(primes_functional1(50))
 print(primes_functional2(50))
+print(list(primes_segmented(50)))
 
 print(primes_imperative(100))
 print(primes_lcomp(100))
 print(primes_functional1(100))
 print(primes_functional2(100))
+print(list(primes_segmented(100)))
 
 i = 100000
 print(timeit.timeit(lambda: primes_imperative(i), number=1))
 print(timeit.timeit(lambda: primes_lcomp(i), number=1))
 print(timeit.timeit(lambda: primes_functional1(i), number=1))
 print(timeit.timeit(lambda: primes_functional2(i), number=1))
+print(timeit.timeit(lambda: list(primes_segmented(i)), number=1))
+print()
+
+# only the sieves are fast enough for larger inputs
+i = 10 ** 7
+print(f'sieves up to {i}:')
+print('imperative:\t', timeit.timeit(lambda: primes_imperative(i), number=1))
+print('segmented:\t', timeit.timeit(lambda: list(primes_segmented(i)), number=1))
 print()
 
 relative_performance = dd(float)
@@ -114,8 +175,9 @@ for i in range(1, N + 1):
     lcomp = timeit.timeit(lambda: primes_lcomp(test), number=1000)
     func1 = timeit.timeit(lambda: primes_functional1(test), number=1000)
     func2 = timeit.timeit(lambda: primes_functional2(test), number=1000)
+    seg   = timeit.timeit(lambda: list(primes_segmented(test)), number=1000)
 
-    best = min(imp, lcomp, func1, func2)
+    best = min(imp, lcomp, func1, func2, seg)
 
 
     # storing the sum of the quotients of performance compared to the best performance
@@ -123,21 +185,24 @@ for i in range(1, N + 1):
     relative_performance['list comp']     += lcomp / best
     relative_performance['functional 1.'] += func1 / best
     relative_performance['functional 2.'] += func2 / best
+    relative_performance['segmented']     += seg / best
 
     # the quotients tend to increase with `test`, but that's expected
-    # since the best solution (imperative Sieve of Eratosthenes)
-    # has lower asymptotic time complexity than the rest
-    # therefore the execution time of the rest grows faster than imperative's
+    # since the best solutions (the Sieves of Eratosthenes)
+    # have lower asymptotic time complexity than the rest
+    # therefore the execution time of the rest grows faster than theirs
     print(f'relative performance to the best one (test = {test}):')
     print('imperative:\t', imp / best)
     print('list comp:\t', lcomp / best)
     print('functional 1.:\t', func1 / best)
     print('functional 2.:\t', func2 / best)
+    print('segmented:\t', seg / best)
     print()
 
 
-# the conclusion is that the imperative implementation of the Sieve of Eratosthenes
-# is the fastest solution among those implemented above
+# the conclusion is that the implementations of the Sieve of Eratosthenes are the fastest
+# solutions among those implemented above, the segmented one (sieving odd numbers only,
+# with slice assignments) being the fastest except for the smallest inputs
 print()
 print(f'relative performance to the best one on average (for {N} different tests):')
 for version, performance in relative_performance.items():
@@ -0,0 +1,395 @@
+"""
+Benchmarks for the database operations of `films_db.py` (no GUI needed), run on a temporary SQLite database
+filled with generated films.
+
+Usage:
+python benchmark.py indexes [--rows N] [--repeat N]
+python benchmark.py bulk [--rows N] [--single N] [--chunk-size N]
+python benchmark.py search [--rows N [N ...]] [--repeat N]
+python benchmark.py load [--rows N] [--threads N [N ...]] [--writers N] [--seconds SECONDS]
+python benchmark.py mass [--rows N]
+python benchmark.py cache [--rows N] [--refreshes N] [--write-every N]
+"""
+
+import os
+import time
+import json
+import random
+import tempfile
+import argparse
+import threading
+import statistics
+import collections
+import tracemalloc
+
+from sqlalchemy import insert, text
+
+from films_db import Film, Handler, FilmAlreadyExistsException, open_database
+
+
+WORDS = ['night', 'day', 'city', 'river', 'dark', 'love', 'war', 'summer', 'winter', 'dead', 'man', 'woman', 'earth',
+         'sky', 'blue', 'red', 'house', 'road', 'last', 'first', 'lost', 'time', 'dream', 'light', 'fire', 'stone']
+NAMES = ['Lee', 'Smith', 'Kowalski', 'Fellini', 'Jarmusch', 'Wajda', 'Kurosawa', 'Varda', 'Bergman', 'Ozu', 'Tarkovsky',
+         'Herzog', 'Lynch', 'Kieslowski', 'Campion', 'Denis', 'Haneke', 'Ang', 'Spike', 'Agnes', 'Akira', 'Ingmar']
+
+
+def make_films(n, seed=0):
+    """
+    Yields `n` distinct generated films as dicts of their columns.
+    """
+    rng = random.Random(seed)
+    directors = [f'{rng.choice(NAMES)} {rng.choice(NAMES)} {i}' for i in range(max(1, n // 20))]
+    for i in range(n):
+        yield {
+            'title': f'{rng.choice(WORDS).title()} {rng.choice(WORDS)} {i}',
+            'year': rng.randint(1900, 2021),
+            'director': rng.choice(directors),
+            'operator': f'Operator {rng.randrange(1000)}',
+            'producer': f'Producer {rng.randrange(1000)}',
+        }
+
+
+def fill_database(path, rows, batch=50_000):
+    """
+    Creates a database with `rows` generated films at `path`.
+    Returns a pair: its factory of sessions (see `open_database`) and the list of the films.
+    """
+    sessions = open_database(path)
+    films = list(make_films(rows))
+    with sessions.begin() as session:
+        for i in range(0, rows, batch):
+            session.execute(insert(Film.__table__), films[i:i + batch])
+    return sessions, films
+
+
+def timed(function, repeat):
+    """
+    Returns the median time (in milliseconds) of `repeat` calls of the given function,
+    which is called with the number of the call.
+    """
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        function(i)
+        times.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(times)
+
+
+def legacy_add_film(session, title, year, director, operator, producer):
+    """
+    How `Handler.add_film` worked before the unique index: checking for a duplicate with a query first.
+    """
+    exists = session.query(Film).filter_by(title=title, year=year, director=director, operator=operator, producer=producer).first() is not None
+    if exists:
+        raise FilmAlreadyExistsException()
+    session.add(Film(title, year, director, operator, producer))
+    session.commit()
+
+
+def legacy_edit_films(session, changes, **filters):
+    """
+    How films were edited before the set-based `Handler.edit_films`: loading every one of them and changing its fields.
+    """
+    films = session.query(Film).filter_by(**filters).all()
+    for film in films:
+        for field, value in changes.items():
+            setattr(film, field, value)
+    session.commit()
+    return len(films)
+
+
+def legacy_remove_films(session, **filters):
+    """
+    How `Handler.remove_films` worked before: loading every matching film and deleting it.
+    """
+    films = session.query(Film).filter_by(**filters).all()
+    for film in films:
+        session.delete(film)
+    session.commit()
+    return len(films)
+
+
+def bench_indexes(args):
+    """
+    Measures the latency of adding, finding and editing films in a database of `rows` films,
+    with the indexes of `Film` and without them (as the databases created by the old versions of `film_browser.py`).
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        t0 = time.perf_counter()
+        sessions, films = fill_database(os.path.join(directory, 'films.db'), args.rows)
+        print(f'{args.rows} films inserted in {time.perf_counter() - t0:.1f}s')
+        print()
+
+        for indexed in (True, False):
+            if not indexed:
+                with sessions.begin() as session:
+                    for index in Film.__table__.indexes:
+                        session.execute(text(f'DROP INDEX {index.name}'))
+            session = sessions()  # used by the old version of `add_film` only
+            handler = Handler(sessions)
+            samples = random.Random(1).sample(films, args.repeat)
+            new = list(make_films(args.repeat, seed=2))
+            for i, film in enumerate(new):
+                film['title'] = f'New film {indexed} {i}'
+
+            def add(i):
+                film = new[i]
+                if indexed:
+                    handler.add_film(film['title'], film['year'], film['director'], film['operator'], film['producer'])
+                else:
+                    legacy_add_film(session, film['title'], film['year'], film['director'], film['operator'], film['producer'])
+
+            def add_duplicate(i):
+                film = samples[i]
+                try:
+                    if indexed:
+                        handler.add_film(film['title'], film['year'], film['director'], film['operator'], film['producer'])
+                    else:
+                        legacy_add_film(session, film['title'], film['year'], film['director'], film['operator'], film['producer'])
+                except FilmAlreadyExistsException:
+                    pass
+                else:
+                    raise AssertionError('a duplicate has been added')
+
+            def find_exact(i):
+                film = samples[i]
+                assert handler.find_films(film['title'], film['year'], film['director'], film['operator'], film['producer'])
+
+            def find_director(i):
+                handler.find_films(director=samples[i]['director'])
+
+            def edit(i):
+                film = samples[i]
+                handler.edit_film(film['title'], film['year'], film['director'], film['operator'], film['producer'],
+                                  {'producer': film['producer'] + ' (edited)'})
+                film['producer'] += ' (edited)'
+
+            print('with indexes:' if indexed else 'without indexes (old schema):')
+            print(f'\tadd:\t\t\t{timed(add, args.repeat):.3f} ms')
+            print(f'\tadd duplicate:\t\t{timed(add_duplicate, args.repeat):.3f} ms')
+            print(f'\tfind by all columns:\t{timed(find_exact, args.repeat):.3f} ms')
+            print(f'\tfind by director:\t{timed(find_director, args.repeat):.3f} ms')
+            print(f'\tedit:\t\t\t{timed(edit, args.repeat):.3f} ms')
+            print()
+            session.close()
+        sessions.kw['bind'].dispose()
+
+
+def bench_bulk(args):
+    """
+    Compares adding `single` films one by one with `Handler.add_film` with importing `rows` films from a JSON lines file
+    with `Handler.import_films`, then measures the time and the peak memory of exporting them all.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        sessions = open_database(os.path.join(directory, 'films.db'))
+        handler = Handler(sessions)
+
+        t0 = time.perf_counter()
+        for film in make_films(args.single, seed=1):
+            handler.add_film(film['title'] + ' (single)', film['year'], film['director'], film['operator'], film['producer'])
+        elapsed = time.perf_counter() - t0
+        print(f'add_film:\t{args.single / elapsed:.0f} films/s')
+
+        path = os.path.join(directory, 'films.jsonl')
+        with open(path, 'w', encoding='utf-8') as file:
+            for film in make_films(args.rows):
+                file.write(json.dumps(film) + '\n')
+        t0 = time.perf_counter()
+        added, duplicates, invalid = handler.import_films(path, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - t0
+        print(f'import_films:\t{added / elapsed:.0f} films/s ({added} added in {elapsed:.1f}s)')
+        t0 = time.perf_counter()
+        handler.import_films(path, chunk_size=args.chunk_size)
+        print(f'reimport:\t{args.rows / (time.perf_counter() - t0):.0f} films/s (all duplicates)')
+
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        exported = handler.export_films(os.path.join(directory, 'export.csv'), chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'export_films:\t{exported / elapsed:.0f} films/s, peak memory {peak / 2**20:.1f} MiB')
+        sessions.kw['bind'].dispose()
+
+
+def bench_search(args):
+    """
+    Compares the latency of `Handler.search_films` (the full-text index) with a scan of the table
+    for the same words (`LIKE '%word%'`), for databases of growing numbers of films,
+    both for common words (matching a large part of the table, so the scan finds enough of them early)
+    and for selective ones (matching a few films, so the scan reads the whole table).
+    """
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            sessions, films = fill_database(os.path.join(directory, 'films.db'), rows)
+            session = sessions()  # used by the scans
+            handler = Handler(sessions)
+
+            print(f'{rows} films:')
+            for kind, queries in (
+                ('common', [{'title': 'night'}, {'title': 'dark riv'}, {'director': 'lee'}, {'title': 'summer', 'director': 'ozu'}]),
+                ('selective', [{'title': f'night {rows // 3}'}, {'title': f'{rows // 2}'}, {'director': f'lee {rows // 50}'}]),
+            ):
+                def search(i):
+                    handler.search_films(**queries[i % len(queries)])
+
+                def scan(i):
+                    query = session.query(Film)
+                    for column, value in queries[i % len(queries)].items():
+                        for word in value.split():
+                            query = query.filter(getattr(Film, column).like(f'%{word}%'))
+                    query.limit(1000).all()
+
+                print(f'\tsearch_films (FTS5), {kind} words:\t{timed(search, args.repeat):.3f} ms')
+                print(f'\tLIKE scan, {kind} words:\t\t{timed(scan, args.repeat):.3f} ms')
+            session.close()
+            sessions.kw['bind'].dispose()
+
+
+def bench_load(args):
+    """
+    Measures the throughput of a single `Handler` shared by growing numbers of reader threads (finding films
+    by all their columns, by director, a page of the list and a full-text search, in turns)
+    running together with `writers` threads adding films, for `seconds` seconds each time.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        sessions, films = fill_database(os.path.join(directory, 'films.db'), args.rows)
+        handler = Handler(sessions)
+        added = iter(range(10**9))  # numbers of the added films (`next` of a `range` iterator is atomic)
+
+        def read(rng):
+            film = rng.choice(films)
+            kind = rng.randrange(4)
+            if kind == 0:
+                handler.find_films(film['title'], film['year'], film['director'], film['operator'], film['producer'])
+            elif kind == 1:
+                handler.find_films(director=film['director'])
+            elif kind == 2:
+                handler.find_films_page(rng.randrange(args.rows))
+            else:
+                handler.search_films(title=film['title'])
+
+        def write(rng):
+            film = rng.choice(films)
+            handler.add_film(f'Added film {next(added)}', film['year'], film['director'], film['operator'], film['producer'])
+
+        for threads in args.threads:
+            stop = threading.Event()
+            counts = collections.Counter()
+            lock = threading.Lock()
+
+            def worker(operation, name, seed):
+                rng = random.Random(seed)
+                done = 0
+                while not stop.is_set():
+                    operation(rng)
+                    done += 1
+                with lock:
+                    counts[name] += done
+
+            workers = [threading.Thread(target=worker, args=(read, 'reads', i)) for i in range(threads)]
+            workers += [threading.Thread(target=worker, args=(write, 'writes', -i - 1)) for i in range(args.writers)]
+            for thread in workers:
+                thread.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for thread in workers:
+                thread.join()
+            print(f'{threads} readers, {args.writers} writers:\t'
+                  f'{counts["reads"] / args.seconds:.0f} reads/s, {counts["writes"] / args.seconds:.0f} writes/s')
+        sessions.kw['bind'].dispose()
+
+
+def bench_mass(args):
+    """
+    Measures editing the films of a year, editing all films, removing the films of a year and clearing the database
+    of `rows` films with the set-based `Handler` methods and with loading every film first (the old way).
+    """
+    for legacy in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            sessions, films = fill_database(os.path.join(directory, 'films.db'), args.rows)
+            handler = Handler(sessions)
+            session = sessions()  # used by the old way only
+            if legacy:
+                operations = [
+                    ('edit a year', lambda: legacy_edit_films(session, {'producer': 'Someone'}, year=1950)),
+                    ('edit all', lambda: legacy_edit_films(session, {'operator': 'Someone'})),
+                    ('remove a year', lambda: legacy_remove_films(session, year=1960)),
+                    ('clear all', lambda: legacy_remove_films(session)),
+                ]
+            else:
+                operations = [
+                    ('edit a year', lambda: handler.edit_films({'producer': 'Someone'}, year=1950)),
+                    ('edit all', lambda: handler.edit_films({'operator': 'Someone'})),
+                    ('remove a year', lambda: handler.remove_films(year=1960)),
+                    ('clear all', lambda: handler.remove_films()),
+                ]
+            print('loading every film (old):' if legacy else 'set-based:')
+            for name, operation in operations:
+                t0 = time.perf_counter()
+                count = operation()
+                print(f'\t{name}:\t{time.perf_counter() - t0:.2f}s ({count} films)')
+            session.close()
+            sessions.kw['bind'].dispose()
+
+
+def bench_cache(args):
+    """
+    Measures what the GUI does after nearly every action (fetching the first page of the list) together with looking
+    films up by a director, with and without the cache of queries, while a film is added every `write_every` refreshes.
+    """
+    for cache_size in (0, 128):
+        with tempfile.TemporaryDirectory() as directory:
+            sessions, films = fill_database(os.path.join(directory, 'films.db'), args.rows)
+            handler = Handler(sessions, cache_size=cache_size)
+            directors = [film['director'] for film in films[:20]]
+            t0 = time.perf_counter()
+            for i in range(args.refreshes):
+                if i % args.write_every == 0:
+                    handler.add_film(f'new film {i}', 2000, directors[i % 20], 'Someone', 'Someone')
+                handler.find_films_page()
+                handler.find_films(director=directors[i % len(directors)])
+            elapsed = time.perf_counter() - t0
+            print(f'cache of {cache_size} results:\t{elapsed / args.refreshes * 1000:.2f}ms per refresh\t{handler.cache_info()}')
+            sessions.kw['bind'].dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    indexes = subparsers.add_parser('indexes', help='add/find/edit latency with and without the indexes')
+    indexes.add_argument('--rows', type=int, default=1_000_000)
+    indexes.add_argument('--repeat', type=int, default=20)
+    indexes.set_defaults(run=bench_indexes)
+
+    bulk = subparsers.add_parser('bulk', help='adding films one by one vs importing them in chunks, and exporting them')
+    bulk.add_argument('--rows', type=int, default=200_000, help='films imported and exported')
+    bulk.add_argument('--single', type=int, default=2000, help='films added one by one')
+    bulk.add_argument('--chunk-size', type=int, default=10000)
+    bulk.set_defaults(run=bench_bulk)
+
+    search = subparsers.add_parser('search', help='full-text search vs LIKE scans as the table grows')
+    search.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    search.add_argument('--repeat', type=int, default=20)
+    search.set_defaults(run=bench_search)
+
+    load = subparsers.add_parser('load', help='throughput of concurrent readers and writers sharing a handler')
+    load.add_argument('--rows', type=int, default=100_000)
+    load.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='numbers of reader threads')
+    load.add_argument('--writers', type=int, default=1, help='number of writer threads')
+    load.add_argument('--seconds', type=float, default=5.0)
+    load.set_defaults(run=bench_load)
+
+    mass = subparsers.add_parser('mass', help='set-based edits and removals vs loading every film first')
+    mass.add_argument('--rows', type=int, default=1_000_000)
+    mass.set_defaults(run=bench_mass)
+
+    cache = subparsers.add_parser('cache', help='repeated list refreshes and lookups with and without the cache of queries')
+    cache.add_argument('--rows', type=int, default=100_000)
+    cache.add_argument('--refreshes', type=int, default=2000)
+    cache.add_argument('--write-every', type=int, default=10, help='a film is added every that many refreshes')
+    cache.set_defaults(run=bench_cache)
+
+    args = parser.parse_args()
+    args.run(args)
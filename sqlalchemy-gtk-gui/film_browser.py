@@ -1,50 +1,89 @@
 import os
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk as gtk
-from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, String, Integer
-from sqlalchemy import create_engine
+import argparse
+import threading
+import collections
+try:
+    import gi
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import Gtk as gtk, GLib as glib
+except ImportError:  # only needed for the GUI, the import and export commands work without it
+    gtk = glib = None
+from films_db import Handler, PAGE_SIZE, open_database
 
 
-Base = declarative_base()
+def film_row(film):
+    """Returns the row of the list of films (see `View`) showing the given film."""
+    return (film.title, film.director, str(film.year), film.operator, film.producer, film.id_film)
 
-class InvalidYearException(Exception):
-    pass
 
-class FilmAlreadyExistsException(Exception):
-    pass
+def call_once(callback, value):
+    """Calls `callback(value)` and returns False, so that `GLib.idle_add` doesn't call it again."""
+    callback(value)
+    return False
 
-class FilmDoesntExistException(Exception):
-    pass
 
-class EmptyInfoException(Exception):
-    pass
-
-class Film(Base):
-    """Class that stores info about films."""
-    __tablename__ = 'films'
-
-    id_film = Column(Integer, primary_key=True, autoincrement=True)
-    year = Column(Integer)
-    title = Column(String)
-    director = Column(String)
-    operator = Column(String)
-    producer = Column(String)
+class Worker:
+    """
+    Runs calls (of `Handler` methods) one by one, in the order they were submitted, in a background thread,
+    so that the GTK main loop never waits for the database. The result of a call (or the exception it raised)
+    is passed to its callback through `schedule` (`GLib.idle_add` by default, which runs it in the main loop,
+    where the widgets can be touched). Another `schedule` (e.g. one calling the callback right away)
+    lets the controller run without GTK, with a fake view.
+    """
 
-    def __init__(self, title, year, director, operator, producer):
-        """All arguments should be strings except `year` which should a non-negative integer not larger than 2021."""
-        if not str(year).isnumeric() or not int(str(year)) <= 2021:
-            raise InvalidYearException()
+    def __init__(self, schedule=None):
+        self.schedule = schedule or glib.idle_add
+        # the calls waiting to be run: key -> (call, done, failed), in the order they were submitted
+        self.jobs = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.busy = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, call, done=None, failed=None):
+        """
+        Makes the worker run `call()`, then `done(result)` (or `failed(exception)`) through `schedule`.
+        A waiting call with the same `key` is dropped (so e.g. many clicks in a row make a single query)
+        and this one takes its place at the end of the queue, so it still runs after everything submitted before it.
+        """
+        with self.condition:
+            self.jobs.pop(key, None)
+            self.jobs[key] = (call, done, failed)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs and not self.closed:
+                    self.condition.wait()
+                if not self.jobs:
+                    return
+                key, (call, done, failed) = self.jobs.popitem(last=False)
+                self.busy = True
+            try:
+                callback, value = done, call()
+            except Exception as exception:
+                callback, value = failed, exception
+            if callback is not None:
+                self.schedule(call_once, callback, value)
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def wait(self):
+        """Waits until all the submitted calls are done (their callbacks may still be waiting for the main loop)."""
+        with self.condition:
+            while self.jobs or self.busy:
+                self.condition.wait()
+
+    def close(self):
+        """Lets the submitted calls finish and stops the worker's thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
 
-        self.year = int(str(year))
-        self.title = title
-        self.director = director
-        self.operator = operator
-        self.producer = producer
-    
-    def __str__(self):
-        return f'"{self.title}" by {self.director}, {self.year}, operator: {self.operator}, producer: {self.producer}'
 
 class View:
     """Class that handles GUI for this application."""
@@ -58,6 +97,13 @@ class View:
         self.treeview   = self.builder.get_object('treeview_items')
         self.selection  = self.treeview.get_selection()
         self.films_list = self.builder.get_object('films_list')
+        self.adjustment = self.treeview.get_vadjustment()
+        # the list shows the films fetched so far, page by page as it is scrolled down (see `Controller.load_more`):
+        # `last_id` is the id of the last of them and `complete` tells whether there are no more films to fetch
+        self.last_id = None
+        self.complete = False
+        # whether the list shows the results of a search (see `Controller.search_films`) instead of all the films
+        self.searching = False
 
         # full-info widget componenets
         self.year_label = self.builder.get_object('year_label')
@@ -71,6 +117,7 @@ class View:
         self.add_btn = self.builder.get_object('add_btn')
         self.edit_btn = self.builder.get_object('edit_btn')
         self.rmsel_btn = self.builder.get_object('rmsel_btn')
+        self.search_btn = self.builder.get_object('search_btn')
 
         # entries
         self.year_entry = self.builder.get_object('year_entry')
@@ -110,10 +157,42 @@ class View:
         self.refresh()
 
     def update_films_list(self, films=[]):
-        """Displays all films contained in the database in a single scrollable list of items."""
+        """Displays the given films in a single scrollable list of items (as the first page, see `append_films`)."""
         self.films_list.clear()  # clears the current list
-        for film in films:  # repopulates the list with currently stored films
-            self.films_list.append((film.title, film.director, str(film.year), film.operator, film.producer))
+        self.last_id = None
+        self.complete = False
+        self.append_films(films)
+
+    def append_films(self, films):
+        """Appends the next page of films to the list."""
+        for film in films:
+            self.films_list.append(film_row(film))
+            self.last_id = film.id_film
+
+    def update_film(self, film):
+        """Shows the new info of the given (edited) film in its row, if it's in the list."""
+        treeiter = self.films_list.get_iter_first()
+        while treeiter is not None:
+            if self.films_list[treeiter][5] == film.id_film:
+                self.films_list[treeiter] = film_row(film)
+                return
+            treeiter = self.films_list.iter_next(treeiter)
+
+    def remove_films(self, ids):
+        """Removes from the list the rows of the films with the given ids (the ones removed from the database)."""
+        treeiter = self.films_list.get_iter_first()
+        while treeiter is not None:
+            if self.films_list[treeiter][5] in ids:
+                # `remove` moves the iterator to the next row, returns False if there is none
+                if not self.films_list.remove(treeiter):
+                    treeiter = None
+            else:
+                treeiter = self.films_list.iter_next(treeiter)
+
+    def near_end(self):
+        """Tells whether the list is scrolled (or is short enough) so that its end is less than a screen away."""
+        adjustment = self.adjustment
+        return adjustment.get_value() + 2 * adjustment.get_page_size() >= adjustment.get_upper()
     
     def reset_entries(self):
         self.year_entry.set_text('')
@@ -128,14 +207,22 @@ class View:
 class Controller:
     """
     Objects of this class glue GUI and database operations together.
+    The database operations run in the background (see `Worker`), the view is updated when they're done.
     """
-    def __init__(self, handler, view):
+    def __init__(self, handler, view, worker=None):
         self.handler = handler
         self.view = view
+        self.worker = worker or Worker()
+        # the lists of films are numbered: `listing` is the number of the latest one requested (see `show_films`),
+        # `shown` of the one in the view, so a page fetched for an older list isn't appended to a newer one
+        self.listing = self.shown = 0
+        # whether the next page of films is being fetched (see `load_more`)
+        self.loading = False
 
         self.view.rm_btn.connect('clicked', self.remove_films_from_db)  # triggers removal of the items that satisfy the constraints given in the entries
         self.view.add_btn.connect('clicked', self.add_film_to_db)  # triggers addition of the film that is described by the entries' content
         self.view.edit_btn.connect('clicked', self.edit_film_in_db)  # triggers the edition of the selected element
+        self.view.search_btn.connect('clicked', self.search_films)  # triggers the search for the films described by the entries' content
         self.view.rmsel_btn.connect('clicked', lambda widget: self.remove_films_from_db(widget, True))  # triggers the removal of the selected element
 
         self.view.menu_rm.connect('activate', lambda widget: self.remove_films_from_db(widget, True))  # triggers removal of the items that satisfy the constraints given in the entries
@@ -143,6 +230,10 @@ class Controller:
         self.view.menu_add.connect('activate', self.add_film_to_db)  # triggers addition of the film that is described by the entries' content
         self.view.menu_edit.connect('activate', self.edit_film_in_db)  # triggers the edition of the selected element
 
+        # the next page of films is fetched when the list is scrolled close to its end (or is too short to be scrolled)
+        self.view.adjustment.connect('value-changed', self.on_scroll)
+        self.view.adjustment.connect('changed', self.on_scroll)
+
         self.update_view()
 
     def add_film_to_db(self, widget):
@@ -159,12 +250,16 @@ class Controller:
         operator = self.view.operator_entry.get_text().strip()
         producer = self.view.producer_entry.get_text().strip()
 
-        try:
-            self.handler.add_film(title, year, director, operator, producer)
-            self.view.films_list.append((title, director, year, operator, producer))
+        def added(film):
+            # the new film has the largest id, so it belongs at the end of the list;
+            # if the list doesn't reach the end yet, then it will be fetched with the last page
+            if self.view.complete and not self.view.searching:
+                self.view.append_films([film])
             self.view.reset_entries()
             self.view.refresh()
-        except: pass
+
+        info = (title, year, director, operator, producer)
+        self.worker.submit(('add', info), lambda: self.handler.add_film(*info), added)
 
     def edit_film_in_db(self, widget):
         """
@@ -197,11 +292,15 @@ class Controller:
         if ch_operator: changes['operator'] = ch_operator
         if ch_producer: changes['producer'] = ch_producer
 
-        try:
-            self.handler.edit_film(title, year, director, operator, producer, changes)
+        def edited(film):
+            self.view.update_film(film)  # only the edited row is updated
             self.view.reset_entries()
-            self.update_view()
-        except: pass
+            self.view.set_full_info(self.view.selection)
+
+        info = (title, year, director, operator, producer)
+        self.worker.submit(
+            ('edit', info, tuple(sorted(changes.items()))), lambda: self.handler.edit_film(*info, changes), edited
+        )
 
     def remove_films_from_db(self, widget, selected=False, wipe=False):
         """
@@ -234,101 +333,121 @@ class Controller:
                 return
             self.view.reset_entries()
 
-        try:
-            self.handler.remove_films(title, year, director, operator, producer)
-            self.update_view()
-        except: pass
+        def remove():
+            # the database tells which films match, so exactly their rows are removed from the list; the worker runs
+            # the calls one by one, so nothing (done through the GUI) changes the films between these two
+            ids = set(self.handler.find_film_ids(*info)) if any(info) else None
+            self.handler.remove_films(*info)
+            return ids
 
-    def update_view(self):
+        def removed(ids):
+            # only the removed rows are removed from the list (all of them if the whole database was cleared)
+            if ids is None:
+                self.update_view()
+            elif ids:
+                self.view.remove_films(ids)
+
+        info = (title, year, director, operator, producer)
+        self.worker.submit(('remove', info), remove, removed)
+
+    def search_films(self, widget):
         """
-        Populates the films list with all the films stored in the database.
+        Lists the films found with the full-text search (see `Handler.search_films`) for the content of the entries:
+        words (or their beginnings) in the title, director, operator and producer, and the exact year.
+        If all entries are empty, then all films are listed again.
         """
-        self.view.update_films_list(self.handler.find_films())
-        self.view.refresh()
+        year = self.view.year_entry.get_text().strip()
+        title = self.view.title_entry.get_text().strip()
+        director = self.view.director_entry.get_text().strip()
+        operator = self.view.operator_entry.get_text().strip()
+        producer = self.view.producer_entry.get_text().strip()
+        if not any((title, year, director, operator, producer)):
+            self.update_view()
+            return
 
-class Handler:
-    """
-    Class that is able to handle database operations made available by this script.
-    Those are:
-    - adding a film to the database
-    - editing an existing database entry
-    - finding and listing films whose metainfo fulfill certain criteria
-    - removing from the database films whose metainfo fulfill certain criteria
-    """
+        info = (title, year, director, operator, producer)
+        self.show_films(lambda: self.handler.search_films(*info), searching=True)
 
-    def __init__(self, session):
-        self.session = session
+    def update_view(self):
+        """
+        Populates the films list with the first page of the films stored in the database
+        (the next ones are fetched as the list is scrolled, see `load_more`).
+        """
+        self.show_films(self.handler.find_films_page)
 
-    def add_film(self, title, year, director, operator, producer):
-        """Arguments should be strings containing valid metainfo about a film. All arguments are non-optional."""
-        if not all((title, director, year, operator, producer)):
-            raise EmptyInfoException()
+    def show_films(self, find, searching=False):
+        """
+        Replaces the list with the films returned by `find()` (called in the background): the first page of films
+        or (if `searching`) the results of a search, which aren't paged. Only the latest of the lists
+        requested in a row is fetched (see `Worker.submit`).
+        """
+        self.listing += 1
+        listing = self.listing
+
+        def found(films):
+            self.shown = listing
+            self.view.update_films_list(films)
+            self.view.complete = searching or len(films) < PAGE_SIZE
+            self.view.searching = searching
+            self.view.refresh()
 
-        # checking if the film has already been added to the database
-        exists = self.session.query(Film).filter_by(title=title, year=year, director=director, operator=operator, producer=producer).first() is not None
-        if exists:
-            raise FilmAlreadyExistsException()
+        def failed(exception):
+            self.shown = listing
 
-        film = Film(title, year, director, operator, producer)
-        self.session.add(film)
-        self.session.commit()
+        self.worker.submit('list', find, found, failed)
 
-    def edit_film(self, title, year, director, operator, producer, changes):
+    def load_more(self):
         """
-        Arguments should be strings containing appropriate and valid info about the edited film, except `changes`.
-        `changes` should be a dictionary containing the changes to be made in the film's database entry fields named
-        just as 2.-6. arguments of this method. Only explicitly specified fields are changed.
+        Appends the next page of films to the list, unless all of them are already there,
+        the page is already being fetched or the list is about to be replaced.
         """
-        if not all((title, director, year, operator, producer)):
-            raise EmptyInfoException()
-
-        film = self.session.query(Film).filter_by(title=title, year=year, director=director, operator=operator, producer=producer).first()
-        if film is None:
-            raise FilmDoesntExistException()
-
-        if 'year' in changes:
-            year = changes['year']
-            if not str(year).isnumeric() or not int(str(year)) <= 2021:  # assuming that a valid year is between 0 and 2021
-                raise InvalidYearException()
-            film.year = int(str(year))
-        if 'title' in changes:    film.title = changes['title']
-        if 'director' in changes: film.director = changes['director']
-        if 'operator' in changes: film.operator = changes['operator']
-        if 'producer' in changes: film.producer = changes['producer']
-
-        self.session.commit()
-
-    def remove_films(self, title=None, year=None, director=None, operator=None, producer=None):
-        """Arguments should be valid metainfo about films. A film will be removed if it matches the given criteria."""
-        filters = {}
-        if year:     filters['year'] = year
-        if title:    filters['title'] = title
-        if director: filters['director'] = director
-        if operator: filters['operator'] = operator
-        if producer: filters['producer'] = producer
-
-        to_remove = self.session.query(Film).filter_by(**filters).all()
-        for film in to_remove:
-            self.session.delete(film)
-        self.session.commit()
-
-    def find_films(self, title=None, year=None, director=None, operator=None, producer=None):
-        """Arguments should be valid metainfo about films. A film will be listed if it matches the given criteria."""
-        filters = {}
-        if year:     filters['year'] = year
-        if title:    filters['title'] = title
-        if director: filters['director'] = director
-        if operator: filters['operator'] = operator
-        if producer: filters['producer'] = producer
-        return self.session.query(Film).filter_by(**filters).all()  # returns a list of found films
+        if self.view.complete or self.loading or self.shown != self.listing:
+            return
+        self.loading = True
+        listing = self.shown
+
+        def loaded(films):
+            self.loading = False
+            if self.shown != listing:
+                return  # the list was replaced in the meantime
+            self.view.append_films(films)
+            self.view.complete = len(films) < PAGE_SIZE
+
+        def failed(exception):
+            self.loading = False
+
+        after = self.view.last_id
+        self.worker.submit('more', lambda: self.handler.find_films_page(after), loaded, failed)
+
+    def on_scroll(self, adjustment):
+        if self.view.near_end():
+            self.load_more()
 
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
-connnection_string = "sqlite:///" + os.path.join(BASE_DIR, 'films.db')
-engine = create_engine(connnection_string)
-Base.metadata.create_all(bind=engine)
-Session = sessionmaker()
-sesh = Session(bind=engine)
-controller = Controller(Handler(sesh), View())
-gtk.main()
-sesh.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Film browser: the GUI if no command is given, otherwise the command (which needs no GTK).')
+    parser.add_argument('--database', default=os.path.join(BASE_DIR, 'films.db'), help='path of the SQLite database')
+    commands = parser.add_subparsers(dest='command')
+    import_command = commands.add_parser('import', help='add the films from a CSV or JSON lines file')
+    import_command.add_argument('path')
+    import_command.add_argument('--format', choices=('csv', 'jsonl'), help='guessed from the extension if not given')
+    import_command.add_argument('--chunk-size', type=int, default=10000)
+    export_command = commands.add_parser('export', help='write all the films to a CSV or JSON lines file')
+    export_command.add_argument('path')
+    export_command.add_argument('--format', choices=('csv', 'jsonl'), help='guessed from the extension if not given')
+    args = parser.parse_args()
+
+    handler = Handler(open_database(args.database))
+    if args.command == 'import':
+        added, duplicates, invalid = handler.import_films(args.path, args.format, args.chunk_size)
+        print(f'Added {added} films, skipped {duplicates} duplicates and {invalid} invalid films.')
+    elif args.command == 'export':
+        print(f'Exported {handler.export_films(args.path, args.format)} films.')
+    elif gtk is None:
+        parser.error('the GUI requires GTK 3 (the `gi` module), only the import and export commands work without it')
+    else:
+        controller = Controller(handler, View())
+        gtk.main()
+        controller.worker.close()  # the changes submitted before the window was closed are still made
@@ -0,0 +1,557 @@
+"""
+The database layer of the film browser (see `film_browser.py`), usable on its own, without GTK:
+the `Film` model, `open_database` (an engine with a pool of connections to an SQLite database in WAL mode)
+and the `Handler` of the operations on films, each of them running in its own short session
+(with the results of the queries kept in a `QueryCache` until a change of the films makes them stale).
+"""
+
+import re
+import csv
+import json
+import threading
+import contextlib
+import collections
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import Column, String, Integer, Index
+from sqlalchemy import create_engine, event, select, update, delete, text, inspect, func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+
+
+Base = declarative_base()
+
+class InvalidYearException(Exception):
+    pass
+
+class FilmAlreadyExistsException(Exception):
+    pass
+
+class FilmDoesntExistException(Exception):
+    pass
+
+class EmptyInfoException(Exception):
+    pass
+
+# names of the columns of a film (without its id), in the order of the columns of files of films (see `Handler.import_films`)
+FILM_FIELDS = ('title', 'year', 'director', 'operator', 'producer')
+
+# how many films are fetched from the database at once to be shown in the list (see `Handler.find_films_page`)
+PAGE_SIZE = 200
+
+# the largest number of films found by a full-text search (see `Handler.search_films`)
+SEARCH_LIMIT = 1000
+# the matches of a full-text search are ranked among the first that many of them only, because ranking costs as much
+# as there are matches (and a common word can match a large part of the table), so this keeps searches fast as it grows
+RANK_WINDOW = 10_000
+
+# the number of connections kept open by the pool of an engine (see `open_database`), and how many more can be opened
+# when they are all in use (those are closed when returned); a connection is used by a single operation at a time
+POOL_SIZE = 8
+MAX_OVERFLOW = 8
+# how many seconds a writer waits for another one to finish (SQLite allows a single writer at a time)
+BUSY_TIMEOUT = 30
+
+# how many results of queries a handler keeps in memory (see `QueryCache`), 0 turns the cache off
+CACHE_SIZE = 128
+
+# the trigger removing deleted films from the full-text index (see `FTS_SCHEMA`), dropped for a moment to clear the table at once
+FTS_DELETE_TRIGGER = """CREATE TRIGGER IF NOT EXISTS films_fts_delete AFTER DELETE ON films BEGIN
+        INSERT INTO films_fts(films_fts, rowid, title, director, operator, producer)
+        VALUES ('delete', old.id_film, old.title, old.director, old.operator, old.producer);
+    END"""
+
+# the full-text index of the films (an SQLite FTS5 table indexing the text columns of the `films` table without copying them)
+# and the triggers keeping it in sync with every insert, update and delete, however they're done
+# (an update changing only the year doesn't touch the index)
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS films_fts USING fts5(
+        title, director, operator, producer, content='films', content_rowid='id_film', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS films_fts_insert AFTER INSERT ON films BEGIN
+        INSERT INTO films_fts(rowid, title, director, operator, producer)
+        VALUES (new.id_film, new.title, new.director, new.operator, new.producer);
+    END""",
+    FTS_DELETE_TRIGGER,
+    """CREATE TRIGGER IF NOT EXISTS films_fts_update AFTER UPDATE OF title, director, operator, producer ON films BEGIN
+        INSERT INTO films_fts(films_fts, rowid, title, director, operator, producer)
+        VALUES ('delete', old.id_film, old.title, old.director, old.operator, old.producer);
+        INSERT INTO films_fts(rowid, title, director, operator, producer)
+        VALUES (new.id_film, new.title, new.director, new.operator, new.producer);
+    END""",
+]
+
+
+def check_year(year):
+    """Returns the given year as an integer. Raises `InvalidYearException` unless it is a non-negative integer not larger than 2021."""
+    if not str(year).isnumeric() or not int(str(year)) <= 2021:
+        raise InvalidYearException()
+    return int(str(year))
+
+
+def film_changes(changes):
+    """
+    Returns the dict of the given changes of films' fields (see `Handler.edit_films`) with the year as an integer,
+    raises `InvalidYearException` if it isn't valid.
+    """
+    changes = {field: value for field, value in changes.items() if field in FILM_FIELDS}
+    if 'year' in changes:
+        changes['year'] = check_year(changes['year'])  # assuming that a valid year is between 0 and 2021
+    return changes
+
+
+def film_filters(title=None, year=None, director=None, operator=None, producer=None):
+    """Returns a dict of the given (non-empty) criteria, to be passed to `filter_by`."""
+    filters = {}
+    if year:     filters['year'] = year
+    if title:    filters['title'] = title
+    if director: filters['director'] = director
+    if operator: filters['operator'] = operator
+    if producer: filters['producer'] = producer
+    return filters
+
+
+def fts_query(title=None, director=None, operator=None, producer=None):
+    """
+    Returns an FTS5 query matching the films whose given columns contain words starting with every word of the given texts
+    (e.g. title 'nig' matches 'Night on Earth', director 'lee' matches 'Ang Lee' and 'Spike Lee'), None if no words are given.
+    """
+    parts = []
+    for column, value in (('title', title), ('director', director), ('operator', operator), ('producer', producer)):
+        words = re.findall(r'\w+', value or '')  # only word characters, so the syntax of FTS5 queries can't get in
+        if words:
+            parts.append(f'{column} : (' + ' AND '.join(f'"{word}"*' for word in words) + ')')
+    return ' AND '.join(parts) or None
+
+
+def file_format(path, format=None):
+    """Returns `format` if given, otherwise guesses the format of a file of films from its extension: 'csv' or 'jsonl'."""
+    if format is None:
+        format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    if format not in ('csv', 'jsonl'):
+        raise ValueError(f'unknown format of films: {format!r}')
+    return format
+
+
+class Film(Base):
+    """Class that stores info about films."""
+    __tablename__ = 'films'
+    __table_args__ = (
+        # the same film can't be stored twice, the database itself rejects duplicates (see `Handler.add_film`);
+        # the index also makes looking a film up by all of its info (and by its title alone) a search, not a full scan
+        Index('ix_films_film', 'title', 'year', 'director', 'operator', 'producer', unique=True),
+    )
+
+    id_film = Column(Integer, primary_key=True, autoincrement=True)
+    year = Column(Integer, index=True)
+    title = Column(String)
+    director = Column(String, index=True)
+    operator = Column(String)
+    producer = Column(String)
+
+    def __init__(self, title, year, director, operator, producer):
+        """All arguments should be strings except `year` which should a non-negative integer not larger than 2021."""
+        self.year = check_year(year)
+        self.title = title
+        self.director = director
+        self.operator = operator
+        self.producer = producer
+    
+    def __str__(self):
+        return f'"{self.title}" by {self.director}, {self.year}, operator: {self.operator}, producer: {self.producer}'
+
+
+def filters_overlap(filters, criteria):
+    """
+    Returns whether a film matching `criteria` (a dict of films' fields, e.g. all the fields of a single film)
+    could match `filters` too, i.e. they don't require different values of the same field.
+    """
+    return all(field_value(field, filters[field]) == field_value(field, criteria[field]) for field in filters.keys() & criteria.keys())
+
+
+def field_value(field, value):
+    """Returns the value of a film's field as it's compared by the database (years as numbers, e.g. '01999' as 1999)."""
+    if field == 'year' and str(value).isnumeric():
+        return int(str(value))
+    return str(value)
+
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class QueryCache:
+    """
+    Keeps the results of the latest `maxsize` queries of films (the least recently used ones are evicted first).
+    Every result is stored together with the filters of its query, so that a change of some films drops only
+    the results which might include them (see `invalidate`). Safe to use from many threads at once.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()  # key -> (kind, filters, result, args), the most recently used last
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        # increased by every invalidation, so that a result queried before a change isn't stored after it
+        self.generation = 0
+
+    def get(self, kind, filters, query, *args):
+        """
+        Returns (a copy of) the list of films found by `query()` for a query of the given kind, filters and other
+        arguments, from memory if the same query was made before and none of its films changed since then.
+        """
+        key = (kind, args, tuple(sorted((field, field_value(field, value)) for field, value in filters.items())))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(self.entries[key][2])
+            self.misses += 1
+            generation = self.generation
+
+        result = query()
+        with self.lock:
+            if self.maxsize > 0 and self.generation == generation:
+                self.entries[key] = (kind, filters, result, args)
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return list(result)
+
+    def invalidate(self, stale):
+        """Drops the results for which `stale(kind, filters, result, args)` is true (see `get` for the arguments)."""
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, entry in self.entries.items() if stale(*entry)]:
+                del self.entries[key]
+
+    def clear(self):
+        self.invalidate(lambda kind, filters, result, args: True)
+
+    def info(self):
+        """Returns the numbers of hits and misses so far, the maximal and the current number of stored results."""
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+
+def enable_wal(connection, record):
+    """
+    Called for every new connection: switches the database to WAL mode, in which readers don't block the writer
+    and the writer doesn't block readers, and makes commits wait only for the log, not for the database file.
+    """
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def open_database(path, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW):
+    """
+    Opens the SQLite database of films at `path` (creating it, or the missing parts of it, see `create_tables`).
+    Returns a factory of sessions (a `sessionmaker`) bound to an engine with a pool of `pool_size` connections
+    (and `max_overflow` more when needed) in WAL mode. It is safe to use from many threads at once,
+    as long as every thread uses its own sessions (just like `Handler` does).
+    """
+    # the pool is chosen explicitly, because before SQLAlchemy 2.0 file databases of SQLite aren't pooled by default
+    # (and their connections, used by many threads one after another, weren't allowed to change threads)
+    engine = create_engine(
+        'sqlite:///' + path, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+        connect_args={'timeout': BUSY_TIMEOUT, 'check_same_thread': False}
+    )
+    event.listen(engine, 'connect', enable_wal)
+    create_tables(engine)
+    # the films stay usable after their sessions are closed (nothing is expired on commit)
+    return sessionmaker(bind=engine, expire_on_commit=False)
+
+
+class Handler:
+    """
+    Class that is able to handle database operations made available by this script.
+    Those are:
+    - adding a film to the database
+    - editing an existing database entry
+    - finding and listing films whose metainfo fulfill certain criteria
+    - removing from the database films whose metainfo fulfill certain criteria
+    - searching for films by words (and their prefixes) in their metainfo
+    - importing films from CSV/JSON lines files and exporting them to such files
+
+    Every operation runs in its own short session taken from `sessions` (see `open_database`), which is closed
+    when the operation ends, so a single handler can be used from many threads at once. The returned films
+    are detached from their sessions, but all their columns are loaded.
+
+    The results of `find_films`, `find_films_page` and `search_films` are cached (see `QueryCache`, `cache_size`
+    of them at most) and the methods changing films drop just the results those changes could affect.
+    Changes made to the database in other ways (e.g. by another program) aren't noticed, call `cache.clear()` then.
+    """
+
+    def __init__(self, sessions, cache_size=CACHE_SIZE):
+        self.sessions = sessions
+        self.cache = QueryCache(cache_size)
+
+    def cache_info(self):
+        """Returns the hits and misses of the cache of queries (see `QueryCache.info`), e.g. to tune its size."""
+        return self.cache.info()
+
+    def forget(self, *criteria, added=False):
+        """
+        Drops the cached results which might change because films matching any of the given `criteria` (dicts of
+        films' fields) were changed, added or removed. A new film (`added`) gets the largest id, so it can't be
+        on a page of films which is full (see `find_films_page`). The results of full-text searches are always dropped.
+        """
+        def stale(kind, filters, result, args):
+            if kind == 'search':
+                return True
+            if added and kind == 'page' and len(result) == args[1]:  # the arguments of a page are `after` and `limit`
+                return False
+            return any(filters_overlap(filters, fields) for fields in criteria)
+        self.cache.invalidate(stale)
+
+    def add_film(self, title, year, director, operator, producer):
+        """Arguments should be strings containing valid metainfo about a film. All arguments are non-optional."""
+        if not all((title, director, year, operator, producer)):
+            raise EmptyInfoException()
+
+        film = Film(title, year, director, operator, producer)
+        with self.transaction() as session:
+            session.add(film)
+        self.forget({field: getattr(film, field) for field in FILM_FIELDS}, added=True)
+        return film
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs the enclosed block in a new session, which is committed at the end of the block (rolled back if the block
+        raises an exception) and closed. If the commit would store the same film twice (see the unique index of `Film`),
+        then raises `FilmAlreadyExistsException`.
+        """
+        try:
+            with self.sessions.begin() as session:
+                yield session
+        except IntegrityError:
+            raise FilmAlreadyExistsException()
+
+    def edit_film(self, title, year, director, operator, producer, changes):
+        """
+        Arguments should be strings containing appropriate and valid info about the edited film, except `changes`.
+        `changes` should be a dictionary containing the changes to be made in the film's database entry fields named
+        just as 2.-6. arguments of this method. Only explicitly specified fields are changed.
+        """
+        if not all((title, director, year, operator, producer)):
+            raise EmptyInfoException()
+
+        changes = film_changes(changes)
+        # editing a film into another one which is already in the database is refused too
+        criteria = dict(title=title, year=year, director=director, operator=operator, producer=producer)
+        edited = {**criteria, **changes}
+        with self.transaction() as session:
+            # the film isn't loaded before being changed, it's found by its new info afterwards (with the unique index),
+            # as SQLAlchemy older than 2.0 can't use UPDATE ... RETURNING with SQLite
+            if changes and not session.execute(
+                update(Film).filter_by(**criteria).values(**changes).execution_options(synchronize_session=False)
+            ).rowcount:
+                raise FilmDoesntExistException()
+            film = session.query(Film).filter_by(**edited).first()
+            if film is None:
+                raise FilmDoesntExistException()
+        if changes:
+            self.forget(criteria, edited)
+        return film
+
+    def edit_films(self, changes, title=None, year=None, director=None, operator=None, producer=None):
+        """
+        Changes the fields given in `changes` (just like `edit_film`) of all the films which match the given criteria
+        (of all films if there are none) with a single UPDATE statement, without loading them.
+        Returns the number of the edited films. If that would make two films the same, then none is edited
+        and `FilmAlreadyExistsException` is raised.
+        """
+        changes = film_changes(changes)
+        if not changes:
+            return 0
+        filters = film_filters(title, year, director, operator, producer)
+        with self.transaction() as session:
+            edited = session.execute(
+                update(Film).filter_by(**filters).values(**changes).execution_options(synchronize_session=False)
+            ).rowcount
+        if edited:
+            self.forget(filters, {**filters, **changes})
+        return edited
+
+    def remove_films(self, title=None, year=None, director=None, operator=None, producer=None):
+        """
+        Arguments should be valid metainfo about films. A film will be removed if it matches the given criteria.
+        The films are removed with a single DELETE statement, without loading them. Returns the number of the removed films.
+        """
+        filters = film_filters(title, year, director, operator, producer)
+        with self.transaction() as session:
+            if filters:
+                removed = session.execute(delete(Film).filter_by(**filters).execution_options(synchronize_session=False)).rowcount
+            else:
+                # clearing the whole database: the full-text index is cleared at once (this also starts the transaction,
+                # so the trigger is surely back at the end) and without the trigger (fired for every row)
+                # SQLite drops all the films at once instead of deleting them one by one
+                session.execute(text("INSERT INTO films_fts(films_fts) VALUES ('delete-all')"))
+                session.execute(text('DROP TRIGGER films_fts_delete'))
+                removed = session.execute(delete(Film).execution_options(synchronize_session=False)).rowcount
+                session.execute(text(FTS_DELETE_TRIGGER))
+        if removed:
+            self.forget(filters)  # empty filters (clearing the database) overlap with all the cached results
+        return removed
+
+    def find_films(self, title=None, year=None, director=None, operator=None, producer=None):
+        """Arguments should be valid metainfo about films. A film will be listed if it matches the given criteria."""
+        filters = film_filters(title, year, director, operator, producer)
+
+        def query():
+            with self.sessions() as session:
+                return session.query(Film).filter_by(**filters).all()  # returns a list of found films
+        return self.cache.get('all', filters, query)
+
+    def find_films_page(self, after=None, limit=PAGE_SIZE, title=None, year=None, director=None, operator=None, producer=None):
+        """
+        Like `find_films`, but returns only a page: at most `limit` films with ids larger than `after` (all if it's None),
+        ordered by their ids. The page is found with keyset pagination (by the primary key, not with an offset),
+        so fetching a page costs the same no matter how far in the list it is, and removing or adding films
+        doesn't shift the following pages.
+        """
+        filters = film_filters(title, year, director, operator, producer)
+
+        def query():
+            with self.sessions() as session:
+                films = session.query(Film).filter_by(**filters)
+                if after is not None:
+                    films = films.filter(Film.id_film > after)
+                return films.order_by(Film.id_film).limit(limit).all()
+        return self.cache.get('page', filters, query, after, limit)
+
+    def find_film_ids(self, title=None, year=None, director=None, operator=None, producer=None):
+        """Like `find_films`, but returns just the ids of the found films (without loading them, and not cached)."""
+        filters = film_filters(title, year, director, operator, producer)
+        with self.sessions() as session:
+            return session.execute(select(Film.id_film).filter_by(**filters)).scalars().all()
+
+    def search_films(self, title=None, year=None, director=None, operator=None, producer=None, limit=SEARCH_LIMIT):
+        """
+        Finds films with the full-text index: the texts given for the columns are matched by the prefixes of words
+        (see `fts_query`), `year` exactly. Returns a list of at most `limit` found films, the best matches first
+        (ranked by bm25 among the first `RANK_WINDOW` matches). Without any texts it returns the first `limit` films
+        (of the given year). Unlike `find_films`, it doesn't scan the table, so it stays fast as the table grows.
+        """
+        query = fts_query(title, director, operator, producer)
+        if query is None:
+            return self.find_films_page(limit=limit, year=year)
+        if year:
+            if not str(year).isnumeric():
+                return []
+            year = int(str(year))  # the unary plus below drops the column's affinity, so the year isn't converted by SQLite
+            # the unary plus keeps SQLite from using the index of years (and running the full-text query for every film of the year)
+            matches = ('SELECT films_fts.rowid AS id, bm25(films_fts) AS score FROM films_fts JOIN films ON films.id_film = films_fts.rowid '
+                       'WHERE films_fts MATCH :query AND +films.year = :year LIMIT :window')
+        else:
+            matches = 'SELECT rowid AS id, bm25(films_fts) AS score FROM films_fts WHERE films_fts MATCH :query LIMIT :window'
+        statement = f'SELECT films.* FROM films JOIN ({matches}) AS found ON films.id_film = found.id ORDER BY found.score LIMIT :limit'
+
+        def search():
+            with self.sessions() as session:
+                return session.query(Film).from_statement(text(statement)).params(
+                    query=query, year=year, window=RANK_WINDOW, limit=limit
+                ).all()
+        return self.cache.get('search', dict(query=query, year=year), search, limit)
+
+    def import_films(self, path, format=None, chunk_size=10000):
+        """
+        Adds the films from the file at `path` to the database: a CSV file with a header row naming the columns
+        (see `FILM_FIELDS`) or a JSON lines file with an object per film (`format` is 'csv' or 'jsonl',
+        guessed from the extension if not given).
+        The films are inserted in chunks of `chunk_size`, every chunk with a single statement in a single transaction,
+        and the films which are already in the database (or earlier in the file) are skipped by the database
+        itself (see the unique index of `Film`), so nothing is queried for them.
+        Films with missing info or an invalid year are skipped too.
+        Returns a triple: the numbers of the added, the duplicate and the invalid films.
+        """
+        added = duplicates = invalid = 0
+        statement = insert(Film.__table__).on_conflict_do_nothing()
+
+        def insert_chunk(chunk):
+            with self.sessions.begin() as session:
+                return session.execute(statement, chunk).rowcount
+
+        with open(path, newline='', encoding='utf-8') as file:
+            if file_format(path, format) == 'csv':
+                records = csv.DictReader(file)
+            else:
+                records = (json.loads(line) for line in file if line.strip())
+
+            chunk = []
+            for record in records:
+                film = {field: str(record.get(field) or '').strip() for field in FILM_FIELDS}
+                try:
+                    if not all(film.values()):
+                        raise EmptyInfoException()
+                    film['year'] = check_year(film['year'])
+                except (EmptyInfoException, InvalidYearException):
+                    invalid += 1
+                    continue
+                chunk.append(film)
+                if len(chunk) == chunk_size:
+                    inserted = insert_chunk(chunk)
+                    added += inserted
+                    duplicates += len(chunk) - inserted
+                    chunk = []
+            if chunk:
+                inserted = insert_chunk(chunk)
+                added += inserted
+                duplicates += len(chunk) - inserted
+        if added:
+            self.cache.clear()
+        return added, duplicates, invalid
+
+    def export_films(self, path, format=None, chunk_size=10000):
+        """
+        Writes all the films in the database to the file at `path`, in the same formats as `import_films` reads.
+        The films are streamed from the database `chunk_size` rows at a time as plain rows (no `Film` objects),
+        so the memory used doesn't grow with the number of films.
+        Returns the number of the exported films.
+        """
+        format = file_format(path, format)
+        exported = 0
+        with self.sessions() as session, open(path, 'w', newline='', encoding='utf-8') as file:
+            rows = session.execute(
+                select(*(getattr(Film, field) for field in FILM_FIELDS)).order_by(Film.id_film).execution_options(yield_per=chunk_size)
+            )
+            if format == 'csv':
+                writer = csv.writer(file)
+                writer.writerow(FILM_FIELDS)
+            for row in rows:
+                if format == 'csv':
+                    writer.writerow(row)
+                else:
+                    file.write(json.dumps(dict(zip(FILM_FIELDS, row)), ensure_ascii=False) + '\n')
+                exported += 1
+        return exported
+
+
+def create_tables(engine):
+    """
+    Creates the tables and their indexes (together with the full-text index, see `FTS_SCHEMA`),
+    also the indexes missing in a database created by an older version of this script.
+    Such a database can hold the same film more than once, then only its first stored copy (with the lowest id) is kept,
+    otherwise the unique index of films (see `Film`) couldn't be created.
+    """
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        if 'ix_films_film' not in {index['name'] for index in inspect(connection).get_indexes('films')}:
+            columns = (Film.title, Film.year, Film.director, Film.operator, Film.producer)
+            first_copies = select(func.min(Film.id_film)).group_by(*columns)
+            # films with a NULL in any column don't count as duplicates, just like in the unique index
+            connection.execute(
+                delete(Film).where(Film.id_film.not_in(first_copies), *(column.is_not(None) for column in columns))
+            )
+        for index in Film.__table__.indexes:
+            index.create(bind=connection, checkfirst=True)
+    with engine.begin() as connection:
+        new = not inspect(connection).has_table('films_fts')
+        # recreated, so that a database made when the trigger fired on updates of any column gets the current version
+        connection.execute(text('DROP TRIGGER IF EXISTS films_fts_update'))
+        for statement in FTS_SCHEMA:
+            connection.execute(text(statement))
+        if new:
+            # indexes the films which were already there
+            connection.execute(text("INSERT INTO films_fts(films_fts) VALUES ('rebuild')"))
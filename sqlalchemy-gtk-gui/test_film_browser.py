@@ -0,0 +1,115 @@
+"""
+Regression checks of the controller of `film_browser.py`, run with `python -m pytest`. They need no GTK:
+the controller drives a stub view, and the callbacks of the worker are called right away (in its thread).
+"""
+from films_db import Handler, open_database
+from film_browser import Controller, View, Worker
+
+
+class Entry:
+    def __init__(self):
+        self.text = ''
+
+    def get_text(self):
+        return self.text
+
+    def set_text(self, text):
+        self.text = text
+
+    def connect(self, signal, callback):
+        pass
+
+
+class ListStore:
+    # the part of `Gtk.ListStore` used by `View`, the iterators are the numbers of the rows
+    def __init__(self):
+        self.rows = []
+
+    def clear(self):
+        self.rows = []
+
+    def append(self, row):
+        self.rows.append(list(row))
+
+    def get_iter_first(self):
+        return 0 if self.rows else None
+
+    def iter_next(self, treeiter):
+        return treeiter + 1 if treeiter + 1 < len(self.rows) else None
+
+    def remove(self, treeiter):
+        del self.rows[treeiter]
+        return treeiter < len(self.rows)
+
+    def __getitem__(self, treeiter):
+        return self.rows[treeiter]
+
+    def __setitem__(self, treeiter, row):
+        self.rows[treeiter] = list(row)
+
+
+class Selection:
+    def __init__(self, films_list):
+        self.films_list = films_list
+        self.treeiter = None
+
+    def get_selected(self):
+        return self.films_list, self.treeiter
+
+
+class StubView(View):
+    # `View` without its window: the methods updating the list of films are the real ones
+    def __init__(self):
+        self.films_list = ListStore()
+        self.selection = Selection(self.films_list)
+        self.adjustment = Entry()
+        self.last_id = None
+        self.complete = False
+        self.searching = False
+        for name in ('year', 'title', 'director', 'operator', 'producer'):
+            setattr(self, f'{name}_entry', Entry())
+        for name in ('rm_btn', 'add_btn', 'edit_btn', 'search_btn', 'rmsel_btn', 'menu_rm', 'menu_clr', 'menu_add', 'menu_edit'):
+            setattr(self, name, Entry())
+
+    def near_end(self):
+        return True
+
+    def refresh(self):
+        pass
+
+
+def start(tmp_path):
+    handler = Handler(open_database(str(tmp_path / 'films.db')))
+    for i in range(6):
+        handler.add_film(f'Film {i}', 1990 + i % 2, f'Director {i % 3}', 'Operator', 'Producer')
+    view = StubView()
+    worker = Worker(schedule=lambda callback, *args: callback(*args))
+    controller = Controller(handler, view, worker)
+    worker.wait()
+    return handler, view, controller
+
+
+def titles(view):
+    return [row[0] for row in view.films_list.rows]
+
+
+def test_removing_by_criteria_removes_the_rows_the_database_removed(tmp_path):
+    handler, view, controller = start(tmp_path)
+    assert titles(view) == [f'Film {i}' for i in range(6)]
+    # the database compares the year as a number, the shown one is '1991'
+    view.year_entry.set_text('1991.0')
+    controller.remove_films_from_db(None)
+    controller.worker.wait()
+    assert titles(view) == ['Film 0', 'Film 2', 'Film 4']
+    assert titles(view) == [film.title for film in handler.find_films()]
+    controller.worker.close()
+
+
+def test_removing_the_selected_film_removes_just_its_row(tmp_path):
+    handler, view, controller = start(tmp_path)
+    view.selection.treeiter = 4
+    controller.remove_films_from_db(None, selected=True)
+    controller.worker.wait()
+    assert titles(view) == ['Film 0', 'Film 1', 'Film 2', 'Film 3', 'Film 5']
+    assert titles(view) == [film.title for film in handler.find_films()]
+    controller.worker.close()
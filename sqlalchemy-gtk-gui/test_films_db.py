@@ -0,0 +1,38 @@
+"""
+Regression checks of `films_db.py`, run with `python -m pytest`.
+"""
+import sqlite3
+
+import pytest
+
+from films_db import FilmAlreadyExistsException, Handler, open_database
+
+
+def test_opening_an_old_database_with_duplicates_keeps_the_first_copies(tmp_path):
+    # a database from before the unique index of films, which could hold the same film more than once
+    path = str(tmp_path / 'films.db')
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE films (id_film INTEGER PRIMARY KEY AUTOINCREMENT, year INTEGER, title VARCHAR, '
+        'director VARCHAR, operator VARCHAR, producer VARCHAR)'
+    )
+    connection.executemany('INSERT INTO films (year, title, director, operator, producer) VALUES (?, ?, ?, ?, ?)', [
+        (1991, 'Night on Earth', 'Jim Jarmusch', 'Frederick Elmes', 'Jim Jarmusch'),
+        (1995, 'Dead Man', 'Jim Jarmusch', 'Robby Muller', 'Demetra J. MacBride'),
+        (1991, 'Night on Earth', 'Jim Jarmusch', 'Frederick Elmes', 'Jim Jarmusch'),
+        (1991, 'Night on Earth', 'Jim Jarmusch', 'Frederick Elmes', 'Jim Jarmusch'),
+        (1999, 'Ghost Dog', 'Jim Jarmusch', None, None),
+        (1999, 'Ghost Dog', 'Jim Jarmusch', None, None),
+    ])
+    connection.commit()
+    connection.close()
+
+    handler = Handler(open_database(path))
+    films = handler.find_films()
+    assert [(film.id_film, film.title) for film in films] == [
+        (1, 'Night on Earth'), (2, 'Dead Man'), (5, 'Ghost Dog'), (6, 'Ghost Dog')
+    ]
+    assert [film.id_film for film in handler.search_films(title='night')] == [1]
+    # the unique index is there now, so the duplicates can't come back
+    with pytest.raises(FilmAlreadyExistsException):
+        handler.add_film('Night on Earth', 1991, 'Jim Jarmusch', 'Frederick Elmes', 'Jim Jarmusch')